@@ -21,7 +21,9 @@
 This module contains miscanellous tools to be used when working with Ajax requests
 """
 
-from flask import request, jsonify, json, render_template, get_flashed_messages, redirect
+import zlib
+
+from flask import request, jsonify, json, render_template, get_flashed_messages, redirect, current_app, Response, stream_with_context
 
 def request_is_ajax():
     """ Determines if an incoming request is an AJAX
@@ -68,3 +70,74 @@ def jsondump(data, isarray=False):
             return "{}"
     else:
         return result
+
+class StreamedObject(object):
+    """ Wraps an iterable of (key, value) tuples, that jsonstream encodes as a JSON object while iterating over it """
+    def __init__(self, items):
+        self.items = items
+
+class StreamedArray(object):
+    """ Wraps an iterable, that jsonstream encodes as a JSON array while iterating over it """
+    def __init__(self, values):
+        self.values = values
+
+# Size of the chunks sent by jsonstream, before compression
+_stream_chunk_size = 64 * 1024
+
+def jsonstream(data):
+    """ Returns a response that sends the provided data serialized into json while it is being encoded.
+        The data may contain StreamedObject and StreamedArray instances, so that large
+        structures are produced, encoded and sent progressively instead of all at once.
+        The response is compressed on the fly if the client accepts gzip.
+    """
+    chunks = _bufferchunks(_iterencode(data, current_app.json_encoder()))
+    headers = {}
+    if 'gzip' in request.accept_encodings:
+        chunks = _gzipchunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+    return Response(stream_with_context(chunks), mimetype='application/json', headers=headers)
+
+def _iterencode(data, encoder):
+    if isinstance(data, StreamedObject):
+        separator = '{'
+        for key, value in data.items:
+            if not isinstance(key, basestring):
+                key = str(key) # Like json.dumps
+            yield separator + encoder.encode(key) + ':'
+            for chunk in _iterencode(value, encoder):
+                yield chunk
+            separator = ','
+        yield '}' if separator == ',' else '{}'
+    elif isinstance(data, StreamedArray):
+        separator = '['
+        for value in data.values:
+            yield separator
+            for chunk in _iterencode(value, encoder):
+                yield chunk
+            separator = ','
+        yield ']' if separator == ',' else '[]'
+    else:
+        yield encoder.encode(data)
+
+def _bufferchunks(chunks):
+    """ Groups small chunks into chunks of about _stream_chunk_size bytes """
+    buf = []
+    size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= _stream_chunk_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf)
+
+def _gzipchunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16) # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -20,28 +20,33 @@
 """ Contains pages and web services used to manipulate shinken configuration files """
 
 import copy
+import cPickle as pickle
+import fcntl
+import hashlib
+import json
 import os
 import os.path
 import re
 import shutil
+import tempfile
+import threading
 from subprocess import call, Popen
 
 import pynag.Model
 from pynag.Parsers import config
-from flask import jsonify, render_template, abort, request, redirect
+from flask import jsonify, render_template, abort, request, redirect, g
 from flask.ext.login import login_required, current_user
 from wtforms import Form, TextField, SelectField, SelectMultipleField, TextAreaField, SelectFieldBase, validators
 from wtforms.fields.html5 import IntegerField, URLField
-from werkzeug.contrib.cache import SimpleCache
 from shinken.property import none_object
 import shinken.objects
 from shinken.objects.config import Config
 from shinken.property import BoolProp, PythonizeError
 import chardet
 
-from . import app, cache, db
+from . import app, db
 from user import User
-from sqlalchemy import Table, select, exists, or_
+from sqlalchemy import Table, select, exists, or_, func
 
 
 _typekeys = {
@@ -66,7 +71,6 @@ _typekeys = {
     'broker': 'broker_name'
 }
 
-CACHE_TIMEOUT = 60
 LOCK_FILE = '/tmp/hokuto_shinken_conf.lock'
 
 CONF_DIR = '/etc/shinken/'
@@ -75,13 +79,21 @@ WAIT_DIR = '/tmp/waiting/'
 WAIT_CONF_DIR = WAIT_DIR + 'shinken/'
 CONF_FILE = 'shinken.cfg'
 MIGRATE_FILE = 'migrate.txt'
+MIGRATE_STATUS_FILE = '/tmp/hokuto_migration_status.json'
+MIGRATE_LOCK_FILE = '/tmp/hokuto_migration.lock'
 SERVICE_WARNING_FILE = '/tmp/service_changed.txt'
 LAST_CHECK = '/tmp/hokuto_shinken_test_results'
 SIGNAL = '/tmp/shinken_update.signal'
+CONF_CACHE_FILE = '/tmp/hokuto_shinken_conf.cache'
+CONF_CACHE_VERSION = 4 # Increment when the content of the configuration snapshot changes
 
 # Tell pynag's Model to go fetch the fake configuration path
 pynag.Model.cfg_file = os.path.join(TMP_DIR, CONF_FILE)
 
+# Pickled version of the last configuration loaded by this process,
+# stored as a (fingerprint, payload) tuple
+_conf_snapshot = None
+
 #################################### FUNCTIONS ##########################################
 def _check_lock():
     ''' Check if the configuration is currently locked and if the user is the current owner '''
@@ -133,33 +145,321 @@ def _release_lock():
     return False
 
 def _getconf():
-    """ Return the conf from /tmp """
-    conf = cache.get('nag_conf')
+    """
+    Return the conf from /tmp
+
+    The parsed configuration is shared between all the server processes through a snapshot file
+    (see CONF_CACHE_FILE), identified by the fingerprint of the staged configuration files.
+    Each request gets its own copy of the configuration, so it can be freely modified.
+    """
+    conf = getattr(g, 'nag_conf', None)
+    if conf is not None:
+        return conf
+
+    conf = _refresh_conf()
     if conf is None:
-        # No conf in cache; load it
-        if not os.path.exists(TMP_DIR):
-            if os.path.exists(WAIT_CONF_DIR):
-                src = WAIT_CONF_DIR
-            else:
-                src = CONF_DIR
-            p = Popen(['cp','-R','--preserve=timestamps',src,TMP_DIR])
-            p.wait()
-
-        shinken_file = os.path.join(TMP_DIR, CONF_FILE)
-        app.logger.debug('PyNag is loading configuration at: ' + shinken_file)
-        conf = config(shinken_file) # Let pynag find out the configuration path by itself
-        conf.parse()
-
-        # TODO : Improve error handling
-        # We remove the errors from the configuration as the error type
-        # (ParserError) cannot be deserialized by the cache system
-        for e in conf.errors:
-            app.logger.warning('PyNag error: ' + str(e))
-        conf.errors = []
-
-        cache.set('nag_conf', conf, timeout=CACHE_TIMEOUT) #TODO : Configure cache timeout
+        conf = pickle.loads(_conf_snapshot[1])[1]
+    g.nag_conf = conf
+    return conf
+
+def _refresh_conf():
+    """
+    Brings the configuration snapshot of this process up to date with the staged configuration files,
+    and drops the copy used by the current request.
+    When the snapshot is outdated, only the files that changed since it was taken are parsed again if possible.
+    Returns the configuration if it had to be parsed, or None if an existing snapshot could be used.
+    """
+    global _conf_snapshot
+    g.nag_conf = None
+
+    if not os.path.exists(TMP_DIR):
+        if os.path.exists(WAIT_CONF_DIR):
+            src = WAIT_CONF_DIR
+        else:
+            src = CONF_DIR
+        p = Popen(['cp','-R','--preserve=timestamps',src,TMP_DIR])
+        p.wait()
+
+    files = _stat_conf_files()
+    fingerprint = _conf_fingerprint(files)
+    if _conf_snapshot is not None and _conf_snapshot[0] == fingerprint:
+        return None
+    payload = _read_conf_snapshot(fingerprint)
+    if payload is not None:
+        _conf_snapshot = (fingerprint, payload)
+        return None
+
+    # Nobody parsed this version of the configuration yet.
+    # Start from any previous snapshot and only parse what changed since then
+    conf = None
+    if _conf_snapshot is not None:
+        base = _conf_snapshot[1]
+    else:
+        base = _read_conf_snapshot()
+    if base is not None:
+        base_files, conf = pickle.loads(base)
+        if not _reparse_changed(conf, base_files, files):
+            conf = None
+    if conf is None:
+        conf = _parseconf()
+
+    payload = pickle.dumps((files, conf), pickle.HIGHEST_PROTOCOL)
+    _write_conf_snapshot(fingerprint, payload)
+    _conf_snapshot = (fingerprint, payload)
+    return conf
+
+def _parseconf():
+    """ Parse the whole configuration stored in /tmp with pynag """
+    shinken_file = os.path.join(TMP_DIR, CONF_FILE)
+    app.logger.debug('PyNag is loading configuration at: ' + shinken_file)
+    conf = config(shinken_file) # Let pynag find out the configuration path by itself
+    conf.parse()
+
+    # TODO : Improve error handling
+    # We remove the errors from the configuration as the error type
+    # (ParserError) cannot be deserialized by the cache system
+    for e in conf.errors:
+        app.logger.warning('PyNag error: ' + str(e))
+    conf.errors = []
+
+    conf.index = _ConfigIndex(conf)
     return conf
 
+def _reparse_changed(conf, old_files, new_files):
+    """
+    Updates a parsed configuration by parsing again only the object files that changed.
+    *old_files* contains the state of the files when *conf* was parsed, and *new_files*
+    their current state (both as returned by _stat_conf_files).
+
+    Returns False if the changes cannot be applied incrementally, for example when the main configuration
+    file or a template changed. In this case the configuration should be parsed again from scratch.
+    """
+    stale = set(f for f in new_files if old_files.get(f) != new_files[f])
+    stale.update(f for f in old_files if f not in new_files)
+    if not stale:
+        return True
+
+    parsed = set(os.path.normpath(f) for f in conf.cfg_files)
+    current = {os.path.normpath(f): f for f in conf.get_cfg_files()}
+    for f in stale:
+        if f not in parsed and f not in current:
+            # Not an object file: main configuration, resources...
+            return False
+
+    dropped = [i for i in conf.pre_object_list if os.path.normpath(i['meta']['filename']) in stale]
+    try:
+        added = []
+        for f in stale:
+            if f in current:
+                added.extend(conf.parse_file(current[f]))
+    except Exception as ex:
+        app.logger.debug('Incremental configuration parsing failed: ' + str(ex))
+        return False
+    # Other objects may inherit from templates; they would all have to be resolved again
+    if any('name' in i for i in dropped) or any('name' in i for i in added):
+        return False
+
+    app.logger.debug('PyNag is parsing {0} modified configuration files'.format(len(stale)))
+    isstale = lambda i: os.path.normpath(i['meta']['filename']) in stale
+    conf.pre_object_list = [i for i in conf.pre_object_list if not isstale(i)]
+    conf.post_object_list = [i for i in conf.post_object_list if not isstale(i)]
+    conf.item_list = None # Makes pynag rebuild its templates lookup table
+    typekeys = set('all_' + i['meta']['object_type'] for i in dropped)
+    for typekey in typekeys:
+        conf.data[typekey] = [i for i in conf.data[typekey] if not isstale(i)]
+
+    for item in added:
+        objtype = item['meta']['object_type']
+        conf.pre_object_list.append(item)
+        conf.item_apply_cache.setdefault(objtype, {})
+        if 'use' in item:
+            item = conf._apply_template(item)
+        conf.post_object_list.append(item)
+        conf.data.setdefault('all_' + objtype, []).append(item)
+        typekeys.add('all_' + objtype)
+    conf.cfg_files = conf.get_cfg_files()
+
+    for e in conf.errors:
+        app.logger.warning('PyNag error: ' + str(e))
+    conf.errors = []
+
+    conf.index.update(typekeys)
+    return True
+
+def _stat_conf_files():
+    """
+    Returns the state of the staged configuration files, as a dict associating
+    the path of each .cfg file to its inode, modification time and size
+    """
+    files = {}
+    for root, dirs, filenames in os.walk(TMP_DIR):
+        for f in filenames:
+            if not f.endswith('.cfg'):
+                continue
+            path = os.path.normpath(os.path.join(root, f))
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # Removed while we were walking the directory
+            files[path] = (st.st_ino, st.st_mtime, st.st_size)
+    return files
+
+def _conf_fingerprint(files):
+    """
+    Returns a string identifying a state of the staged configuration files (see _stat_conf_files).
+    It changes as soon as any process writes into the configuration.
+    """
+    return hashlib.sha1(repr((CONF_CACHE_VERSION, sorted(files.iteritems())))).hexdigest()
+
+def _read_conf_snapshot(fingerprint = None):
+    """
+    Returns the pickled (files, configuration) tuple stored in the shared snapshot file.
+    If a fingerprint is specified, returns None if the snapshot does not match it.
+    """
+    try:
+        with open(CONF_CACHE_FILE, 'rb') as f:
+            if f.readline().rstrip('\n') != fingerprint and fingerprint is not None:
+                return None
+            return f.read()
+    except IOError:
+        return None
+
+def _write_conf_snapshot(fingerprint, payload):
+    """ Stores a pickled (files, configuration) tuple into the shared snapshot file """
+    try:
+        # Write to a temporary file first so that other processes never read a partial snapshot
+        fd, tmppath = tempfile.mkstemp(prefix='.hokuto_conf', dir=os.path.dirname(CONF_CACHE_FILE))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(fingerprint + '\n')
+            f.write(payload)
+        os.rename(tmppath, CONF_CACHE_FILE)
+    except (IOError, OSError) as ex:
+        app.logger.warning('Could not write the configuration snapshot: ' + str(ex))
+
+def _invalidate_conf():
+    """ Drops the parsed configuration from this process and from the shared snapshot """
+    global _conf_snapshot
+    _conf_snapshot = None
+    g.nag_conf = None
+    try:
+        os.remove(CONF_CACHE_FILE)
+    except OSError:
+        pass
+
+class _ConfigIndex(object):
+    """
+    Lookup tables over the objects of a parsed configuration, built once when the configuration
+    is loaded and stored along with it (see _getconf).
+
+    Objects are indexed by type and primary key or template name, and services are also
+    indexed by their (description, host, hostgroup) triplet. Just like a linear search,
+    lookups return the first matching object in the configuration.
+
+    The template each inherited attribute comes from is also resolved here, and stored
+    in the 'inherited_from' dict of the object meta data (see _annotateform).
+    """
+    def __init__(self, conf):
+        self.data = conf.data
+        self.objects = {} # (list name, key) => { key value: object }
+        self.names = {} # (list name, key) => sorted list of key values
+        self.services = {} # service key => { (description, host, hostgroup): service }
+        self.update()
+
+    def update(self, typekeys = None):
+        """ Rebuilds the tables of the specified object lists (for example 'all_host'), or of every list """
+        if typekeys is None:
+            typekeys = [k for k in self.data if k.startswith('all_')]
+        for typekey in typekeys:
+            items = self.data.get(typekey, [])
+            objtype = typekey[4:]
+            keys = set(['name', objtype + '_name'])
+            if objtype in _typekeys:
+                keys.add(_typekeys[objtype])
+            for key in keys:
+                table = {}
+                for e in items:
+                    if key in e:
+                        table.setdefault(e[key], e)
+                self.objects[(typekey, key)] = table
+                self.names[(typekey, key)] = sorted(e[key] for e in items if key in e)
+            if typekey == 'all_service':
+                self.__index_services(items)
+            self.__resolve_inheritance(typekey, items)
+
+    def __resolve_inheritance(self, typekey, items):
+        templates = self.objects.get((typekey, 'name'), {})
+        resolved = {} # id(object) => { attribute: template name }
+        for e in items:
+            self.__inherited_from(e, templates, resolved)
+
+    def __inherited_from(self, item, templates, resolved):
+        """
+        Finds out which template provides each inherited attribute of item.
+        Like pynag, the first template of the use directive that has a value wins.
+        """
+        sources = resolved.get(id(item))
+        if sources is not None:
+            return sources
+        sources = {}
+        resolved[id(item)] = sources # Also protects against inheritance loops
+        inherited = item['meta']['inherited_attributes']
+        for name in item.get('use', '').split(','):
+            name = name.strip()
+            parent = templates.get(name)
+            if parent is None:
+                continue
+            parentsources = self.__inherited_from(parent, templates, resolved)
+            defined = parent['meta']['defined_attributes']
+            for attr in inherited:
+                if attr in sources:
+                    continue
+                if attr in defined:
+                    sources[attr] = name
+                elif attr in parentsources:
+                    sources[attr] = parentsources[attr]
+        item['meta']['inherited_from'] = sources
+        return sources
+
+    def __index_services(self, services):
+        self.services = {}
+        for e in services:
+            host = e.get('host_name')
+            hostgroup = e.get('hostgroup_name')
+            for key in ('service_description', 'name'):
+                if key not in e:
+                    continue
+                table = self.services.setdefault(key, {})
+                desc = e[key]
+                table.setdefault((desc, None, None), e)
+                if host is not None:
+                    table.setdefault((desc, host, None), e)
+                if hostgroup is not None:
+                    table.setdefault((desc, None, hostgroup), e)
+                if host is not None and hostgroup is not None:
+                    table.setdefault((desc, host, hostgroup), e)
+
+    def find(self, typekey, key, value):
+        """ Returns the first object of the typekey list whose key directive equals value, or None """
+        table = self.objects.get((typekey, key))
+        if table is None:
+            # Not indexed; fall back to a full scan
+            return next((e for e in self.data.get(typekey, []) if key in e and e[key] == value), None)
+        return table.get(value)
+
+    def find_service(self, key, description, host = None, hostgroup = None):
+        """
+        Returns the first service whose key directive (service_description or name) equals description.
+        If host or hostgroup are specified, the service must also be attached to them.
+        """
+        return self.services.get(key, {}).get((description, host, hostgroup))
+
+    def list_names(self, typekey, key):
+        """ Returns the sorted values of the key directive of all the objects of the typekey list """
+        names = self.names.get((typekey, key))
+        if names is None:
+            names = sorted(e[key] for e in self.data.get(typekey, []) if key in e)
+        return list(names)
+
 def _checkConf():
     """ Check shinken configuration and write check results to LAST_CHECK """
     conf_root = os.path.join(TMP_DIR, CONF_FILE)
@@ -240,7 +540,7 @@ def _get_details(objtype, istemplate, objid, formtype, targetfinder = None):
                 primkey = 'name'
             else:
                 primkey = _typekeys[objtype]
-            target = next((e for e in conf.data[typekey] if primkey in e and e[primkey] == objid), None)
+            target = conf.index.find(typekey, primkey, objid)
         else:
             target = targetfinder(conf, istemplate)
         if target is None:
@@ -297,21 +597,11 @@ def _searchservice(conf, istemplate, objid, containers):
             else:
                 host = containers[ihost+1:ihostgroup-1]
                 hostgroup = containers[ihostgroup+1:]
-            target = next((e for e in conf.data['all_service'] if service_key in e and e[service_key] == objid and
-                                                            'host_name' in e and e['host_name'] == host and
-                                                            'hostgroup_name' in e and e['hostgroup_name'] == hostgroup), None)
-
         else:
             host = containers[ihost+1:]
-            target = next((e for e in conf.data['all_service'] if service_key in e and e[service_key] == objid and
-                                                            'host_name' in e and e['host_name'] == host), None)
-    else:
-        if ihostgroup >= 0:
-            hostgroup = containers[ihostgroup+1:]
-            target = next((e for e in conf.data['all_service'] if service_key in e and e[service_key] == objid and
-                                                            'hostgroup_name' in e and e['hostgroup_name'] == hostgroup), None)
-        else:
-            target = next((e for e in conf.data['all_service'] if service_key in e and e[service_key] == objid), None)
+    elif ihostgroup >= 0:
+        hostgroup = containers[ihostgroup+1:]
+    target = conf.index.find_service(service_key, objid, host, hostgroup)
     if target is None:
         abort(404)
     return target
@@ -366,8 +656,8 @@ def _save_new(form,targettype):
         os.chmod(savedir + '/' + filename,0o644)
         f.close()
 
-    #delete conf cache
-    cache.delete('nag_conf')
+    #parse the modified files again
+    _refresh_conf()
     return True
 
 
@@ -439,8 +729,8 @@ def _save_existing(conf, data, form, form_is_comprehensive):
         conf.commit()
         if changed_id[0]:
             _populate_migration_list(*changed_id)
-        #delete conf cache
-        cache.delete('nag_conf')
+        #parse the modified files again
+        _refresh_conf()
 
     return did_change
 
@@ -456,34 +746,121 @@ def _populate_migration_list(objtype,path,new,old):
         f.write(objtype + '|' + path + '|' + old + '|' + new + "\n")
 
 def _migrate_data():
-    """ Migrate host or service data when updating their identifer name"""
+    """
+    Migrate host or service data when updating their identifer name
+
+    The migration runs in the background, as renaming a busy host may touch a lot of rows.
+    Its progress can be followed with get_migration_status. Migrations started by several requests
+    or server processes run one after the other (see _run_migration).
+    """
     if not os.path.isfile(WAIT_CONF_DIR + MIGRATE_FILE):
-        return
+        return False
     with open(WAIT_CONF_DIR + MIGRATE_FILE,'r') as f:
-        for line in f:
-            migrate = line.rstrip().split('|')
-            objtype = migrate[0]
-            old = migrate[2]
-            new = migrate[3]
-            app.logger.info('Need to migrate ' + objtype + ' : ' + old + ' to ' + new)
-            #Update any reference in the dashboard, sla and graph databases
-            from dashboard import partsConfTable
-            from sla import Sla
-            from grapher import graphTokenTable
-            for row in db.engine.execute(select([partsConfTable.c.key]).where(partsConfTable.c.key.startswith('probe|'+old))):
-                old_key = row[0]
-                new_key = old_key.replace('probe|'+old,'probe|'+new)
-                db.session.execute(partsConfTable.update().where(partsConfTable.c.key == old_key), {'key': new_key})
-
-            for row in db.engine.execute(select([graphTokenTable.c.key]).where(graphTokenTable.c.key.startswith(old+':'))):
-                old_key = row[0]
-                new_key = old_key.replace(old+':',new+':')
-                db.session.execute(graphTokenTable.update().where(graphTokenTable.c.key == old_key), {'key': new_key})
-
-            for row in Sla.query.filter_by(host_name=old).all():
-                row.host_name = new
-
-            db.session.commit()
+        renames = [line.rstrip().split('|') for line in f if line.strip()]
+    if not renames:
+        return False
+
+    _write_migration_status('waiting', 0, len(renames))
+    worker = threading.Thread(target=_run_migration, args=(renames,), name='hokuto-migration')
+    worker.start()
+    return True
+
+def _run_migration(renames):
+    """ Updates every reference to the renamed objects in the dashboard, sla and graph databases, in a single transaction """
+    from dashboard import partsConfTable
+    from sla import Sla
+    from grapher import graphTokenTable, graphPositionsTable
+    slaTable = Sla.__table__
+    total = len(renames)
+    i = 0
+    # The lock is held until the end of the migration, and released by the system if the process dies
+    lock = open(MIGRATE_LOCK_FILE, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _write_migration_status('running', 0, total)
+        with app.app_context():
+            with db.engine.begin() as conn:
+                for i, migrate in enumerate(renames):
+                    objtype = migrate[0]
+                    old = migrate[2]
+                    new = migrate[3]
+                    app.logger.info('Need to migrate ' + objtype + ' : ' + old + ' to ' + new)
+                    conn.execute(partsConfTable.update()
+                                               .where(partsConfTable.c.key.startswith('probe|'+old))
+                                               .values(key=func.replace(partsConfTable.c.key, 'probe|'+old, 'probe|'+new)))
+                    conn.execute(graphTokenTable.update()
+                                                .where(graphTokenTable.c.key.startswith(old+':'))
+                                                .values(key=func.replace(graphTokenTable.c.key, old+':', new+':')))
+                    _rename_graph_positions(conn, graphPositionsTable, old, new)
+                    conn.execute(slaTable.update()
+                                         .where(slaTable.c.host_name == old)
+                                         .values(host_name=new))
+                    _write_migration_status('running', i + 1, total)
+        _write_migration_status('done', total, total)
+    except Exception as ex:
+        app.logger.error('Data migration failed: ' + str(ex))
+        _write_migration_status('failed', i, total, '{0} (failed at rename {1} of {2}, all the changes were rolled back)'.format(ex, i + 1, total))
+    finally:
+        lock.close()
+
+def _rename_graph_positions(conn, table, old, new):
+    """ Renames the object in the graph positions stored as JSON dictionaries, whose keys look like "host:x" """
+    if isinstance(old, str):
+        old = old.decode('utf-8')
+    if isinstance(new, str):
+        new = new.decode('utf-8')
+    prefix = old + ':'
+    # Only load the entries that may contain the object; the stored entries and this pattern are
+    # both made by json.dumps, which escapes the non-ASCII characters the same way
+    pattern = json.dumps(prefix)[:-1]
+    q = select([table.c.user_id, table.c.graph_id, table.c.positions]).where(table.c.positions.contains(pattern))
+    for uid, graph_id, positions in conn.execute(q).fetchall():
+        positions = json.loads(positions)
+        renamed = {}
+        for key, value in positions.iteritems():
+            if key.startswith(prefix):
+                key = new + key[len(old):]
+            renamed[key] = value
+        conn.execute(table.update()
+                          .where(table.c.user_id == uid)
+                          .where(table.c.graph_id == graph_id)
+                          .values(positions=json.dumps(renamed, separators=(',', ':'))))
+
+def _write_migration_status(state, done, total, error = None):
+    """ Stores the progress of the data migration, so that any server process can report it """
+    status = {'state': state, 'done': done, 'total': total}
+    if error is not None:
+        status['error'] = error
+    try:
+        fd, tmppath = tempfile.mkstemp(prefix='.hokuto_migration', dir=os.path.dirname(MIGRATE_STATUS_FILE))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(status, f)
+        os.rename(tmppath, MIGRATE_STATUS_FILE)
+    except (IOError, OSError) as ex:
+        app.logger.warning('Could not write the migration status: ' + str(ex))
+
+@app.route('/config/migration', methods=['GET'])
+@login_required
+def get_migration_status():
+    """ Returns the progress of the last data migration """
+    try:
+        with open(MIGRATE_STATUS_FILE, 'r') as f:
+            status = json.load(f)
+    except (IOError, ValueError):
+        return jsonify({'state': 'none'})
+    if status['state'] == 'running' and not _is_migration_locked():
+        # The server process running the migration died, and its transaction was rolled back
+        status['state'] = 'interrupted'
+    return jsonify(status)
+
+def _is_migration_locked():
+    """ Tells if a data migration is currently running in any server process """
+    try:
+        with open(MIGRATE_LOCK_FILE, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        return True
+    return False
 
 
 # #########################################################################################################
@@ -573,31 +950,47 @@ def _validatefullform(form,data):
     return tmp.validate()
 
 def _annotateform(form, data):
-    typedata = getattr(shinken.objects, data['meta']['object_type'].title(), None)
-    if typedata is None:
+    defaults = _get_default_annotations(data['meta']['object_type'])
+    if defaults is None:
         return
+    inherited = data['meta']['inherited_attributes']
+    sources = data['meta'].get('inherited_from', {})
     for field in form:
-        propdata = None
-        if field.name in typedata.properties:
-            propdata = typedata.properties[field.name]
         # Is the value inherited ?
-        if field.name in data['meta']['inherited_attributes']:
-            desc = _createannotation(data['meta']['inherited_attributes'][field.name], True)
-            if desc is not None:
-                field.placeholder = desc
-        elif propdata is not None:
-            if propdata.default != none_object:
-                desc = _createannotation(propdata.default, False)
-                if desc is not None:
-                    field.placeholder = desc
-
-def _createannotation(value, inherited):
+        if field.name in inherited:
+            desc = _createannotation(inherited[field.name], True, sources.get(field.name))
+        else:
+            desc = defaults.get(field.name)
+        if desc is not None:
+            field.placeholder = desc
+
+# Object type => { property: annotation of its default value }
+_default_annotations = {}
+
+def _get_default_annotations(objtype):
+    """ Returns the annotations describing the Shinken default values of the properties of an object type """
+    if objtype not in _default_annotations:
+        typedata = getattr(shinken.objects, objtype.title(), None)
+        if typedata is None:
+            annotations = None
+        else:
+            annotations = {}
+            for name, propdata in typedata.properties.iteritems():
+                if propdata.default != none_object:
+                    desc = _createannotation(propdata.default, False)
+                    if desc is not None:
+                        annotations[name] = desc
+        _default_annotations[objtype] = annotations
+    return _default_annotations[objtype]
+
+def _createannotation(value, inherited, source = None):
     """
     Generates a string that describes the default value of a property
 
     value contains the default value applied
     inherited tells if the default value is applied because it's inherited
     (True) or just because no value is available (False)
+    source is the name of the template the value is inherited from, if known
     """
     empty = False
     if value is None or value == ['']:
@@ -607,7 +1000,7 @@ def _createannotation(value, inherited):
 
     if empty:
         if inherited:
-            return 'Default value: empty (inherited)'
+            return 'Default value: empty ({0})'.format(_inheritancenote(source))
         else:
             return None
 
@@ -622,9 +1015,14 @@ def _createannotation(value, inherited):
 
     value = 'Default: {0}'.format(value)
     if inherited:
-        value = value + ' (inherited)'
+        value = value + ' ({0})'.format(_inheritancenote(source))
     return value
 
+def _inheritancenote(source):
+    if source is None:
+        return 'inherited'
+    return 'inherited from {0}'.format(source)
+
 def _listobjects(type, key = None):
     # A template ?
     is_template = False
@@ -638,12 +1036,7 @@ def _listobjects(type, key = None):
             key = type + '_name'
     conf = _getconf()
     typekey = 'all_' + type
-    if typekey in conf.data:
-        result = [i[key] for i in conf.data[typekey] if key in i]
-        result.sort()
-        return result
-    else:
-        return []
+    return conf.index.list_names(typekey, key)
 
 def _listobjects_choices(type, addempty = False, key = None, description = None):
     """ Gets a list from _listobjects and formats it so it can work with a SelectField """
@@ -750,11 +1143,11 @@ def applyConf():
             return jsonify({'success':0, 'error': 'Error while moving files from '+TMP_DIR+' to '+WAIT_CONF_DIR})
         open(SIGNAL,'a').close()
         #delete conf cache
-        cache.delete('nag_conf')
-        _migrate_data()
+        _invalidate_conf()
+        migrating = _migrate_data()
         if(os.path.isfile(SERVICE_WARNING_FILE)):
             os.remove(SERVICE_WARNING_FILE)
-        return jsonify({'success': 1, 'service_changed': service_changed})
+        return jsonify({'success': 1, 'service_changed': service_changed, 'migrating': migrating})
     with open(LAST_CHECK,'r') as filehandler:
         message = ''
         message = [message + line[18:-4] for line in filehandler if line.find('ERROR') != -1]
@@ -777,7 +1170,7 @@ def resetConf():
     pcode = call(['rm','-r',TMP_DIR])
     if pcode:
         return jsonify({'success': False, 'message': "Can't remove "+TMP_DIR})
-    cache.delete('nag_conf')
+    _invalidate_conf()
     if os.path.isfile(TMP_DIR + MIGRATE_FILE):
         open(TMP_DIR + MIGRATE_FILE, 'w').close()
     return jsonify({'success': True})
@@ -828,7 +1221,7 @@ def delete_conf(typeid,objid):
     else:
         conf = _getconf()
         typekey = 'all_'+typeid
-        target = next((e for e in conf.data[typekey] if primkey in e and e[primkey] == objid), None)
+        target = conf.index.find(typekey, primkey, objid)
         filename = target['meta']['filename'];
         app.logger.debug('Removing file "{0}" because it contains object "{1}" of type "{2}"'.format(filename, objid, typeid))
         os.remove(filename)
@@ -836,8 +1229,8 @@ def delete_conf(typeid,objid):
     if is_template:
         typeid = typeid + 'template'
 
-    #delete conf cache
-    cache.delete('nag_conf')
+    #parse the modified file again
+    _refresh_conf()
     return redirect('/config#'+typeid)
 
 @app.route('/config/expert/<typeid>/<objid>', methods=['GET','POST'])
@@ -860,7 +1253,7 @@ def expert_mode(typeid,objid):
 
     conf = _getconf()
     typekey = 'all_'+typeid
-    target = next((e for e in conf.data[typekey] if primkey in e and e[primkey] == objid), None)
+    target = conf.index.find(typekey, primkey, objid)
     filename = target['meta']['filename']
 
     form = ExpertForm(request.form)
@@ -870,12 +1263,12 @@ def expert_mode(typeid,objid):
         if not _check_lock():
             abort(403)
         _set_lock()
-        f = open(filename,'w')
         fdata = {k.name:k.data for k in form}
-        f.write(fdata['field'])
+        with open(filename,'w') as f:
+            f.write(fdata['field'])
 
-        #delete conf cache
-        cache.delete('nag_conf')
+        #parse the modified file again
+        _refresh_conf()
         if is_template:
             typeid = typeid + 'template'
         return redirect('/config#'+ typeid)
@@ -20,7 +20,7 @@
 
 """ Contains tools used to display the dashboards """
 
-from flask import render_template, request, abort
+from flask import render_template, request, abort, session
 from flask.ext.login import login_required, current_user
 from sqlalchemy import Table, select, exists, or_
 
@@ -30,8 +30,13 @@ from widgetsloader import load_widgets_list
 from unit import Unit
 
 import json
+import time
 from collections import defaultdict
 
+# Number of seconds the dashboards list is kept in the session, so that dashboards
+# created from another session of the same user eventually show up
+DASHBOARDS_LIST_TTL = 60
+
 @app.route('/dashboards')
 @login_required
 def dashboards(dashname = None):
@@ -92,23 +97,33 @@ def dashboard_part_save():
         savedata['col'] = int(request.form['col'])
     if 'row' in request.form:
         savedata['row'] = int(request.form['row'])
-    if pid <= 0:
-        # New part
-        savedata['widget'] = request.form['widget']
-        savedata['dashboard'] = request.form['dashboard']
-        savedata['title'] = request.form['title']
-        pid = create_part(**savedata)
-    else:
-        # Existing part
-        if 'title' in request.form:
-            savedata['title'] = request.form['title']
-        del savedata['id']
-        if len(savedata):
-            update_part(pid, **savedata)
-
+    conf = None
     if 'conf' in request.form:
-        update_part_conf(pid, json.loads(request.form['conf']))
-
+        conf = json.loads(request.form['conf'])
+
+    # Save the part and its configuration in a single transaction
+    created = False
+    with db.engine.begin() as conn:
+        if pid <= 0:
+            # New part
+            savedata['widget'] = request.form['widget']
+            savedata['dashboard'] = request.form['dashboard']
+            savedata['title'] = request.form['title']
+            pid = create_part(conn, **savedata)
+            created = True
+        else:
+            # Existing part
+            if 'title' in request.form:
+                savedata['title'] = request.form['title']
+            del savedata['id']
+            if len(savedata):
+                update_part(pid, conn, **savedata)
+
+        if conf is not None:
+            update_part_conf(pid, conf, conn)
+
+    if created:
+        invalidate_list_dashboards()
     return jsondump({'original_id': oldid, 'saved_id': pid})
 
 #TODO: Create delete probe and delete scale methods
@@ -169,9 +184,20 @@ def global_dashboards_list():
     
 # DATA ACCESS
 def get_list_dashboards():
-    """ Returns a list of dashboard names available to the currently connected user """
+    """ Returns a list of dashboard names available to the currently connected user.
+        The list is cached in the user's session, see invalidate_list_dashboards.
+    """
+    cached = session.get('dashboards_list')
+    if cached is not None and cached.get('user_id') == current_user.id and cached.get('expires', 0) > time.time():
+        return list(cached['names'])
     query = select([partsTable.c.dashboard]).where(partsTable.c.user_id == current_user.id).distinct()
-    return [row[0] for row in db.engine.execute(query).fetchall()]
+    names = [row[0] for row in db.engine.execute(query).fetchall()]
+    session['dashboards_list'] = {'user_id': current_user.id, 'names': names, 'expires': time.time() + DASHBOARDS_LIST_TTL}
+    return names
+
+def invalidate_list_dashboards():
+    """ Drops the cached dashboards list of the current user, once dashboards have been created, renamed or deleted """
+    session.pop('dashboards_list', None)
 
 def dashboard_name_exists(name):
     """ Checks if the currently connected user has a dashboard with the provided name """
@@ -183,7 +209,8 @@ def dashboard_name_exists(name):
 def get_dashboard_parts(dashboard):
     """ Returns an array of all the parts contained in the specified dashboard """
     query = select([partsTable]).where(partsTable.c.user_id == current_user.id).where(partsTable.c.dashboard == dashboard)
-    resultset = db.engine.execute(query)
+    resultset = db.engine.execute(query).fetchall()
+    confs = get_confs([row[partsTable.c.id] for row in resultset])
     return [{'id': row[partsTable.c.id],
              'widget': row[partsTable.c.widget],
              'dashboard': dashboard,
@@ -192,13 +219,15 @@ def get_dashboard_parts(dashboard):
              'height': row[partsTable.c.height],
              'col': row[partsTable.c.col],
              'row': row[partsTable.c.row],
-             'conf': get_conf(row[partsTable.c.id]),
+             'conf': confs[row[partsTable.c.id]],
          } for row in resultset]
 
-def create_part(**partdata):
+def create_part(conn = None, **partdata):
     """ Creates a new part for the current user, returning its ID.
         The informations that must be provided for creation are the widget, dashboard
         and title of the new part.
+        conn may be a connection to use instead of the database engine, for example to use a transaction;
+        in this case the caller must call invalidate_list_dashboards once the transaction is committed.
     """
     # TODO: check that the dashboards count does not exceed some maximum
 
@@ -216,13 +245,18 @@ def create_part(**partdata):
     partdata['user_id'] = current_user.id
     if 'id' in partdata:
         del partdata['id'] # Remove the ID so we get the database-generated ID
-    return db.engine.execute(partsTable.insert(), partdata).inserted_primary_key[0]
+    if conn is None:
+        pid = db.engine.execute(partsTable.insert(), partdata).inserted_primary_key[0]
+        invalidate_list_dashboards()
+        return pid
+    return conn.execute(partsTable.insert(), partdata).inserted_primary_key[0]
 
 
-def update_part(id, **partdata):
+def update_part(id, conn = None, **partdata):
     """ Updates the specified part, if it belongs to the currently connected user.
         Note that the user_id, widget, and dashboard fields will not be saved.
         Also, empty titles are not taken into account.
+        conn may be a connection to use instead of the database engine.
     """
     # Remove any data that cannot change after creation
     if 'id' in partdata:
@@ -238,85 +272,94 @@ def update_part(id, **partdata):
         del partdata['title']
 
     query = partsTable.update().where(partsTable.c.id == id).where(partsTable.c.user_id == current_user.id)
-    db.engine.execute(query, partdata);
+    if conn is None:
+        conn = db.engine
+    conn.execute(query, partdata);
 
 # PARTS CONF
-@app.route('/dashboards/part/conf/<id>')
+@app.route('/dashboards/part/conf/<int:id>')
 def get_conf(id):
-    query = select([partsConfTable]).where(partsConfTable.c.parts_id == id)
-    results = {}
-    results['probes'] = defaultdict(dict)
-    results['scales'] = defaultdict(dict)
+    return get_confs([id])[id]
 
+def get_confs(ids):
+    """ Returns the configuration of each of the specified parts, by part ID, using a single query """
+    results = {}
+    for id in ids:
+        results[id] = {}
+        results[id]['probes'] = defaultdict(dict)
+        results[id]['scales'] = defaultdict(dict)
+    if not ids:
+        return results
+
+    query = select([partsConfTable]).where(partsConfTable.c.parts_id.in_(ids))
     for row in db.engine.execute(query):
+        conf = results[row[0]]
         if(row[1].startswith('probe|')):
             probe = row[1].split('|',3)
-            results['probes'][probe[1]][probe[2]] = row[2]
+            conf['probes'][probe[1]][probe[2]] = row[2]
         elif row[1].startswith('scale|'):
             scale = row[1].split('|',3)
-            results['scales'][scale[1]][scale[2]] = row[2]
+            conf['scales'][scale[1]][scale[2]] = row[2]
         else:
-            results[row[1]] = row[2]
+            conf[row[1]] = row[2]
     return results
 
-def update_part_conf(id,conf):
+def update_part_conf(id, conf, conn = None):
     """ Update part's conf table
+        Only the keys whose value changed are written, with a single bulk upsert.
+        conn may be a connection to use instead of the database engine; otherwise
+        a transaction is used.
         TODO: need more check and error handling
     """
+    entries = {}
     for(key,value) in conf.items():
         if key == 'probes':
             for(probe,setting) in value.items():
                 for(name, v) in setting.items():
-                    probeKey='probe|'+probe+'|'+name
-                    entry={
-                        'parts_id':id,
-                        'key': probeKey,
-                        'value':v
-                    }
-                    save_conf_key(id, probeKey, entry)
+                    entries['probe|'+probe+'|'+name] = v
         elif key == 'scales':
             for(scale,setting) in value.items():
                 for(name, v) in setting.items():
-                    scaleKey='scale|'+scale+'|'+name
-                    entry={
-                        'parts_id':id,
-                        'key': scaleKey,
-                        'value':v
-                    }
-                    save_conf_key(id, scaleKey, entry)
-
+                    entries['scale|'+scale+'|'+name] = v
         else:
-            entry = {
-                'parts_id': id,
-                'key': key,
-                'value': value
-            }
-            save_conf_key(id,key,entry)
+            entries[key] = value
+    if not entries:
+        return
+
+    if conn is None:
+        with db.engine.begin() as conn:
+            _save_conf_entries(conn, id, entries)
+    else:
+        _save_conf_entries(conn, id, entries)
+
+def _save_conf_entries(conn, parts_id, entries):
+    """ Adds or updates keys into the parts_conf table """
+    query = select([partsConfTable.c.key, partsConfTable.c.value]).where(partsConfTable.c.parts_id == parts_id)
+    oldconf = {row[0]: row[1] for row in conn.execute(query)}
+    rows = [{'parts_id': parts_id, 'key': key, 'value': value}
+            for key, value in entries.iteritems()
+            if key not in oldconf or oldconf[key] != value]
+    if rows:
+        conn.execute(partsConfTable.insert().prefix_with('OR REPLACE'), rows)
 
 def remove_conf_key(parts_id,keys):
     """ Remove conf key """
     query = partsConfTable.delete().where(partsConfTable.c.parts_id == parts_id).where(or_(*keys))
     db.engine.execute(query)
 
-def save_conf_key(parts_id,key,entry):
-    """ Add or update a key into the parts_conf table """
-    oldconf = [row[0] for row in db.engine.execute(select([partsConfTable.c.key]).where(partsConfTable.c.parts_id == parts_id))]
-    if(key in oldconf):
-        result = db.engine.execute(partsConfTable.update().where(partsConfTable.c.parts_id == parts_id).where(partsConfTable.c.key == key), entry)
-    else:
-        result = db.engine.execute(partsConfTable.insert(), entry)
-
 def delete_part(id):
     """ Removes the specified part from the database, if it belongs to the current user """
     query = partsTable.delete().where(partsTable.c.id == id).where(partsTable.c.user_id == current_user.id)
     db.engine.execute(query)
     query = partsConfTable.delete().where(partsConfTable.c.parts_id == id)
     db.engine.execute(query)
+    invalidate_list_dashboards()
 
 def rename_dashboard(oldname, newname):
     """ Rename dashboard from the database """
     query = partsTable.update().where(partsTable.c.user_id == current_user.id).where(partsTable.c.dashboard == oldname)
     db.engine.execute(query, {'dashboard': newname})
+    invalidate_list_dashboards()
 
 # DATABASES
 partsConfTable = Table('parts_conf',
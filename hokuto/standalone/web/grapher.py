@@ -24,7 +24,15 @@
     to the server that stores the layed out positions for this user.
 
 """
+import hashlib
+import multiprocessing
+from array import array
+import os
 import re
+import signal
+import tempfile
+import time
+import uuid
 # deep copy import (copying of lists)
 from copy import deepcopy
 from math import ceil, sin, cos, floor, pi, sqrt
@@ -34,23 +42,44 @@ from json import JSONEncoder
 from flask import abort, json, render_template, request
 from flask.ext.login import login_required, current_user
 from sqlalchemy import Table
-from sqlalchemy.sql import select, bindparam, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import select, bindparam, func, union
 
 # Imports for networkx
 import networkx as nx
 
 import igraph as ig
 
+# NumPy is only used to refine the position of new nodes
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from on_reader.livestatus import livestatus, get_all_hosts, get_all_services
 
 from . import app, db, utils
-from ajax import jsondump
+from ajax import jsondump, jsonstream, StreamedObject
 
 # Defines the default space between two nodes.
 # The different algoriths in this files will try to aim for this
 # value whenever possible
 _base_node_spacing = 60
 
+# Number of force-directed iterations used to place new nodes into an existing layout
+_incremental_layout_iterations = 50
+
+# Number of movable nodes whose neighbours are searched at once when refining a layout,
+# which bounds the size of the distance matrices to this number times the nodes count
+_refine_chunk_size = 256
+
+# Directory where the background layout jobs store their status and results
+_layout_jobs_dir = '/tmp/hokuto_layout_jobs/'
+
+# Signals handled by the web server processes, whose handlers are reset in the layout jobs processes
+_layout_jobs_signals = (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGHUP,
+                        signal.SIGUSR1, signal.SIGUSR2, signal.SIGWINCH, signal.SIGCHLD)
+
 # Defines a prefix that should be used to store metadata
 # attached to a graph in the graph state database
 _metadata_storage_prefix = 'hokuto__meta:'
@@ -78,6 +107,9 @@ class GraphTypeError(Exception):
 # BEGIN : Common Graph struture tools
     
 class GraphNode(object):
+    # Graphs may contain thousands of nodes, don't give each of them a __dict__
+    __slots__ = ('id', 'label', 'x', 'y', 'placed', 'link_in', 'link_out', 'category', 'shinken_type', 'attributes', 'group', 'radius')
+
     def __init__(self, id, label, category, shinken_type, **kwargs):
         self.id = id
         self.label = label
@@ -102,6 +134,8 @@ class GraphNode(object):
         return hash(self.id)
 
 class GraphEdge(object):
+    __slots__ = ('source', 'target', 'shinken_type', 'attributes')
+
     def __init__(self, source_node, target_node, shinken_type, **kwargs):
         self.source = source_node
         self.target = target_node
@@ -161,23 +195,31 @@ class GraphBase(object):
             as well as a boolean specifying if any nodes were actually found to create this bounding box.
             Note that only placed nodes are included to compute the bounding box
         """
-        xminlist = [n.x - n.radius for n in self.nodes.itervalues() if n.placed]
-        xmaxlist = [n.x + n.radius for n in self.nodes.itervalues() if n.placed]
-        yminlist = [n.y - n.radius for n in self.nodes.itervalues() if n.placed]
-        ymaxlist = [n.y + n.radius for n in self.nodes.itervalues() if n.placed]
-        if len(xminlist) == 0:
-            return (0, 0, 0, 0, False)
-        return (min(xminlist),
-                min(yminlist),
-                max(xmaxlist),
-                max(ymaxlist),
-                True)
+        found = False
+        left = top = right = bottom = 0
+        for n in self.nodes.itervalues():
+            if not n.placed:
+                continue
+            r = n.radius
+            if not found:
+                left, top, right, bottom = n.x - r, n.y - r, n.x + r, n.y + r
+                found = True
+                continue
+            if n.x - r < left:
+                left = n.x - r
+            if n.x + r > right:
+                right = n.x + r
+            if n.y - r < top:
+                top = n.y - r
+            if n.y + r > bottom:
+                bottom = n.y + r
+        return (left, top, right, bottom, found)
 
     def normalize(self):
         """ Moves all the placed nodes by the same amount, so that the top-left corner of the bbox becomes (0,0) """
         bbox_left, bbox_top, bbox_right, bbox_bottom, has_content = self.get_bounds()
         if has_content:
-            for n in self.nodes.values():
+            for n in self.nodes.itervalues():
                 n.x -= bbox_left
                 n.y -= bbox_top
 
@@ -206,7 +248,7 @@ class GraphBase(object):
                     [e for e in node.link_out if e.target.id in self.nodes])
 
     def move_by(self, x, y):
-        for n in self.nodes.values():
+        for n in self.nodes.itervalues():
             if n.placed:
                 n.x += x
                 n.y += y
@@ -215,7 +257,7 @@ class GraphBase(object):
         return len(self.nodes) == 0
 
     def scale(self, x, y):
-        for n in self.nodes.values():
+        for n in self.nodes.itervalues():
             if n.placed:
                 n.x *= x
                 n.y *= y
@@ -228,6 +270,21 @@ class GraphBase(object):
                 result = n.radius
         return result
 
+    def get_adjacency(self):
+        """
+        Returns the edges of this graph as compressed sparse rows: a (ids, indptr, indices) tuple, where the edges
+        going out of the node ids[i] go to the nodes whose indices in ids are indices[indptr[i]:indptr[i + 1]]
+        """
+        ids = self.nodes.keys()
+        index = {id: i for i, id in enumerate(ids)}
+        indptr = array('i', [0])
+        indices = array('i')
+        for id in ids:
+            link_in, link_out = self.get_local_links(self.nodes[id])
+            indices.extend(index[e.target.id] for e in link_out)
+            indptr.append(len(indices))
+        return (ids, indptr, indices)
+
     def extract_unplaced_nodes(self):
         result = GraphBase()
         result.nodes = { n.id: n for n in self.nodes.itervalues() if not n.placed }
@@ -376,30 +433,46 @@ class Graph(GraphBase):
                     result['link:' + self.nodes[n].id + ':' + e.target.id] = 'virtual'
         return result
 
-    def generate_full_data(self):
+    def generate_full_data(self, streamed = False):
+        """
+        Generates the dictionnary describing the whole graph that is sent to the client.
+        If streamed is true, the result is meant for ajax.jsonstream, and the nodes data is generated while it is sent.
+        """
         result = {}
-        result['nodes'] = {n: self.nodes[n].__dict__ for n in self.nodes}
-        for n in result['nodes']:
-            # Before we send back the data, turn edges into simpler objects to avoid circular references
-            result['nodes'][n]['link_in'] = map(Graph.__map_edges, result['nodes'][n]['link_in'])
-            result['nodes'][n]['link_out'] = map(Graph.__map_edges, result['nodes'][n]['link_out'])
-            # Same for the group
-            if result['nodes'][n]['group'] is not None:
-                result['nodes'][n]['group'] = result['nodes'][n]['group'].id
+        if streamed:
+            result['nodes'] = StreamedObject(self.__generate_nodes_data())
+        else:
+            result['nodes'] = dict(self.__generate_nodes_data())
         # Add groups, only those with at least one node
-        result['groups'] = {id: self.groups[id].__dict__ for id in self.groups if len(self.groups[id].nodes) > 0}
-        for g in result['groups'].values():
-            del g['nodes'] # Remove nodes from groups to avoid circular references. Node->group associations are sotred in the nodes
-            for key in g.keys():
-                if key.startswith('_'):
-                    del g[key] # Remove stuff starting with a _ (no need to have them on the client side)
+        # Node->group associations are stored in the nodes
+        result['groups'] = {id: {'id': g.id, 'label': g.label, 'shinken_type': g.shinken_type}
+                            for id, g in self.groups.iteritems() if len(g.nodes) > 0}
         # Add metadata
         m = self.metadata
         if m is None:
             m = {}
         result['meta'] = m
+        if streamed:
+            return StreamedObject(result.iteritems())
         return result
 
+    def __generate_nodes_data(self):
+        for id, n in self.nodes.iteritems():
+            yield (id, {'id': n.id,
+                        'label': n.label,
+                        'x': n.x,
+                        'y': n.y,
+                        'placed': n.placed,
+                        # Turn edges into simpler objects to avoid circular references
+                        'link_in': map(Graph.__map_edges, n.link_in),
+                        'link_out': map(Graph.__map_edges, n.link_out),
+                        'category': n.category,
+                        'shinken_type': n.shinken_type,
+                        'attributes': n.attributes,
+                        # Same for the group
+                        'group': None if n.group is None else n.group.id,
+                        'radius': n.radius})
+
     @staticmethod
     def __map_edges(edge):
         return { 'source': edge.source.id, 'target': edge.target.id, 'shinken_type': edge.shinken_type, 'attributes': edge.attributes }
@@ -481,7 +554,7 @@ def _create_physical_hosts_graph_structure(hostgroups = None):
     """
     g = Graph()
     permissions = utils.get_contact_permissions(current_user.shinken_contact)
-    all_hosts = get_all_hosts()
+    all_hosts = get_all_hosts('graph')
 
     for hname, h in all_hosts.iteritems():
         if hname not in permissions['hosts']:
@@ -506,7 +579,8 @@ def _create_logical_services_graph_structure(hosts = None, servicegroups = None)
     The servicegroups parameter can contain an array of service group names. If provided, only services belonging to those groups will be included.
     """
     g = Graph()
-    slist = get_all_services()
+    # Filtering by service group requires all the services columns
+    slist = get_all_services('graph' if servicegroups is None else None)
 
     #remove forbidden services
     permissions = utils.get_contact_permissions(current_user.shinken_contact)
@@ -544,8 +618,8 @@ def _create_logical_hosts_graph_structure(hostgroups = None):
     parameter that may contain an array of strings (hostgroup names)
     """
     g = Graph()
-    slist = get_all_services()
-    hlist = get_all_hosts()
+    slist = get_all_services('graph')
+    hlist = get_all_hosts('graph')
     permissions = utils.get_contact_permissions(current_user.shinken_contact)
     tmp = {}
     for s in slist:
@@ -609,17 +683,10 @@ def _execute_networkx_layout(graph, nx_graph, graphtype):
     
 def _execute_igraph(graph, scale, layout_name, **kwargs):
     """ Executes an iGraph layout on the specified graph """
-    ig_graph = ig.Graph(directed = True)
-    names_index = []
-    # First the nodes
-    for n in graph.nodes:
-        ig_graph.add_vertex(n)
-        names_index.append(n)
-    # Then the edges
-    for n in graph.nodes.values():
-        link_in, link_out = graph.get_local_links(n)
-        for e in link_out:
-            ig_graph.add_edge(e.source.id, e.target.id)
+    names_index, indptr, indices = graph.get_adjacency()
+    edges = [(i, indices[j]) for i in xrange(len(names_index)) for j in xrange(indptr[i], indptr[i + 1])]
+    ig_graph = ig.Graph(n = len(names_index), edges = edges, directed = True)
+    ig_graph.vs['name'] = names_index
 
     layout = ig_graph.layout(layout_name, **kwargs)
 
@@ -673,6 +740,97 @@ def _fit_unplaced_nodes(graph, non_linear = False):
     isolated_g.normalize()
     isolated_g.move_by(0, g_bottom + _base_node_spacing)
     
+def _place_new_nodes(graph):
+    """
+    Places the nodes that are missing from an existing layout, without moving the other nodes.
+    New nodes linked to the graph are refined with a few force-directed iterations if NumPy is available.
+    """
+    movable = [n for n in graph.nodes.itervalues() if not n.placed and (n.link_in or n.link_out)]
+    has_placed = any(n.placed for n in graph.nodes.itervalues())
+    _fit_unplaced_nodes(graph)
+    if np is not None and movable and has_placed:
+        _refine_new_nodes(graph, movable, _incremental_layout_iterations)
+
+def _refine_new_nodes(graph, movable, iterations):
+    """
+    Runs a bounded force-directed layout on the movable nodes, all the other nodes being fixed.
+    Linked nodes attract each other up to the usual link length, and nodes closer than
+    their radiuses plus the base spacing repel each other.
+    """
+    ids = graph.nodes.keys()
+    index = {id: i for i, id in enumerate(ids)}
+    pos = np.array([(graph.nodes[id].x, graph.nodes[id].y) for id in ids], dtype=float)
+    radius = np.array([graph.nodes[id].radius for id in ids], dtype=float)
+    moving = np.array([index[n.id] for n in movable])
+    count = len(ids)
+
+    # Edges that have at least one movable end
+    edges = set()
+    for n in movable:
+        link_in, link_out = graph.get_local_links(n)
+        for e in link_in + link_out:
+            edges.add((index[e.source.id], index[e.target.id]))
+    edges = np.array(sorted(edges)).reshape(-1, 2)
+    src, dst = edges[:, 0], edges[:, 1]
+    link_length = (radius[src] + radius[dst]) * 1.8
+    max_distance = radius.max() * 2 + _base_node_spacing
+
+    # Avoid nodes that are exactly on top of each other
+    pos[moving] += np.random.uniform(-1, 1, (len(moving), 2))
+    temperature = float(_base_node_spacing)
+    cooling = 0.05 ** (1.0 / iterations)
+    for it in xrange(iterations):
+        if it % 10 == 0:
+            # Only the nodes close enough to be reached within the next iterations can repel the movable ones,
+            # find those (movable node, node) pairs once in a while
+            rows, cols = _find_close_nodes(pos, moving, max_distance + temperature * 20)
+            min_distance = radius[moving][rows] + radius[cols] + _base_node_spacing
+
+        # Repulsion between close nodes
+        delta = pos[moving][rows] - pos[cols]
+        distance = np.maximum(np.sqrt((delta ** 2).sum(axis=1)), 0.01)
+        push = delta * (np.clip(min_distance - distance, 0, None) / distance)[:, None]
+        disp = np.empty((len(moving), 2))
+        for axis in (0, 1):
+            disp[:, axis] = np.bincount(rows, push[:, axis], len(moving))
+
+        # Attraction along the edges
+        delta = pos[dst] - pos[src]
+        length = np.maximum(np.sqrt((delta ** 2).sum(axis=1)), 0.01)
+        pull = delta * ((length - link_length) / length * 0.5)[:, None]
+        for axis in (0, 1):
+            forces = np.bincount(src, pull[:, axis], count) - np.bincount(dst, pull[:, axis], count)
+            disp[:, axis] += forces[moving]
+
+        # Limit the displacement to the current temperature
+        length = np.maximum(np.sqrt((disp ** 2).sum(axis=1)), 0.01)
+        pos[moving] += disp * (np.minimum(length, temperature) / length)[:, None]
+        temperature *= cooling
+
+    for i in moving:
+        node = graph.nodes[ids[i]]
+        node.x = float(pos[i, 0])
+        node.y = float(pos[i, 1])
+        node.placed = True
+
+def _find_close_nodes(pos, moving, reach):
+    """
+    Returns the (index in moving, node index) pairs of the nodes closer than reach to each moving node,
+    the node itself excluded. The moving nodes are processed by chunks to keep the memory use bounded.
+    """
+    rows = []
+    cols = []
+    for start in xrange(0, len(moving), _refine_chunk_size):
+        chunk = moving[start:start + _refine_chunk_size]
+        dx = pos[chunk, 0][:, None] - pos[None, :, 0]
+        dy = pos[chunk, 1][:, None] - pos[None, :, 1]
+        close = dx * dx + dy * dy < reach * reach
+        close[np.arange(len(chunk)), chunk] = False
+        r, c = np.nonzero(close)
+        rows.append(r + start)
+        cols.append(c)
+    return np.concatenate(rows), np.concatenate(cols)
+
 def _fit_unplaced_nodes_circular(nodes):
     # This algorithm will place the nodes on concentric circles
     # Sort the nodes by size, desc
@@ -867,6 +1025,22 @@ graphTokenTable = Table('graphtokens',
                         db.Column('key', db.String(128), primary_key=True),
                         db.Column('value', db.String(1024)))
 
+# Node positions of a graph, stored as a single JSON dictionary instead of graph tokens
+# when GRAPH_STATE_COMPACT_POSITIONS is set
+graphPositionsTable = Table('graphpositions',
+                            db.metadata,
+                            db.Column('user_id', db.Integer, primary_key=True),
+                            db.Column('graph_id', db.String(128), primary_key=True),
+                            db.Column('positions', db.Text, nullable=False))
+
+# Layouts computed for a given graph topology, shared by all users
+graphLayoutTable = Table('graphlayouts',
+                         db.metadata,
+                         db.Column('hash', db.String(40), primary_key=True),
+                         db.Column('layout', db.String(64), nullable=False),
+                         db.Column('created', db.Integer, nullable=False),
+                         db.Column('positions', db.Text, nullable=False))
+
 _graph_name_parser_expression = re.compile(r'^(?P<type>[\w\.]+)(?:/(?P<path>[a-zA-Z0-9\-_ \.]+))?(?:\$(?P<layout>[\w _\-\.]+))?$')
                         
 def _parse_graph_name(full_graph_name):
@@ -904,6 +1078,31 @@ def loadstate(graphname, layout = None):
     """ Loads all the values stored for the specified graph 
         by the currently connected user.
     """
+    graph, db_state, missing_positions = _build_graph(graphname)
+    if graph.is_empty():
+        return graph
+
+    # Should we apply a layout ?
+    changes = False
+    if layout is not None:
+        _apply_layout_global(graph, layout)
+        changes = True
+    # If the layout is being reseted or it is used for the first time, just create the entire layout
+    elif len(db_state) == 0:
+        _apply_layout_global(graph, 'spring') # The default layout is spring !
+        changes = True
+    elif missing_positions:
+        _place_new_nodes(graph)
+        changes = True
+    if changes:
+        savestate(graphname, graph.generate_state_data(), True)
+    return graph
+
+def _build_graph(graphname):
+    """
+    Creates the specified graph, and projects the values stored by the currently connected user on it.
+    Returns the graph, the stored values and a boolean telling if some nodes have no stored position.
+    """
     uid = current_user.id
     db_state = get_result(graphname, uid)
     
@@ -921,48 +1120,145 @@ def loadstate(graphname, layout = None):
         raise GraphTypeError(graphname)
 
     if graph.is_empty():
-        return graph
+        return (graph, db_state, False)
     
     delete_states, missing_positions = graph.read_state_data(db_state)
     
     # Delete some values from the database if they weren't useful
     if len(delete_states) > 0:
-        # Delete the states we need to delete
-        for state in delete_states:
-            db.engine.execute(graphTokenTable.delete()\
-                 .where(graphTokenTable.c.key == state))
+        savestate(graphname, {state: None for state in delete_states})
         # Update the db contents
         db_state = get_result(graphname, uid)
-    
-    # Should we apply a layout ?
-    changes = False
-    if layout is not None:
-        _apply_layout_global(graph, layout)
-        changes = True
-    # If the layout is being reseted or it is used for the first time, just create the entire layout
-    elif len(db_state) == 0:
-        _apply_layout_global(graph, 'spring') # The default layout is spring !
-        changes = True
-    elif missing_positions:
-        _fit_unplaced_nodes(graph)
-        changes = True
-    if changes:
-        savestate(graphname, graph.generate_state_data(), True)
-    return graph
+    return (graph, db_state, missing_positions)
 
 def _apply_layout_global(graph, layout):
+    """
+    Lays out the whole graph with the specified layout.
+    Layouts are cached by topology, so that graphs identical to an already laid out one reuse its positions.
+    """
+    key = _layout_cache_key(graph, layout)
+    if _read_cached_layout(graph, key):
+        return
+    _compute_layout_global(graph, layout)
+    _store_cached_layout(graph, key, layout)
+
+def _compute_layout_global(graph, layout, stopped = None, progress = None, parallel = False):
+    """
+    Lays out the whole graph with the specified layout.
+
+    stopped may be a function telling if the computation should be stopped. Once it returns True,
+    the remaining steps are done with a quick placement instead of the requested layout.
+    progress may be a function receiving the completion ratio after each step.
+    If parallel is True, large graphs have their groups laid out in a pool of processes (only used by the
+    background layout jobs, see _apply_layout_groups).
+    Returns False if the computation has been stopped before the end.
+    """
     if len(graph.groups) == 0:
-        _apply_layout(graph, layout)
+        complete = _apply_layout_step(graph, layout, stopped)
     else:
-        for g in graph.groups.values():
-            _apply_layout(g, 'circular-tree')
+        complete = _apply_layout_groups(graph, 'circular-tree', stopped, progress, parallel)
         # After we laid out individual groups, create a fake graph with one node per group
         # so that we can position each group
         gr_graph = graph.extract_groups_graph()
-        _apply_layout(gr_graph, layout) # TODO : Use spring for laying out the groups ?
+        complete = _apply_layout_step(gr_graph, layout, stopped) and complete # TODO : Use spring for laying out the groups ?
         #gr_graph.scale(3, 3)
         for gr_node in gr_graph.nodes.values():
             graph.groups[gr_node.id].move_by(gr_node.x, gr_node.y)
+    return complete
+
+def _apply_layout_step(graph, layout, stopped):
+    """ Applies a layout, or a quick placement if the computation has been stopped (see _compute_layout_global) """
+    if stopped is not None and stopped():
+        _apply_quick_layout(graph)
+        return False
+    _apply_layout(graph, layout)
+    return True
+
+def _apply_layout_groups(graph, layout, stopped, progress, parallel = False):
+    """
+    Lays out each group of the graph independently.
+    If parallel is True, groups are laid out in a pool of processes, unless there is only one group or one CPU,
+    or the graph has less than GRAPH_LAYOUT_PARALLEL_MIN_NODES nodes (starting the pool would cost more than it saves).
+    """
+    groups = graph.groups.values()
+    steps = len(groups) + 1
+    if stopped is not None and stopped():
+        for g in groups:
+            _apply_quick_layout(g)
+        return False
+    processes = int(app.config.get('GRAPH_LAYOUT_PROCESSES', 0)) or multiprocessing.cpu_count()
+    min_nodes = int(app.config.get('GRAPH_LAYOUT_PARALLEL_MIN_NODES', 500))
+    if not parallel or len(groups) < 2 or processes < 2 or len(graph.nodes) < min_nodes:
+        complete = True
+        for i, g in enumerate(groups):
+            complete = _apply_layout_step(g, layout, stopped) and complete
+            if progress is not None:
+                progress(float(i + 1) / steps)
+        return complete
+
+    tasks = [(g.id, layout) + _serialize_graph(g) for g in groups]
+    laid_out = set()
+    processes = min(processes, len(groups))
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Send the groups by chunks, so that graphs made of many small groups do not cost one round-trip per group
+        chunksize = max(1, len(tasks) // (processes * 4))
+        for gid, positions in pool.imap_unordered(_layout_serialized_graph, tasks, chunksize):
+            g = graph.groups[gid]
+            for id, (x, y) in positions.iteritems():
+                node = g.nodes[id]
+                node.x = x
+                node.y = y
+                node.placed = True
+            laid_out.add(gid)
+            if progress is not None:
+                progress(float(len(laid_out)) / steps)
+            if stopped is not None and stopped():
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+
+    for g in groups:
+        if g.id not in laid_out:
+            _apply_quick_layout(g)
+    return len(laid_out) == len(groups)
+
+def _serialize_graph(graph):
+    """ Returns the node IDs, node radiuses and edges (see GraphBase.get_adjacency) of a graph, see _layout_serialized_graph """
+    ids, indptr, indices = graph.get_adjacency()
+    radiuses = array('d', (graph.nodes[id].radius for id in ids))
+    return (ids, radiuses, indptr, indices)
+
+def _layout_serialized_graph(task):
+    """
+    Process pool worker that lays out a graph serialized by _serialize_graph.
+    Returns the ID sent with the graph and the positions of its nodes by node ID.
+    """
+    gid, layout, ids, radiuses, indptr, indices = task
+    graph = GraphBase()
+    nodes = []
+    for id, radius in zip(ids, radiuses):
+        node = GraphNode(id, id, None, None)
+        node.radius = radius
+        graph.nodes[id] = node
+        nodes.append(node)
+    for source, node in enumerate(nodes):
+        for target in indices[indptr[source]:indptr[source + 1]]:
+            edge = GraphEdge(node, nodes[target], None)
+            node.link_out.append(edge)
+            nodes[target].link_in.append(edge)
+    _apply_layout(graph, layout)
+    return (gid, {n.id: (n.x, n.y) for n in nodes})
+
+def _apply_quick_layout(graph):
+    """ Places all the nodes of a graph on concentric circles, which is fast but ignores edges """
+    graph.clear_positions()
+    nodes = graph.nodes.values()
+    if nodes:
+        _fit_unplaced_nodes_circular(nodes)
+    graph.normalize()
+    graph.move_by(_base_node_spacing, _base_node_spacing)
 
 def _apply_layout(graph, layout):
         graph.clear_positions()
@@ -974,6 +1270,240 @@ def _apply_layout(graph, layout):
         graph.normalize()
         graph.move_by(_base_node_spacing, _base_node_spacing) # create some space between the nodes and the origin
 
+def _layout_cache_key(graph, layout):
+    """ Returns a string identifying the layout of a graph, made from its nodes, edges and groups """
+    nodes = []
+    edges = []
+    for id, n in graph.nodes.iteritems():
+        nodes.append((id, n.radius, None if n.group is None else n.group.id))
+        edges.extend((id, e.target.id) for e in n.link_out)
+    nodes.sort()
+    edges.sort()
+    return hashlib.sha1(repr((layout, nodes, edges))).hexdigest()
+
+def _read_cached_layout(graph, key):
+    """ Places the nodes of the graph according to a cached layout. Returns False if there is no such layout. """
+    q = select([graphLayoutTable.c.positions]).where(graphLayoutTable.c.hash == key)
+    row = db.engine.execute(q).first()
+    if row is None:
+        return False
+    positions = json.loads(row[0])
+    if len(positions) != len(graph.nodes):
+        return False
+    for id, n in graph.nodes.iteritems():
+        n.x, n.y = positions[id]
+        n.placed = True
+    app.logger.debug('Using cached layout ' + key)
+    return True
+
+def _store_cached_layout(graph, key, layout):
+    """ Stores the layout of a graph in the layouts cache, and drops the oldest layouts if the cache is full """
+    _store_cached_positions({id: (n.x, n.y) for id, n in graph.nodes.iteritems()}, key, layout)
+
+def _store_cached_positions(positions, key, layout):
+    """ Stores nodes positions in the layouts cache, see _store_cached_layout """
+    try:
+        db.engine.execute(graphLayoutTable.insert(), hash=key, layout=layout, created=int(time.time()), positions=json.dumps(positions))
+    except IntegrityError:
+        return # Another process computed the same layout at the same time
+
+    max_layouts = int(app.config.get('GRAPH_LAYOUT_CACHE_SIZE', 50))
+    q = select([graphLayoutTable.c.hash])\
+            .order_by(graphLayoutTable.c.created.desc())\
+            .offset(max_layouts)
+    old = [r[0] for r in db.engine.execute(q)]
+    if old:
+        db.engine.execute(graphLayoutTable.delete().where(graphLayoutTable.c.hash.in_(old)))
+
+def _start_layout_job(graph, graphname, layout):
+    """
+    Starts the computation of a layout for the specified graph in a background process.
+    Returns the ID of the job, that can be polled with _poll_layout_job.
+
+    Once started, the 'status' file of the job is only written by the job process. The changes
+    made by the web server are stored in a separate 'server' file (see _update_job_status).
+    """
+    _clean_layout_jobs()
+    job = uuid.uuid4().hex
+    budget = float(app.config.get('GRAPH_LAYOUT_TIME_BUDGET', 60))
+    status = {'state': 'running',
+              'progress': 0,
+              'user_id': current_user.id,
+              'graph': graphname,
+              'layout': layout,
+              'key': _layout_cache_key(graph, layout),
+              'deadline': time.time() + budget}
+    _write_job_file(job, 'status', status)
+
+    # Detach the job process with a double fork: it is adopted by init, which reaps it once over, so that
+    # the web server worker neither leaves zombie processes nor waits for the running jobs when it exits
+    pid = os.fork()
+    if pid == 0:
+        try:
+            if os.fork() == 0:
+                try:
+                    _run_layout_job(job, graph, layout, status)
+                finally:
+                    os._exit(0)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    return job
+
+def _run_layout_job(job, graph, layout, status):
+    """ Background process computing a layout, see _start_layout_job """
+    # This process is a fork of a web server worker, whose signal handlers would prevent it from being stopped.
+    # It runs in its own process group, so that it can be killed along with its layout processes (see _kill_job_process)
+    for sig in _layout_jobs_signals:
+        signal.signal(sig, signal.SIG_DFL)
+    os.setpgid(0, 0)
+    pid = os.getpid()
+    _write_job_file(job, 'pid', {'pid': pid, 'started': _process_start_time(pid)})
+
+    def report(**values):
+        if not _is_job_cancelled(job):
+            status.update(values)
+            _write_job_file(job, 'status', status)
+
+    try:
+        # Start with a quick layout, so that something can be shown if we run out of time
+        _compute_layout_global(graph, layout, lambda: True)
+        _write_job_file(job, 'result', graph.generate_state_data())
+
+        stopped = lambda: time.time() > status['deadline'] or _is_job_cancelled(job)
+        complete = _compute_layout_global(graph, layout, stopped, lambda p: report(progress=p), True)
+        _write_job_file(job, 'result', graph.generate_state_data())
+        report(state='done', progress=1, complete=complete)
+    except Exception as ex:
+        report(state='failed', error=str(ex))
+    finally:
+        _remove_job_file(job, 'pid')
+
+def _poll_layout_job(job):
+    """
+    Returns the status of a layout job started by the current user, or None if there is no such job.
+    Once the job is over, its layout is saved as the user's graph state.
+    """
+    status = _read_job_status(job)
+    if status is None or status['user_id'] != current_user.id:
+        return None
+
+    if _is_job_cancelled(job):
+        status['state'] = 'cancelled'
+    elif status['state'] == 'running' and time.time() > status['deadline'] + 5:
+        # The layout is taking longer than allowed: use the best layout computed so far
+        _kill_job_process(job)
+        status = _read_job_status(job)
+        if status['state'] == 'running': # The job did not finish in the meantime
+            status = _update_job_status(job, state='done', complete=False)
+
+    if status['state'] == 'done' and not status.get('saved'):
+        result = _read_job_file(job, 'result')
+        if result is not None:
+            savestate(status['graph'], result, True)
+            if status.get('complete'):
+                positions = {}
+                for key, value in result.iteritems():
+                    if key.endswith(':x'):
+                        positions[key[:-2]] = (value, result[key[:-2] + ':y'])
+                _store_cached_positions(positions, status['key'], status['layout'])
+        status = _update_job_status(job, saved=True)
+    return status
+
+def _cancel_layout_job(job):
+    """ Stops a layout job started by the current user. Returns False if there is no such job. """
+    status = _read_job_status(job)
+    if status is None or status['user_id'] != current_user.id:
+        return False
+    if status['state'] == 'running':
+        open(_job_file(job, 'cancel'), 'a').close()
+        _kill_job_process(job)
+    return True
+
+def _kill_job_process(job):
+    """ Kills the process of a job and its layout processes, if it is still running """
+    info = _read_job_file(job, 'pid')
+    if info is None:
+        return # Not started yet, or already over
+    pid = info['pid']
+    try:
+        # Make sure that the PID has not been reused by another process since the job ended
+        if os.getpgid(pid) != pid or _process_start_time(pid) != info['started']:
+            return
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass # Already over
+    _remove_job_file(job, 'pid')
+
+def _process_start_time(pid):
+    """ Returns the start time of a process in clock ticks since the boot, or None if it is unknown """
+    try:
+        with open('/proc/{0}/stat'.format(pid), 'r') as f:
+            # The process name may contain spaces: the start time is the 20th field after it
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (IOError, IndexError, ValueError):
+        return None
+
+def _is_job_cancelled(job):
+    return os.path.exists(_job_file(job, 'cancel'))
+
+def _job_file(job, kind):
+    return os.path.join(_layout_jobs_dir, '{0}.{1}'.format(job, kind))
+
+def _read_job_file(job, kind):
+    try:
+        with open(_job_file(job, kind), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def _write_job_file(job, kind, data):
+    """ Writes a job file atomically, so that other processes never read a partial file """
+    if not os.path.isdir(_layout_jobs_dir):
+        try:
+            os.makedirs(_layout_jobs_dir)
+        except OSError:
+            pass # Created by another process in the meantime
+    fd, tmppath = tempfile.mkstemp(prefix='.' + job, dir=_layout_jobs_dir)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmppath, _job_file(job, kind))
+
+def _remove_job_file(job, kind):
+    try:
+        os.remove(_job_file(job, kind))
+    except OSError:
+        pass
+
+def _read_job_status(job):
+    """ Returns the status written by the job process, updated with the changes made by the web server """
+    status = _read_job_file(job, 'status')
+    if status is not None:
+        status.update(_read_job_file(job, 'server') or {})
+    return status
+
+def _update_job_status(job, **values):
+    """ Changes the status of a job from the web server, without overwriting the status written by the job process """
+    if _read_job_file(job, 'status') is None or _is_job_cancelled(job):
+        return _read_job_status(job)
+    server = _read_job_file(job, 'server') or {}
+    server.update(values)
+    _write_job_file(job, 'server', server)
+    return _read_job_status(job)
+
+def _clean_layout_jobs():
+    """ Removes the files of the jobs older than one hour """
+    if not os.path.isdir(_layout_jobs_dir):
+        return
+    limit = time.time() - 3600
+    for f in os.listdir(_layout_jobs_dir):
+        path = os.path.join(_layout_jobs_dir, f)
+        try:
+            if os.path.getmtime(path) < limit:
+                os.remove(path)
+        except OSError:
+            pass
+
 def get_result(graphname, uid):
     """ Selects the hosts with their positions from the database. Returns
         the result as a dictionary.
@@ -984,17 +1514,33 @@ def get_result(graphname, uid):
                    .where(graphTokenTable.c.user_id == uid)\
                    .where(graphTokenTable.c.graph_id == graphname)
     rows = db.engine.execute(q)
-    return { r[graphTokenTable.c.key] : r[graphTokenTable.c.value] for r in rows }
+    result = { r[graphTokenTable.c.key] : r[graphTokenTable.c.value] for r in rows }
+    positions = _get_positions(db.engine, uid, graphname)
+    if positions is not None:
+        result.update(positions)
+    return result
+
+def _get_positions(conn, uid, graphname):
+    """ Returns the positions stored as a single entry for the specified graph, or None """
+    q = select([graphPositionsTable.c.positions])\
+                   .where(graphPositionsTable.c.user_id == uid)\
+                   .where(graphPositionsTable.c.graph_id == graphname)
+    row = conn.execute(q).first()
+    if row is None:
+        return None
+    return json.loads(row[0])
     
 def get_list_saves(graphtype):
     uid = current_user.id
-    q = select([graphTokenTable.c.graph_id])\
+    q = union(select([graphTokenTable.c.graph_id])\
                     .where(graphTokenTable.c.user_id == uid)\
-                    .where(graphTokenTable.c.graph_id.startswith(graphtype + '$'))\
-                    .distinct()
+                    .where(graphTokenTable.c.graph_id.startswith(graphtype + '$')),
+              select([graphPositionsTable.c.graph_id])\
+                    .where(graphPositionsTable.c.user_id == uid)\
+                    .where(graphPositionsTable.c.graph_id.startswith(graphtype + '$')))
     rows = db.engine.execute(q)
     substart = len(graphtype) + 1
-    return [r[graphTokenTable.c.graph_id][substart:] for r in rows]
+    return [r[0][substart:] for r in rows]
 
 def savestate(graphname, data, clear = False):
     """ Merges the specified data into the current
@@ -1002,6 +1548,9 @@ def savestate(graphname, data, clear = False):
 
         If clear is true, then all the existing values will be cleared
         before the new ones are saved.
+
+        Everything is saved in a single transaction. Node positions are stored
+        as a single entry if GRAPH_STATE_COMPACT_POSITIONS is set.
     """
     uid = current_user.id
 
@@ -1010,55 +1559,99 @@ def savestate(graphname, data, clear = False):
     #if graphname not in _layout_types:
     #    raise GraphTypeError(graphname)
 
-    if clear:
-        app.logger.info('Clearing ' + graphname)
-        db.engine.execute(graphTokenTable.delete()\
-                 .where(graphTokenTable.c.user_id == uid)\
-                 .where(graphTokenTable.c.graph_id == graphname))
-
     app.logger.debug('Saving data in graph "{0}": {1}'.format(graphname, data))
-                 
-    inserts = []
-    update = graphTokenTable.update()\
-                            .where(graphTokenTable.c.user_id == uid)\
-                            .where(graphTokenTable.c.graph_id == graphname)\
-                            .where(graphTokenTable.c.key == bindparam('tkey'))\
-                            .values(value=bindparam('value'))
-    delete = graphTokenTable.delete()\
-                            .where(graphTokenTable.c.user_id == uid)\
-                            .where(graphTokenTable.c.graph_id == graphname)\
-                            .where(graphTokenTable.c.key == bindparam('tkey'))
-
-    for key in data:
-        if data[key] is None:
-            # Remove the value
-            db.engine.execute(delete, tkey=key)
+
+    compact = app.config.get('GRAPH_STATE_COMPACT_POSITIONS', False)
+    tokens = {}
+    positions = {}
+    for key, value in data.iteritems():
+        if value is not None:
+            value = str(value)
+        if compact and (key.endswith(':x') or key.endswith(':y')):
+            positions[key] = value
         else:
-            # Try to update the value
-            c = db.engine.execute(update, tkey=key, value=str(data[key]))
-            if c.rowcount == 0:
-                # Insert
-                inserts = inserts + [{'user_id': uid,
-                                     'graph_id': graphname,
-                                     'key': key,
-                                     'value': str(data[key])}]
-
-    if inserts:
-        # Check that the current amount of rows + number of rows to insert does not reach the row count limitation
-        # We enforce this to prevent a user from making the DB blow up by injecting unlimited random keys
-        count_query = select([func.count(graphTokenTable.c.key)])\
-                    .where(graphTokenTable.c.user_id == uid)\
-                    .where(graphTokenTable.c.graph_id == graphname)
-        rows = db.engine.execute(count_query)
-        db_count = 0
-        for r in rows:
-            db_count = r[0]
-
-        max_capacity = app.config.get('GRAPH_STATE_MAX_TOKENS', 1000)
-        if db_count + len(inserts) > max_capacity:
-            app.logger.warning("Graph state capacity reached ! We cannot store any more data in the user's graph state. User {0}, graph {1}, trying to insert {2} new values over {3} existing. Maximum capacity is {4}".format(uid, graphname, len(inserts), db_count, max_capacity))
+            tokens[key] = value
+
+    with db.engine.begin() as conn:
+        if clear:
+            app.logger.info('Clearing ' + graphname)
+            conn.execute(graphTokenTable.delete()\
+                     .where(graphTokenTable.c.user_id == uid)\
+                     .where(graphTokenTable.c.graph_id == graphname))
+            conn.execute(graphPositionsTable.delete()\
+                     .where(graphPositionsTable.c.user_id == uid)\
+                     .where(graphPositionsTable.c.graph_id == graphname))
+
+        # Tokens and positions share the same capacity
+        q = select([graphTokenTable.c.key])\
+                .where(graphTokenTable.c.user_id == uid)\
+                .where(graphTokenTable.c.graph_id == graphname)
+        existing = set(r[0] for r in conn.execute(q))
+        stored = _get_positions(conn, uid, graphname) or {}
+        new_count = len([k for k, v in data.iteritems() if v is not None and k not in existing and k not in stored])
+        if new_count > 0 and not _check_capacity(uid, graphname, len(existing) + len(stored), new_count, compact):
+            # Only update the existing values
+            tokens = {k: v for k, v in tokens.iteritems() if v is None or k in existing or k in stored}
+            positions = {k: v for k, v in positions.iteritems() if v is None or k in existing or k in stored}
+
+        if positions:
+            _save_positions(conn, uid, graphname, positions, stored)
+            # Drop the positions previously saved as tokens
+            _delete_tokens(conn, uid, graphname, positions.keys())
+        # Drop the positions previously saved in a single entry, since get_result gives them precedence over the tokens
+        outdated = [k for k in tokens if k in stored]
+        if outdated:
+            _save_positions(conn, uid, graphname, dict.fromkeys(outdated), stored)
+        if tokens:
+            _save_tokens(conn, uid, graphname, tokens)
+
+def _check_capacity(uid, graphname, existing_count, new_count, compact = False):
+    """
+    Checks that the current amount of values + number of values to insert does not reach the values count limitation
+    We enforce this to prevent a user from making the DB blow up by injecting unlimited random keys
+    When the positions are stored as a single entry, the default limit is higher since they do not take one row each.
+    """
+    max_capacity = int(app.config.get('GRAPH_STATE_MAX_TOKENS', 10000 if compact else 1000))
+    if existing_count + new_count > max_capacity:
+        app.logger.warning("Graph state capacity reached ! We cannot store any more data in the user's graph state. User {0}, graph {1}, trying to insert {2} new values over {3} existing. Maximum capacity is {4}".format(uid, graphname, new_count, existing_count, max_capacity))
+        return False
+    return True
+
+def _save_tokens(conn, uid, graphname, tokens):
+    """ Saves graph tokens with a bulk upsert; tokens with a None value are removed (see savestate for the capacity check) """
+    _delete_tokens(conn, uid, graphname, [k for k, v in tokens.iteritems() if v is None])
+    values = {k: v for k, v in tokens.iteritems() if v is not None}
+    if not values:
+        return
+    rows = [{'user_id': uid, 'graph_id': graphname, 'key': k, 'value': v} for k, v in values.iteritems()]
+    conn.execute(graphTokenTable.insert().prefix_with('OR REPLACE'), rows)
+
+def _delete_tokens(conn, uid, graphname, keys):
+    keys = list(keys)
+    # Stay below the maximum number of SQLite query parameters
+    for i in xrange(0, len(keys), 500):
+        conn.execute(graphTokenTable.delete()\
+                 .where(graphTokenTable.c.user_id == uid)\
+                 .where(graphTokenTable.c.graph_id == graphname)\
+                 .where(graphTokenTable.c.key.in_(keys[i:i + 500])))
+
+def _save_positions(conn, uid, graphname, positions, stored):
+    """
+    Merges node positions into stored, the current positions entry of a graph, and saves it.
+    Positions with a None value are removed, as well as the entry once it is empty.
+    """
+    for key, value in positions.iteritems():
+        if value is None:
+            stored.pop(key, None)
         else:
-            db.engine.execute(graphTokenTable.insert(), inserts)
+            stored[key] = value
+    if not stored:
+        conn.execute(graphPositionsTable.delete()\
+                 .where(graphPositionsTable.c.user_id == uid)\
+                 .where(graphPositionsTable.c.graph_id == graphname))
+        return
+    conn.execute(graphPositionsTable.insert().prefix_with('OR REPLACE'),
+                 user_id=uid, graph_id=graphname, positions=json.dumps(stored, separators=(',', ':')))
 
 def get_generator(layout_name):
     """ Returns the generator's function, according to the layout type
@@ -1097,7 +1690,7 @@ def graph_saves(graphtype):
 @login_required
 def load_graph(graphname):
     try:
-        return jsondump(loadstate(graphname).generate_full_data())
+        return jsonstream(loadstate(graphname).generate_full_data(True))
     except GraphTypeError:
         abort(404)
     except DependencyError:
@@ -1107,7 +1700,9 @@ def load_graph(graphname):
 @login_required
 def reset_graph():
     """ 
-    Resets the specified graph positions, and re-runs an entire layout for it using the specified layout algorithm
+    Resets the specified graph positions, and re-runs an entire layout for it using the specified layout algorithm.
+    Unless the layout is already known, it is computed in the background: the returned job
+    must then be polled with /reset_graph/<job> until its state is not 'running' anymore.
     """
     layout_type = request.args.get('layout')
     graph_name = request.args.get('graph')
@@ -1115,12 +1710,30 @@ def reset_graph():
         return abort(403)
 
     try:
-        return jsondump(loadstate(graph_name, layout_type).generate_state_data())
+        graph = _build_graph(graph_name)[0]
+        if graph.is_empty() or _read_cached_layout(graph, _layout_cache_key(graph, layout_type)):
+            savestate(graph_name, graph.generate_state_data(), True)
+            return jsondump({'state': 'done', 'progress': 1})
+        return jsondump({'state': 'running', 'progress': 0, 'job': _start_layout_job(graph, graph_name, layout_type)})
     except GraphTypeError:
         abort(404)
     except DependencyError:
         abort(501)
 
+@app.route('/reset_graph/<job>', methods=['GET', 'DELETE'])
+@login_required
+def reset_graph_job(job):
+    """ Returns the state and progress of a layout job started by /reset_graph, or cancels it """
+    if request.method == 'DELETE':
+        if not _cancel_layout_job(job):
+            abort(404)
+        return jsondump({'state': 'cancelled'})
+
+    status = _poll_layout_job(job)
+    if status is None:
+        abort(404)
+    return jsondump({'state': status['state'], 'progress': status['progress'], 'job': job})
+
 @app.route('/graph')
 @login_required
 def graph_view():
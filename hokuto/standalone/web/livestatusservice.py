@@ -28,6 +28,7 @@ from flask import render_template,request,jsonify,abort
 from flask.ext.login import login_required, current_user
 
 from . import app, utils
+from ajax import jsonstream, StreamedObject, StreamedArray
 
 def _get_hosts(group = None):
     """ Get available hosts for current user"""
@@ -76,11 +77,13 @@ def get_hosts():
         query = query.filter('{0} = {1}'.format(key, value))
     data = query.call()
 
-    data = [d for d in data if d['name'] in permissions['hosts']]
-    for d in data:
-        d['services'] = [s for s in d['services'] if s in permissions['services']]
+    def results():
+        for d in data:
+            if d['name'] in permissions['hosts']:
+                d['services'] = [s for s in d['services'] if s in permissions['services']]
+                yield d
 
-    return jsonify({'results': data})
+    return jsonstream(StreamedObject([('results', StreamedArray(results()))]))
 
 @app.route('/services/livestatus/get/hostgroups')
 @login_required
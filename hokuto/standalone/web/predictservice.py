@@ -27,13 +27,20 @@ from on_reader.predict import PredictReader
 
 from . import app, utils
 
+# The reader keeps its connections and a cache of the decoded results,
+# so it is shared by all the requests
+_reader = None
+
 def _getreader():
-    """ Returns an instance of the prediction data reader """
+    """ Returns the instance of the prediction data reader """
+    global _reader
     db_path = app.config.get('NANTO_DATABASE', None)
     if db_path is None:
         app.logger.debug('No prediction db info')
         return None
-    return PredictReader(db_path)
+    if _reader is None or _reader.dbpath != db_path:
+        _reader = PredictReader(db_path)
+    return _reader
 
 @app.route('/services/predict/forecast')
 @login_required
@@ -45,16 +52,21 @@ def get_forecast():
     probes= json.loads(request.args.get('probes'))
     if len(probes) == 0:
         return jsonify({})
-    results= {}
     reader = _getreader()
-    if reader is None or reader.forecast_available() is None:
+    if reader is None:
+        app.logger.debug('Forecast data not available')
+        return jsonify({})
+    targets = dict((probe, '.'.join(probe.split(getattr(app.config,'GRAPHITE_SEP','[SEP]')))) for probe in probes)
+    try:
+        forecasts = reader.forecast_many(targets.values())
+    except Exception as ex:
+        app.logger.warning('An error occured while trying to read forecast results !')
+        app.logger.warning(ex)
+        return jsonify({})
+    if forecasts is None:
         app.logger.debug('Forecast data not available')
         return jsonify({})
-    for probe in probes:
-        try:
-            results[probe] = reader.forecast('.'.join(probe.split(getattr(app.config,'GRAPHITE_SEP','[SEP]'))))
-        except Exception as ex:
-            app.logger.warning('An error occured while trying to read forecast results for probe {0} !'.format(probe))
-            app.logger.warning(ex)
-            # Just skip this probe
+    results = {}
+    for probe, target in targets.iteritems():
+        results[probe] = forecasts.get(target)
     return jsonify(results)
@@ -179,8 +179,12 @@ define(['jquery', 'graph.structure', 'graph.renderer', 'graph.infopanel', 'graph
                 url: '/reset_graph',
                 data: {'graph': Grapher._currentType, 'layout': layout},
                 success: function (data){
-                    // Load and save the graph
-                    Grapher.loadAndShowGraph(Grapher._currentType);
+                    if (data.state == 'running')
+                        // The layout is computed in the background
+                        Grapher._waitLayoutJob(data.job, Grapher._currentType);
+                    else
+                        // Load and save the graph
+                        Grapher.loadAndShowGraph(Grapher._currentType);
                 },
                 error: function (jqXhr, textStatus, errorThrown) {
                     Grapher.showGlobalMessage('An error occured while we were generating the graph :(');
@@ -189,6 +193,34 @@ define(['jquery', 'graph.structure', 'graph.renderer', 'graph.infopanel', 'graph
             });
         },
 
+        // Polls a layout job started by resetGraph until it is over,
+        // then displays the new layout
+        _waitLayoutJob: function (job, graphName) {
+            jQuery.ajax({
+                dataType: 'json',
+                url: '/reset_graph/' + job,
+                success: function (data){
+                    if (graphName != Grapher._currentType) {
+                        // The user went to another graph in the meantime
+                        jQuery.ajax('/reset_graph/' + job, {'type': 'DELETE'});
+                    }
+                    else if (data.state == 'running') {
+                        setTimeout(function () { Grapher._waitLayoutJob(job, graphName); }, 1000);
+                    }
+                    else if (data.state == 'done') {
+                        Grapher.loadAndShowGraph(graphName);
+                    }
+                    else {
+                        Grapher.showGlobalMessage('An error occured while we were generating the graph :(');
+                    }
+                },
+                error: function (jqXhr, textStatus, errorThrown) {
+                    Grapher.showGlobalMessage('An error occured while we were generating the graph :(');
+                    Console.warn('XHR error calling /reset_graph/' + job + ': ' + textStatus + '(' + errorThrown + ')');
+                }
+            });
+        },
+
         showGlobalMessage: function (text) {
             if (Grapher._renderer) {
                 Grapher._renderer.hide();
@@ -18,15 +18,34 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from flask import abort, request
 from flask.ext.login import login_required
 
-from on_reader.livestatus import get_all_hosts
+from on_reader.livestatus import get_all_hosts, get_table_columns, COLUMN_NAME, HOST_COLUMNS, DYNAMIC_ATTRIBUTES
 
 from . import app
-from ajax import jsondump
+from ajax import jsonstream, StreamedObject
 
 @app.route('/services/structure/hosts')
 @login_required
 def hostsservice():
-    return jsondump(get_all_hosts(), True)
+    """
+    Returns all the hosts by name.
+    The columns argument may contain a comma separated list of the host columns to return, by default all columns are returned.
+    Unknown columns are rejected with a 400 error.
+    """
+    columns = request.args.get('columns')
+    if columns:
+        columns = [c.strip() for c in columns.split(',')]
+        if not all(COLUMN_NAME.match(c) for c in columns) or not set(columns) <= _known_host_columns():
+            abort(400)
+    else:
+        columns = None
+    return jsonstream(StreamedObject(get_all_hosts(columns).iteritems()))
 
+def _known_host_columns():
+    """ Returns the names of the columns of the livestatus hosts table """
+    known = set(DYNAMIC_ATTRIBUTES['hosts'])
+    for columns in HOST_COLUMNS.itervalues():
+        known.update(columns)
+    return known | get_table_columns('hosts')
@@ -23,6 +23,7 @@
 """
 from collections import OrderedDict
 from . import mk_livestatus
+import re
 import time
 
 FILTER_KEYS = {
@@ -72,6 +73,23 @@ DYNAMIC_ATTRIBUTES = {
 }
 
 
+# Named sets of columns for get_all_hosts and get_all_services,
+# for callers that only use a few of the hosts and services columns
+HOST_COLUMNS = {
+    # Graph builders
+    "graph": ("name", "groups", "parents"),
+    # Components known to livestatus
+    "components": ("name", "services"),
+}
+
+SERVICE_COLUMNS = {
+    # Graph builders
+    "graph": ("description", "host_name", "host_groups", "parent_dependencies"),
+}
+
+# Valid livestatus column names, that cannot alter the query they are sent in
+COLUMN_NAME = re.compile(r'^\w+$')
+
 # All livestatus supported keys/attributes
 SUPPORTED = FILTER_KEYS.keys()
 
@@ -467,11 +485,50 @@ def get_status_logs(target, time_from=None, time_to=None, class_=None):
             res.extend(log.filter("class = %s"%cls).call())
         return res
 
-def get_all_hosts():
-    return {h['name']: h for h in livestatus.hosts._query.call()}
-
-def get_all_services():
-    flat_list = livestatus.services._query.call()
+def _get_columns(registry, columns, required):
+    """ Returns the list of columns to request, from a name of the registry or a list of columns """
+    if columns is None:
+        return None
+    if isinstance(columns, basestring):
+        columns = registry[columns]
+    for c in columns:
+        if not COLUMN_NAME.match(c):
+            raise ValueError("Invalid column name: %r"%c)
+    return list(required) + [c for c in columns if c not in required]
+
+_table_columns = {}
+
+def get_table_columns(table):
+    """ Returns the set of the names of the columns of a livestatus table (cached) """
+    if table not in _table_columns:
+        query = livestatus.columns._query.columns("name").filter("table = " + table)
+        _table_columns[table] = set(c['name'] for c in query.call())
+    return _table_columns[table]
+
+def get_all_hosts(columns=None):
+    """ Returns all the hosts by name.
+
+        By default all the columns are fetched. columns may be a list of the columns to fetch,
+        or the name of a column set defined in HOST_COLUMNS. The name column is always included.
+    """
+    query = livestatus.hosts._query
+    columns = _get_columns(HOST_COLUMNS, columns, ("name",))
+    if columns is not None:
+        query = query.columns(*columns)
+    return {h['name']: h for h in query.call()}
+
+def get_all_services(columns=None):
+    """ Returns all the services by description, then by host name.
+
+        By default all the columns are fetched. columns may be a list of the columns to fetch,
+        or the name of a column set defined in SERVICE_COLUMNS. The description and host_name
+        columns are always included.
+    """
+    query = livestatus.services._query
+    columns = _get_columns(SERVICE_COLUMNS, columns, ("description", "host_name"))
+    if columns is not None:
+        query = query.columns(*columns)
+    flat_list = query.call()
     result = {}
     for s in flat_list:
         sname = s['description']
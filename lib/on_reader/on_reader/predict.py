@@ -20,36 +20,145 @@
 
 import sqlite3
 import logging
+import os.path
+import sys
+import threading
+import urllib
+from array import array
+from collections import OrderedDict
+
+# Maximum number of probes looked up by a single query (SQLite limits the number of bound parameters)
+QUERY_CHUNK_SIZE = 500
+
+# Maximum number of decoded results kept in the cache of each table; the least recently used ones are dropped
+CACHE_SIZE = 10000
+
+def _unpack_values(value):
+    """
+    Decodes a list of numbers stored in the results database. Values are stored as
+    blobs of little endian float64, or as ';'-joined strings by older workers.
+    """
+    if isinstance(value, basestring):
+        return [float(i) for i in value.split(';')]
+    result = array('d')
+    result.fromstring(str(value))
+    if sys.byteorder != 'little':
+        result.byteswap()
+    return result.tolist()
 
 class PredictReader(object):
-    """ This class provides tools used to read the results generated by the prediction algorithms """
+    """
+    This class provides tools used to read the results generated by the prediction algorithms
+
+    Each thread using a reader gets its own read-only connection to the database, that is kept open
+    for the lifetime of the reader. Decoded results are cached, and are only read again from the
+    database once the prediction worker updated them (see the update_time column of each table).
+    The cache keeps one entry per probe, and at most CACHE_SIZE entries per table.
+    """
     
     def __init__(self, dbpath):
         """ Initializes a new data provider, using the specified file as a data source """
         self.dbpath = dbpath
+        self.__local = threading.local()
+        self.__tables = set() # Tables known to exist
+        self.__cache = {} # table name => OrderedDict { probe: (update_time, result) }, least recently used first
+        self.__cache_lock = threading.Lock()
         
     def __opendb(self):
-        result = sqlite3.connect(self.dbpath)
+        """ Returns the read-only connection of the current thread, opening it if needed """
+        con = getattr(self.__local, 'con', None)
+        if con is None:
+            try:
+                uri = 'file:{0}?mode=ro'.format(urllib.pathname2url(os.path.abspath(self.dbpath)))
+                con = sqlite3.connect(uri, timeout=10, uri=True)
+            except TypeError:
+                # This version of the sqlite3 module does not support URIs; at least make sure
+                # this connection never writes anything
+                con = sqlite3.connect(self.dbpath, timeout=10)
+                con.execute('PRAGMA query_only=1')
+            con.row_factory = sqlite3.Row
+            self.__local.con = con
+        return con
+
+    def __openrwdb(self):
+        """ Opens a new connection that can write into the database """
+        result = sqlite3.connect(self.dbpath, timeout=10)
         result.row_factory = sqlite3.Row
         return result
         
     def __checktable(self, con, tablename):
+        if tablename in self.__tables:
+            return True
         cur = con.cursor()
         cur.execute("SELECT name from sqlite_master WHERE type='table' AND name=?", (tablename,))
-        return cur.fetchone() is not None
+        if cur.fetchone() is None:
+            # Not cached: the table will be created as soon as the worker runs
+            return False
+        self.__tables.add(tablename)
+        return True
+
+    def __select(self, con, query, targets):
+        """
+        Runs a query that contains a 'probe IN ({0})' condition for each of the targets,
+        and yields the resulting rows. Targets are sent by chunks of QUERY_CHUNK_SIZE.
+        """
+        targets = list(targets)
+        cur = con.cursor()
+        for i in xrange(0, len(targets), QUERY_CHUNK_SIZE):
+            chunk = targets[i:i + QUERY_CHUNK_SIZE]
+            cur.execute(query.format(','.join('?' * len(chunk))), chunk)
+            for row in cur:
+                yield row
+
+    def __read(self, table, columns, targets, decode):
+        """
+        Reads the results stored in a table for several targets, and returns them as a dict
+        associating each target to the value returned by decode(row). Targets that were never
+        processed by the prediction engine are missing from the dict.
+
+        The decoded results are cached until the update_time of their row changes; in this case
+        only the update times of the targets are read from the database.
+        """
+        con = self.__opendb()
+        if not self.__checktable(con, table):
+            return None
+
+        results = {}
+        stale = []
+        rows = self.__select(con, 'SELECT probe, update_time FROM ' + table + ' WHERE probe IN ({0})', set(targets))
+        with self.__cache_lock:
+            cache = self.__cache.setdefault(table, OrderedDict())
+            for row in rows:
+                cached = cache.pop(row['probe'], None)
+                if cached is not None and cached[0] == row['update_time']:
+                    cache[row['probe']] = cached # Most recently used
+                    results[row['probe']] = cached[1]
+                else:
+                    stale.append(row['probe'])
+
+        query = 'SELECT probe, update_time, ' + ', '.join(columns) + ' FROM ' + table + ' WHERE probe IN ({0})'
+        decoded = [(row['probe'], row['update_time'], decode(row)) for row in self.__select(con, query, stale)]
+        with self.__cache_lock:
+            for probe, update_time, result in decoded:
+                cache.pop(probe, None)
+                cache[probe] = (update_time, result)
+                results[probe] = result
+            while len(cache) > CACHE_SIZE:
+                cache.popitem(last=False)
+        return results
         
     def __checkavailability(self, module):
         try:
-            with self.__opendb() as con:
-                if not self.__checktable(con, 'onoc_pred_versions'):
-                    return None
-                cur = con.cursor()
-                cur.execute('SELECT version FROM onoc_pred_versions WHERE worker_name=?', (module,))
-                row = cur.fetchone()
-                if row is None:
-                    return None
-                else:
-                    return row[0]
+            con = self.__opendb()
+            if not self.__checktable(con, 'onoc_pred_versions'):
+                return None
+            cur = con.cursor()
+            cur.execute('SELECT version FROM onoc_pred_versions WHERE worker_name=?', (module,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            else:
+                return row[0]
         except sqlite3.OperationalError as ex:
             logging.error('An error occured while opening the prediction database. This usually means that the database file exists, but cannot be accessed by this process.')
             logging.error('Database file path is "{0}"'.format(self.dbpath))
@@ -72,41 +181,49 @@ class PredictReader(object):
         
         Note that in some cases the existing data is not good enough to make any prediction; in that case, the values will be an empty dict.
         """
-        with self.__opendb() as con:
-            if not self.__checktable(con, 'timewindow'):
-                return None
-            
-            cur = con.cursor()
-            cur.execute('SELECT update_time, start_time, step, mean, lower_80, lower_95, upper_80, upper_95 FROM timewindow WHERE probe=?', (target,))
-            row = cur.fetchone()
-            if row is None:
-                return None
+        results = self.forecast_many([target])
+        if results is None:
+            return None
+        return results.get(target)
 
-            results = {
-                'date': int(row['update_time']),
-                'values': {},
-            }
-                
-            if row['mean'] is None:
-                return results
-                
-            mean = [float(i) for i in row['mean'].split(';')]
-            lower_80 = [float(i) for i in row['lower_80'].split(';')]
-            lower_95 = [float(i) for i in row['lower_95'].split(';')]
-            upper_80 = [float(i) for i in row['upper_80'].split(';')]
-            upper_95 = [float(i) for i in row['upper_95'].split(';')]
+    def forecast_many(self, targets):
+        """
+        Returns the predicted evolution of several values over the next few hours, using as few queries as possible.
+
+        The result is a dict associating each target to the value that would be returned by forecast(target).
+        Targets that were never checked by the prediction engine are missing from the dict.
+        If no forecast was ever computed, this function returns None.
+        """
+        return self.__read('timewindow', ('start_time', 'step', 'mean', 'lower_80', 'lower_95', 'upper_80', 'upper_95'),
+                           targets, self.__decode_forecast)
+
+    @staticmethod
+    def __decode_forecast(row):
+        results = {
+            'date': int(row['update_time']),
+            'values': {},
+        }
             
-            t = int(row['start_time'])
-            step = int(row['step'])
-            for i in xrange(len(mean)):
-                results['values'][t] = (
-                    lower_80[i],
-                    lower_95[i],
-                    mean[i],
-                    upper_95[i],
-                    upper_80[i])
-                t += step
+        if row['mean'] is None:
             return results
+            
+        mean = _unpack_values(row['mean'])
+        lower_80 = _unpack_values(row['lower_80'])
+        lower_95 = _unpack_values(row['lower_95'])
+        upper_80 = _unpack_values(row['upper_80'])
+        upper_95 = _unpack_values(row['upper_95'])
+        
+        t = int(row['start_time'])
+        step = int(row['step'])
+        for i in xrange(len(mean)):
+            results['values'][t] = (
+                lower_80[i],
+                lower_95[i],
+                mean[i],
+                upper_95[i],
+                upper_80[i])
+            t += step
+        return results
     
     def forecast_available(self):
         return self.__checkavailability('timewindow')
@@ -130,41 +247,38 @@ class PredictReader(object):
         
         The returned dict also contains the 'lower_95' and 'upper_95' values which contains the upper and lower bounds of the 95% confidence band
         """
-        with self.__opendb() as con:
-            if not self.__checktable(con, 'ecdf'):
-                return None
-            
-            cur = con.cursor()
-            cur.execute('SELECT update_time, intervals, probabilities, lower_95, upper_95 FROM ecdf WHERE probe=?', (target,))
-            row = cur.fetchone()
-            if row is None:
-                return None
-            
-            result = {
-                'date': int(row['update_time']),
-                'values': [],
-                'lower_95': 0.0,
-                'upper_95': 0.0,
-            }
+        results = self.__read('ecdf', ('intervals', 'probabilities', 'lower_95', 'upper_95'), [target], self.__decode_ranges)
+        if results is None:
+            return None
+        return results.get(target)
+
+    @staticmethod
+    def __decode_ranges(row):
+        result = {
+            'date': int(row['update_time']),
+            'values': [],
+            'lower_95': 0.0,
+            'upper_95': 0.0,
+        }
+        
+        if row['intervals'] is None:
+            return result
             
-            if row['intervals'] is None:
-                return result
-                
-            intervals = [float(i) for i in row['intervals'].split(';')]
-            probabilities = [float(i) for i in row['probabilities'].split(';')]
-            result['lower_95'] = float(row['lower_95'])
-            result['upper_95'] = float(row['upper_95'])
+        intervals = _unpack_values(row['intervals'])
+        probabilities = _unpack_values(row['probabilities'])
+        result['lower_95'] = float(row['lower_95'])
+        result['upper_95'] = float(row['upper_95'])
+        
+        val = 0
+        for i in xrange(len(intervals)):
+            result['values'].append({
+                'from': val,
+                'to': intervals[i],
+                'estimate': probabilities[i],
+            })
+            val = intervals[i]
             
-            val = 0
-            for i in xrange(len(intervals)):
-                result['values'].append({
-                    'from': val,
-                    'to': intervals[i],
-                    'estimate': probabilities[i],
-                })
-                val = intervals[i]
-                
-            return result
+        return result
             
     def ranges_available(self):
         return self.__checkavailability('ecdf')
@@ -177,31 +291,28 @@ class PredictReader(object):
         Some values may be missing, because they could not be commputed, for example because of a lack of relevant historic data)
         In these cases the returned values are None.
         """
-        with self.__opendb() as con:
-            if not self.__checktable(con, 'markov'):
-                return None
-            
-            cur = con.cursor()
-            cur.execute('SELECT update_time, step, time_from_ok, time_from_warning, time_from_critical FROM markov WHERE probe=?', (target,))
-            row = cur.fetchone()
-            if row is None:
-                return None
-            
-            result = {
-                'date': int(row['update_time']),
-                'time_from_ok': int(row['time_from_ok']) * row['step'],
-                'time_from_warning': int(row['time_from_warning']) * row['step'],
-                'time_from_critical': int(row['time_from_critical']) * row['step'],
-            }
-            
-            if result['time_from_ok'] < 0:
-                result['time_from_ok'] = None
-            if result['time_from_warning'] < 0:
-                result['time_from_warning'] = None
-            if result['time_from_critical'] < 0:
-                result['time_from_critical'] = None
+        results = self.__read('markov', ('step', 'time_from_ok', 'time_from_warning', 'time_from_critical'), [target], self.__decode_changes_to_error)
+        if results is None:
+            return None
+        return results.get(target)
 
-            return result
+    @staticmethod
+    def __decode_changes_to_error(row):
+        result = {
+            'date': int(row['update_time']),
+            'time_from_ok': int(row['time_from_ok']) * row['step'],
+            'time_from_warning': int(row['time_from_warning']) * row['step'],
+            'time_from_critical': int(row['time_from_critical']) * row['step'],
+        }
+        
+        if result['time_from_ok'] < 0:
+            result['time_from_ok'] = None
+        if result['time_from_warning'] < 0:
+            result['time_from_warning'] = None
+        if result['time_from_critical'] < 0:
+            result['time_from_critical'] = None
+
+        return result
             
     def changes_to_error_available(self):
         return self.__checkavailability('markov')
@@ -217,30 +328,37 @@ class PredictReader(object):
         a 'checked' key (containing a boolean telling whether the value was previously checked), and a 'values' key containing
         an array of timestamp at which changes were detected. If no changes were detected at all the array is empty.
         """
-        with self.__opendb() as con:
-            if not self.__checktable(con, 'changepoint'):
-                return None
-                
-            cur = con.cursor()
-            cur.execute('SELECT update_time, points, checked FROM changepoint WHERE probe=?', (target,))
-            row = cur.fetchone()
-            if row is None:
-                return None
-            
-            result = {
-                'date': int(row['update_time']),
-                'checked': int(row['checked']) == 1,
-                'values': []
-            }
+        # Not cached, as the checked flag may change without the results being updated
+        con = self.__opendb()
+        if not self.__checktable(con, 'changepoint'):
+            return None
             
-            points = row['points']
-            if points is not None and len(points) > 0:
-                result['values'] = [int(i) for i in row['points'].split(';')]
+        cur = con.cursor()
+        cur.execute('SELECT update_time, points, checked FROM changepoint WHERE probe=?', (target,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        
+        result = {
+            'date': int(row['update_time']),
+            'checked': int(row['checked']) == 1,
+            'values': []
+        }
+        
+        points = row['points']
+        if points is not None and len(points) > 0:
+            result['values'] = [int(i) for i in row['points'].split(';')]
+        
+        if check and not result['checked']:
+            # The shared connection is read-only
+            rwcon = self.__openrwdb()
+            try:
+                with rwcon:
+                    rwcon.execute('UPDATE changepoint SET checked=1 WHERE probe=?', (target,))
+            finally:
+                rwcon.close()
             
-            if check and not result['checked']:
-                cur.execute('UPDATE changepoint SET checked=1 WHERE probe=?', (target,))
-                
-            return result
+        return result
             
     def changepoints_available(self):
         return self.__checkavailability('changepoint')
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# This file is part of Omega Noc
+# Copyright Omega Noc (C) 2014 Omega Cube and contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the throughput of the timewindow predictions.
+
+The benchmark generates synthetic Whisper files in a temporary Graphite storage directory,
+runs the timewindow pipeline on them against a temporary results database and prints the time
+spent in each step (fetch, resample, forecast, write) as JSON.
+
+Usage: timewindow_benchmark.py [--seasonal N] [--trending N] [--noisy N] [--backend R|numpy] [--output results.json]
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import whisper
+
+def generate_series(kind, start, step, count, rand):
+    """ Returns the (timestamp, value) points of a synthetic series of the specified kind """
+    base = rand.uniform(10, 100)
+    amplitude = rand.uniform(0.1, 0.5) * base
+    slope = rand.uniform(-0.5, 2) * base / (count * step) if kind == 'trending' else 0
+    noise = 0.05 * base if kind != 'noisy' else 0.5 * base
+    points = []
+    value = base
+    for i in xrange(count):
+        t = start + i * step
+        if kind == 'noisy':
+            # Random walk, without any seasonality
+            value += rand.gauss(0, noise)
+            points.append((t, value))
+        else:
+            daily = amplitude * math.sin(2 * math.pi * (t % 86400) / 86400.0)
+            points.append((t, base + daily + slope * i * step + rand.gauss(0, noise)))
+    return points
+
+def create_whisper_files(storage_dir, counts, step, days, seed):
+    """ Creates the synthetic metrics, and returns their names """
+    rand = random.Random(seed)
+    count = days * 86400 / step
+    now = int(time.time())
+    start = now - (count - 1) * step
+    metrics = []
+    for kind, number in sorted(counts.iteritems()):
+        directory = os.path.join(storage_dir, 'whisper', 'bench', kind)
+        os.makedirs(directory)
+        for i in xrange(number):
+            path = os.path.join(directory, 'metric{0}.wsp'.format(i))
+            whisper.create(path, [(step, count)])
+            whisper.update_many(path, generate_series(kind, start, step, count, rand))
+            metrics.append('bench.{0}.metric{1}'.format(kind, i))
+    return metrics
+
+class StageTimer(object):
+    """ Accumulates the time spent in each step of the pipeline """
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, stage, func, *args):
+        t0 = time.time()
+        result = func(*args)
+        durations = self.stages.setdefault(stage, [])
+        durations.append(time.time() - t0)
+        return result
+
+    def report(self, metrics_count):
+        result = {}
+        for stage, durations in self.stages.iteritems():
+            total = sum(durations)
+            result[stage] = {
+                'total': total,
+                'calls': len(durations),
+                'per_metric': total / max(metrics_count, 1),
+            }
+        return result
+
+def run_benchmark(worker, metrics, timer):
+    """ Runs the timewindow steps on all the metrics, one batch at a time """
+    def write(batch, predictions):
+        with worker.get_database() as con:
+            worker.store(con, batch, predictions)
+
+    processed = 0
+    for i in xrange(0, len(metrics), worker.batch_size):
+        batch = []
+        for target in metrics[i:i + worker.batch_size]:
+            (end, step, values) = timer.time('fetch', worker.fetch, target)
+            normalized_values = timer.time('resample', worker.resample, values, step)
+            if len(normalized_values) >= 300:
+                batch.append((target, (end, normalized_values)))
+        predictions = timer.time('forecast', worker.forecast, [data[1] for target, data in batch])
+        timer.time('write', write, batch, predictions)
+        processed += sum(1 for p in predictions if p is not None)
+    return processed
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the throughput of the timewindow predictions')
+    parser.add_argument('--seasonal', type=int, default=20, help='Number of series with a daily seasonality')
+    parser.add_argument('--trending', type=int, default=20, help='Number of seasonal series with a trend')
+    parser.add_argument('--noisy', type=int, default=10, help='Number of random walk series')
+    parser.add_argument('--step', type=int, default=300, help='Interval between two points of the series, in seconds')
+    parser.add_argument('--days', type=int, default=31, help='Length of the series, in days')
+    parser.add_argument('--backend', default='R', help='Forecast backend (see nanto.cfg)')
+    parser.add_argument('--batch-size', type=int, default=None, help='Number of metrics forecasted at once')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random series generator')
+    parser.add_argument('--output', default=None, help='File to write the results to (defaults to the standard output)')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary files')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='nanto_bench')
+    try:
+        # Graphite reads its storage path when it is imported
+        os.environ['GRAPHITE_STORAGE_DIR'] = tmpdir
+        os.makedirs(os.path.join(tmpdir, 'whisper'))
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src'))
+        from graphitequery import settings
+        settings.setup_storage_variables(tmpdir)
+        from timewindow_worker import TimewindowWorker
+
+        counts = {'seasonal': args.seasonal, 'trending': args.trending, 'noisy': args.noisy}
+        t0 = time.time()
+        metrics = create_whisper_files(tmpdir, counts, args.step, args.days, args.seed)
+        generation_time = time.time() - t0
+
+        worker = TimewindowWorker()
+        worker.initialize(None, os.path.join(tmpdir, 'nanto.db'), None, args.backend)
+        if args.batch_size is not None:
+            worker.batch_size = args.batch_size
+
+        timer = StageTimer()
+        t0 = time.time()
+        processed = run_benchmark(worker, metrics, timer)
+        total_time = time.time() - t0
+
+        results = {
+            'config': {
+                'series': counts,
+                'step': args.step,
+                'days': args.days,
+                'backend': args.backend,
+                'batch_size': worker.batch_size,
+                'seed': args.seed,
+            },
+            'metrics': len(metrics),
+            'processed': processed,
+            'generation_time': generation_time,
+            'total_time': total_time,
+            'metrics_per_second': len(metrics) / total_time if total_time > 0 else None,
+            'stages': timer.report(len(metrics)),
+        }
+    finally:
+        if args.keep:
+            sys.stderr.write('Temporary files kept in {0}\n'.format(tmpdir))
+        else:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output is None:
+        print output
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
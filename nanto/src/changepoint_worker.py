@@ -0,0 +1,92 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# This file is part of Omega Noc
+# Copyright Omega Noc (C) 2014 Omega Cube and contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import time
+
+import numpy as np
+
+from prediction_worker import PredictionWorker
+from series_core import to_matrix, fill_gaps, changepoints
+
+
+class ChangepointWorker(PredictionWorker):
+    """
+    This worker detects the points in time at which the mean value of each metric changed
+    during the last month (see PredictReader.changepoints)
+    """
+    def __init__(self):
+        # The worker runs every 6 hours
+        super(ChangepointWorker, self).__init__(21600, 'changepoint', 1)
+        self.history_hours = 30 * 24
+        self.batch_size = 200 # Amount of metrics processed at once
+
+    def internal_run(self):
+        t0 = time.time()
+        count = 0
+        for batch in self.queued_graphite_batches('changepoint', self.history_hours, self.batch_size, t0 + self.compute_interval):
+            with self.stage('compute'):
+                matrix = fill_gaps(to_matrix([data[3] for metric, data in batch]))
+                results = []
+                for i, (metric, (start, end, step, values)) in enumerate(batch):
+                    # Series are aligned on their last value; skip the padding and the leading missing values
+                    row = matrix[i, matrix.shape[1] - len(values):]
+                    first = np.argmax(~np.isnan(row)) if len(row) > 0 else 0
+                    if len(row) == 0 or np.isnan(row[first]):
+                        results.append(None)
+                        continue
+                    results.append(';'.join(str(int(start + (first + k) * step)) for k in changepoints(row[first:])))
+
+            with self.stage('write'):
+                with self.get_database() as con:
+                    # Keep the checked flag of the results that did not change
+                    previous = {}
+                    for metric, data in batch:
+                        row = con.execute('SELECT points, checked FROM changepoint WHERE probe=?', (metric,)).fetchone()
+                        if row is not None:
+                            previous[metric] = row
+                    now = time.time()
+                    for (metric, data), points in zip(batch, results):
+                        if points is None:
+                            self.count('no_data')
+                            con.execute('INSERT OR REPLACE INTO changepoint (probe, update_time, error_desc, points, checked) VALUES (?, ?, ?, ?, ?)',
+                                        (metric, now, 'There is no data for this metric', None, 0))
+                            continue
+                        checked = 0
+                        if metric in previous and previous[metric][0] == points:
+                            checked = previous[metric][1]
+                        con.execute('INSERT OR REPLACE INTO changepoint (probe, update_time, error_desc, points, checked) VALUES (?, ?, ?, ?, ?)',
+                                    (metric, now, None, points, checked))
+            for metric, data in batch:
+                self.metric_done(metric)
+            count += len(batch)
+        ttl = time.time() - t0
+        logging.debug('[nanto:changepoint] Entire changepoint ({0} entries) in {1}s ({2}s / entry)'.format(count, ttl, ttl / max(count, 1)))
+
+    def updatedb(self, currentversion, connection):
+        if currentversion < 1:
+            logging.debug('[nanto:changepoint] Creating changepoint table')
+            # points contains the ';'-joined timestamps of the changes
+            connection.execute('CREATE TABLE IF NOT EXISTS changepoint (\
+                                                         probe VARCHAR(512) NOT NULL PRIMARY KEY,\
+                                                         update_time INT NOT NULL,\
+                                                         error_desc TEXT,\
+                                                         points TEXT,\
+                                                         checked INT NOT NULL DEFAULT 0)')
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# This file is part of Omega Noc
+# Copyright Omega Noc (C) 2014 Omega Cube and contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import time
+
+from prediction_worker import PredictionWorker
+from series_core import to_matrix, ecdf_ranges
+
+
+class EcdfWorker(PredictionWorker):
+    """
+    This worker estimates the distribution of the values of each metric over the last week,
+    as the probability of having values in a few ranges (see PredictReader.ranges)
+    """
+    def __init__(self):
+        # The worker runs every 6 hours
+        super(EcdfWorker, self).__init__(21600, 'ecdf', 1)
+        self.history_hours = 7 * 24
+        self.intervals_count = 10
+        self.batch_size = 200 # Amount of metrics processed at once
+
+    def internal_run(self):
+        t0 = time.time()
+        count = 0
+        for batch in self.queued_graphite_batches('ecdf', self.history_hours, self.batch_size, t0 + self.compute_interval):
+            with self.stage('compute'):
+                matrix = to_matrix([data[3] for metric, data in batch])
+                upper_bounds, probabilities, lower_95, upper_95, counts = ecdf_ranges(matrix, self.intervals_count)
+
+            with self.stage('write'):
+                with self.get_database() as con:
+                    now = time.time()
+                    for i, (metric, data) in enumerate(batch):
+                        if counts[i] == 0:
+                            self.count('no_data')
+                            con.execute('INSERT OR REPLACE INTO ecdf (probe, update_time, error_desc, intervals, probabilities, lower_95, upper_95) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        (metric, now, 'There is no data for this metric', None, None, None, None))
+                        else:
+                            con.execute('INSERT OR REPLACE INTO ecdf (probe, update_time, error_desc, intervals, probabilities, lower_95, upper_95) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        (metric, now, None, self.pack_values(upper_bounds[i]), self.pack_values(probabilities[i]), float(lower_95[i]), float(upper_95[i])))
+            for metric, data in batch:
+                self.metric_done(metric)
+            count += len(batch)
+        ttl = time.time() - t0
+        logging.debug('[nanto:ecdf] Entire ecdf ({0} entries) in {1}s ({2}s / entry)'.format(count, ttl, ttl / max(count, 1)))
+
+    def updatedb(self, currentversion, connection):
+        if currentversion < 1:
+            logging.debug('[nanto:ecdf] Creating ecdf table')
+            # intervals and probabilities are packed float64 blobs (see PredictionWorker.pack_values)
+            connection.execute('CREATE TABLE IF NOT EXISTS ecdf (\
+                                                         probe VARCHAR(512) NOT NULL PRIMARY KEY,\
+                                                         update_time INT NOT NULL,\
+                                                         error_desc TEXT,\
+                                                         intervals BLOB,\
+                                                         probabilities BLOB,\
+                                                         lower_95 REAL,\
+                                                         upper_95 REAL)')
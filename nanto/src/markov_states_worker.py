@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# This file is part of Omega Noc
+# Copyright Omega Noc (C) 2014 Omega Cube and contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import time
+
+import numpy as np
+
+from prediction_worker import PredictionWorker
+from series_core import states_to_los, transition_matrices, mean_first_passage
+
+# Services states are OK (0), WARNING (1), CRITICAL (2) and UNKNOWN (3).
+# UNKNOWN is the error state: it means that the component could not be checked.
+STATES_COUNT = 4
+ERROR_STATE = 3
+
+# Hosts states are UP (0), DOWN (1) and UNREACHABLE (2); they are converted to services states
+HOST_STATES = {0: 0, 1: 2, 2: 3}
+
+
+class MarkovStatesWorker(PredictionWorker):
+    """
+    This worker models the hard states of each component with a Markov chain, and estimates
+    how long it takes to reach the error state from the other ones (see PredictReader.changes_to_error)
+    """
+    def __init__(self):
+        # The worker runs once a day
+        super(MarkovStatesWorker, self).__init__(86400, 'markov', 1)
+        self.history_seconds = 30 * 86400
+        self.step = 60 # The states are sampled every minute
+        self.batch_size = 100 # Amount of components processed at once
+
+    def internal_run(self):
+        t0 = time.time()
+        start = t0 - self.history_seconds
+        end = t0 # Same end for every component, so that all the LOS of a batch have the same length
+
+        # A single query returns the state changes of every component
+        with self.stage('fetch'):
+            components = PredictionWorker.get_livestatus_components()
+            events = {}
+            for e in PredictionWorker.get_livestatus_hard_states(start):
+                service = e['service_description'] or None
+                state = e['state'] if service is not None else HOST_STATES.get(e['state'], ERROR_STATE)
+                events.setdefault((e['host_name'], service), []).append({'time': e['time'], 'state': state})
+
+        for i in xrange(0, len(components), self.batch_size):
+            if self.should_cancel():
+                logging.info('[nanto:markov] Cancelling')
+                return
+            batch = components[i:i + self.batch_size]
+            with self.stage('compute'):
+                los = np.array([MarkovStatesWorker.__create_los_from_events(sorted(events.get(c, []), key=lambda e: e['time']), start, self.step, end) for c in batch])
+                times = mean_first_passage(transition_matrices(los, STATES_COUNT), ERROR_STATE)
+                times = np.where(np.isnan(times), -1, np.round(times)).astype(int)
+
+            with self.stage('write'):
+                with self.get_database() as con:
+                    now = time.time()
+                    for (host, service), row in zip(batch, times):
+                        probe = host if service is None else host + '.' + service
+                        con.execute('INSERT OR REPLACE INTO markov (probe, update_time, step, time_from_ok, time_from_warning, time_from_critical) VALUES (?, ?, ?, ?, ?, ?)',
+                                    (probe, now, self.step, int(row[0]), int(row[1]), int(row[2])))
+            self.count('processed', len(batch))
+        ttl = time.time() - t0
+        logging.debug('[nanto:markov] Entire markov ({0} entries) in {1}s ({2}s / entry)'.format(len(components), ttl, ttl / max(len(components), 1)))
+
+    @staticmethod
+    def __create_los_from_events(events, start, step = 60, end = None):
+        """
+        Converts a list of state changes (dicts containing the time and state of each change, sorted by time)
+        into the list of the states (LOS) of the component at each step from start to end (now by default).
+        """
+        if end is None:
+            end = time.time()
+        return states_to_los([e['time'] for e in events], [e['state'] for e in events], start, end, step).tolist()
+
+    def updatedb(self, currentversion, connection):
+        if currentversion < 1:
+            logging.debug('[nanto:markov] Creating markov table')
+            # The times are expressed in steps, or -1 if the error state cannot be reached
+            connection.execute('CREATE TABLE IF NOT EXISTS markov (\
+                                                         probe VARCHAR(512) NOT NULL PRIMARY KEY,\
+                                                         update_time INT NOT NULL,\
+                                                         step INT NOT NULL,\
+                                                         time_from_ok INT NOT NULL,\
+                                                         time_from_warning INT NOT NULL,\
+                                                         time_from_critical INT NOT NULL)')
@@ -0,0 +1,187 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# This file is part of Omega Noc
+# Copyright Omega Noc (C) 2014 Omega Cube and contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Forecasting backend implemented with NumPy.
+
+It follows the steps of timewindow.r without requiring R: anomalies are removed from the
+last points of the time window, the series is decomposed with STL, and the seasonally adjusted
+series is forecasted with exponential smoothing (just like the stlf function of the R forecast package).
+"""
+
+import logging
+
+import numpy as np
+
+from prediction_worker import ForecastBackend
+
+# Standard normal quantiles of the supported confidence levels
+_QUANTILES = {80: 1.2815515655446004, 95: 1.959963984540054}
+
+class NumpyForecastBackend(ForecastBackend):
+    """ Forecasts time series with an STL decomposition and exponential smoothing """
+
+    def __init__(self, period = 24, check_in = 6, epsilon = 1e-5):
+        """
+        period is the seasonality of the series in points (24 for one day of hourly points)
+        check_in is the number of recent points that are checked for anomalies, and epsilon
+        the density under which a point is considered as an anomaly
+        """
+        self.period = period
+        self.check_in = check_in
+        self.epsilon = epsilon
+
+    def forecast(self, data, window, horizon):
+        data = np.asarray(data, dtype=float)
+        if np.isnan(data[-window:]).all():
+            logging.debug('[nanto] No values to forecast')
+            return None
+        values = self.__remove_anomalies(data, data[-window:].copy())
+        if len(values) < 2 * self.period:
+            logging.debug('[nanto] Not enough values to find the seasonality ({0} points)'.format(len(values)))
+            return None
+
+        seasonal, trend = stl(values, self.period, _nextodd(self.period))
+        adjusted = values - seasonal
+        mean, stddev = ets_forecast(adjusted, horizon)
+
+        # Seasonal naive forecast of the seasonal component
+        seasonal_forecast = seasonal[len(seasonal) - self.period + np.arange(horizon) % self.period]
+        mean = mean + seasonal_forecast
+
+        lower = {}
+        upper = {}
+        for level in (80, 95):
+            lower[level] = (mean - _QUANTILES[level] * stddev).tolist()
+            upper[level] = (mean + _QUANTILES[level] * stddev).tolist()
+        return (mean.tolist(), lower[80], lower[95], upper[80], upper[95])
+
+    def __remove_anomalies(self, data, values):
+        """ Replaces missing and abnormal values among the last check_in points by interpolated values """
+        mean = np.nanmean(data)
+        sd = np.nanstd(data, ddof=1)
+        recent = values[-self.check_in:]
+        if sd > 0:
+            density = np.exp(-0.5 * ((recent - mean) / sd) ** 2) / (sd * np.sqrt(2 * np.pi))
+            with np.errstate(invalid='ignore'): # Missing values are not anomalies
+                anomalies = density < self.epsilon
+            if anomalies.any():
+                logging.debug('[nanto] Found {0} anomalies'.format(anomalies.sum()))
+                recent[anomalies] = np.nan
+        missing = np.isnan(values)
+        if missing.any() and not missing.all():
+            positions = np.arange(len(values))
+            values[missing] = np.interp(positions[missing], positions[~missing], values[~missing])
+        return values
+
+def _nextodd(value):
+    value = int(round(value))
+    return value + 1 if value % 2 == 0 else value
+
+def _loess(y, positions, span, degree):
+    """
+    Locally weighted regression of y (sampled at 0..len(y)-1) evaluated at the specified positions,
+    with a tricube kernel over the span nearest points (as in the STL paper)
+    """
+    n = len(y)
+    x = np.arange(n, dtype=float)
+    distances = np.abs(np.asarray(positions, dtype=float)[:, None] - x[None, :])
+    q = min(span, n)
+    h = np.sort(distances, axis=1)[:, q - 1]
+    if span > n:
+        h += (span - n) // 2
+    h = np.maximum(h, 1e-10)
+    weights = np.clip(1 - (distances / h[:, None]) ** 3, 0, None) ** 3
+    wsum = weights.sum(axis=1)
+    if degree == 0:
+        return weights.dot(y) / wsum
+    # Local linear fit
+    xmean = weights.dot(x) / wsum
+    dx = x[None, :] - xmean[:, None]
+    slope_den = (weights * dx ** 2).sum(axis=1)
+    slope = np.where(slope_den > 1e-10, (weights * dx).dot(y) / np.maximum(slope_den, 1e-10), 0)
+    return weights.dot(y) / wsum + slope * (np.asarray(positions, dtype=float) - xmean)
+
+def _moving_average(values, length):
+    cumsum = np.cumsum(np.concatenate(([0.0], values)))
+    return (cumsum[length:] - cumsum[:-length]) / length
+
+def stl(values, period, seasonal_window, iterations = 2):
+    """
+    Seasonal-trend decomposition with loess (inner loop of STL, without robustness weights).
+    Returns the (seasonal, trend) components; the remainder is values - seasonal - trend.
+    """
+    n = len(values)
+    trend_window = _nextodd(np.ceil(1.5 * period / (1 - 1.5 / seasonal_window)))
+    lowpass_window = _nextodd(period)
+    trend = np.zeros(n)
+    seasonal = np.zeros(n)
+    for _ in xrange(iterations):
+        detrended = values - trend
+        # Smooth each cycle-subseries, extended by one point at both ends
+        cycle = np.zeros(n + 2 * period)
+        for k in xrange(period):
+            sub = detrended[k::period]
+            smoothed = _loess(sub, np.arange(-1, len(sub) + 1), seasonal_window, 0)
+            cycle[k::period][:len(smoothed)] = smoothed
+        # Remove the low frequencies from the cycle
+        lowpass = _moving_average(_moving_average(_moving_average(cycle, period), period), 3)
+        lowpass = _loess(lowpass, np.arange(n), lowpass_window, 1)
+        seasonal = cycle[period:period + n] - lowpass
+        trend = _loess(values - seasonal, np.arange(n), trend_window, 1)
+    return seasonal, trend
+
+def ets_forecast(values, horizon):
+    """
+    Forecasts a non seasonal series with the best exponential smoothing model (simple, additive
+    trend or damped additive trend) according to the AIC.
+    Returns the forecasted values and their standard deviations, as arrays.
+    """
+    n = len(values)
+    grid = np.linspace(0.01, 0.99, 25)
+    candidates = [] # (alpha, beta, phi, parameters count)
+    candidates.extend((a, 0.0, 0.0, 2) for a in grid)
+    candidates.extend((a, b, 1.0, 4) for a in grid for b in grid[::3] if b <= a)
+    candidates.extend((a, b, p, 5) for a in grid for b in grid[::3] if b <= a for p in (0.8, 0.9, 0.95, 0.98))
+    alpha, beta, phi, params = [np.array(c) for c in zip(*candidates)]
+
+    # Run every model at once, in error correction form
+    level = np.full(len(alpha), values[0])
+    slope = np.where(phi > 0, values[1] - values[0], 0.0)
+    sse = np.zeros(len(alpha))
+    for t in xrange(1, n):
+        predicted = level + phi * slope
+        error = values[t] - predicted
+        sse += error ** 2
+        level = predicted + alpha * error
+        slope = phi * slope + beta * error
+
+    aic = (n - 1) * np.log(np.maximum(sse, 1e-300) / (n - 1)) + 2 * params
+    best = np.argmin(aic)
+    alpha, beta, phi = alpha[best], beta[best], phi[best]
+    sigma2 = sse[best] / max(n - 1 - params[best], 1)
+
+    steps = np.arange(1, horizon + 1)
+    damping = np.cumsum(phi ** steps) # phi + phi^2 + ... + phi^h
+    mean = level[best] + damping * slope[best]
+    # Variance of the h-steps ahead forecast: sigma2 * (1 + sum_{j<h} (alpha + beta * phi_j)^2)
+    c = (alpha + beta * damping[:-1]) ** 2
+    variance = sigma2 * (1 + np.concatenate(([0.0], np.cumsum(c))))
+    return mean, np.sqrt(variance)
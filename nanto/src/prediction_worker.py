@@ -20,19 +20,37 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import abc
+import importlib
 import logging
 import os
 import Queue as queue # dammit python 2!
 import sqlite3
+import sys
 import time
 import traceback
 
+from array import array
 from multiprocessing import Process, Value, Queue
 
 from graphitequery import storage, query
 
 from on_reader.livestatus import livestatus, get_all_hosts
 
+from scheduler import MetricScheduler
+from stats import WorkerStats
+
+# Delay before retrying a metric that failed for the first time, in seconds.
+# It doubles after each consecutive failure, up to QUEUE_MAX_RETRY_DELAY.
+QUEUE_RETRY_DELAY = 600
+QUEUE_MAX_RETRY_DELAY = 86400
+
+# Number of metrics marked as running at once by queued_metrics. The acknowledgments of the
+# processed metrics (see metric_done and metric_failed) are written along with them.
+QUEUE_CHUNK_SIZE = 20
+
+# Number of processes used by R to forecast a batch of series (see RForecastBackend.forecast_many)
+R_BATCH_PROCESSES = 1
+
 class PredictionValueTypeException(Exception):
     """ Thrown when we cannot convert a value from R to python """
     def __init__(self, type):
@@ -59,22 +77,40 @@ class PredictionWorker(Process):
         self.data_version = data_version
         self.run_exception = None # This member will be filled with any unmanaged exception that is cought in the run method
         self.last_execution_time = Value('d', 0.0)
+        self.stats = WorkerStats() # Statistics of the current run, see stage() and count()
         
         # Shared
         self.messages = Queue()
         
         # Worker process state
         self.__cancel_requested = False
+        self.__queue_con = None # Connection used by the work queue during a run, see queued_metrics
+        self.__acks = [] # (probe, error message or None, time) of the metrics processed since the last queue update
         
-    def initialize(self, previous_worker, db_path):
+    def initialize(self, previous_worker, db_path, priorities = None, forecast_backend = 'R', carbon_server = None):
         """
         Called by the module just before it's ready to use this instance.
         The previous_worker parameter may contain the worker instance that was 
         executed just before that one. It can be used to pass values between
         consecutive runs.
+        The priorities parameter contains the metric name patterns that should be processed first
+        (see MetricScheduler).
+        The forecast_backend parameter contains the name of the ForecastBackend used by forecasting workers
+        (see FORECAST_BACKENDS).
+        The carbon_server parameter contains the "host:port" address of the carbon daemon the statistics of
+        the runs should be sent to, if any.
         """
         self.database_file = db_path
-        pass
+        self.carbon_server = carbon_server
+        self.scheduler = MetricScheduler(priorities)
+        self.forecast_backend_name = forecast_backend
+        self.__forecast_backend = None
+
+    def get_forecast_backend(self):
+        """ Returns the ForecastBackend instance selected in the configuration """
+        if self.__forecast_backend is None:
+            self.__forecast_backend = create_forecast_backend(self.forecast_backend_name)
+        return self.__forecast_backend
 
     def start(self):
         return super(PredictionWorker, self).start()
@@ -231,6 +267,7 @@ class PredictionWorker(Process):
         pass
 
     def run(self):
+        self.stats = WorkerStats()
         try:
             self.internal_run()
         except Exception as ex:
@@ -238,6 +275,13 @@ class PredictionWorker(Process):
             logging.debug('[nanto] Exception: {0}'.format(ex))
             logging.debug('[nanto] Stack: {0}'.format(traceback.format_exc()))
             self.run_exception = ex
+            self.count('crashes')
+        try:
+            self.__close_queue()
+        except Exception as ex:
+            logging.warning('[nanto:{0}] Could not update the work queue: {1}'.format(self.data_name, ex))
+        self.stats.stop()
+        self.__save_stats()
         self.last_execution_time.value = time.time()
         logging.debug('[nanto] Leaving worker run at ' + str(self.last_execution_time.value))
 
@@ -249,6 +293,32 @@ class PredictionWorker(Process):
         """
         return os.path.join(os.path.dirname(os.path.realpath(__file__)), file_name)
 
+    # INSTRUMENTATION TOOLS for use by child classes
+
+    def stage(self, name):
+        """
+        Returns a context manager that measures the time spent in a stage of the computations, for example:
+            with self.stage('fetch'):
+                ...
+        """
+        return self.stats.stage(name)
+
+    def count(self, name, value = 1):
+        """ Increments one of the counters of the current run """
+        self.stats.count(name, value)
+
+    def __save_stats(self):
+        """ Stores the statistics of the run in the database, and sends them to carbon if configured """
+        values = self.stats.values()
+        logging.debug('[nanto:{0}] Run statistics: {1}'.format(self.data_name, ', '.join('{0}={1}'.format(k, v) for k, v in sorted(values.iteritems()))))
+        try:
+            with self.get_database() as con:
+                self.stats.save(con, self.data_name)
+        except Exception as ex:
+            logging.warning('[nanto:{0}] Could not save the run statistics: {1}'.format(self.data_name, ex))
+        if self.carbon_server:
+            self.stats.send(self.carbon_server, 'nanto.' + self.data_name)
+
     # DATABASE TOOLS for use by child classes
 
     def get_database(self):
@@ -259,6 +329,9 @@ class PredictionWorker(Process):
             logging.error('Could not open database for a prediction module ({0}): {1}'.format(self.database_file, ex))
             raise
 
+        # Let the web server read the results while they are being written
+        result.execute('PRAGMA journal_mode=WAL')
+
         # Check if the versions table exists
         cur = result.cursor()
         cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='onoc_pred_versions'")
@@ -267,6 +340,17 @@ class PredictionWorker(Process):
             # Create the versions table
             result.execute('CREATE TABLE onoc_pred_versions (worker_name VARCHAR(255) NOT NULL PRIMARY KEY, version INT NOT NULL)')
 
+        # Work queue of the runs (see queued_metrics)
+        result.execute('CREATE TABLE IF NOT EXISTS onoc_pred_queue (\
+                            worker_name VARCHAR(255) NOT NULL,\
+                            probe VARCHAR(512) NOT NULL,\
+                            position INT NOT NULL,\
+                            status VARCHAR(16) NOT NULL,\
+                            attempts INT NOT NULL DEFAULT 0,\
+                            next_try REAL NOT NULL DEFAULT 0,\
+                            error_desc TEXT,\
+                            PRIMARY KEY (worker_name, probe))')
+
         # Check if the worker data structure is up to date
         cur.execute('SELECT version FROM onoc_pred_versions WHERE worker_name=?', (self.data_name,))
         row = cur.fetchone()
@@ -296,6 +380,162 @@ class PredictionWorker(Process):
         """
         raise Exception("Not implemented")
 
+    @staticmethod
+    def pack_values(values):
+        """
+        Converts a list of numbers into a blob that can be stored in the results database.
+        Values are stored as little endian float64 (see on_reader.predict for the reading side).
+        """
+        result = array('d', values)
+        if sys.byteorder != 'little':
+            result.byteswap()
+        return sqlite3.Binary(result.tostring())
+
+    def schedule_metrics(self, table, metrics = None):
+        """
+        Returns the Graphite metrics that should be processed by this worker, in processing order.
+        table is the name of the results table of the worker; it must contain probe and update_time columns.
+        metrics may contain the result of get_graphite_metrics_mtimes(), if it is already known.
+        """
+        if metrics is None:
+            metrics = PredictionWorker.get_graphite_metrics_mtimes()
+        last_updates = dict(self.__queue_database().execute('SELECT probe, update_time FROM ' + table))
+        scheduled = self.scheduler.schedule(metrics, last_updates)
+        self.count('skipped', len(metrics) - len(scheduled))
+        return scheduled
+
+    def queued_metrics(self, table, deadline = None):
+        """
+        Yields the Graphite metrics that should be processed by this worker, using a work queue stored
+        in the database so that an interrupted pass can be resumed by the next run.
+
+        When the queue is empty a new pass is planned with schedule_metrics(table). Otherwise the
+        metrics left over by a cancelled, crashed or timed out run are processed first.
+        Each yielded metric must be acknowledged with metric_done() or metric_failed(); a metric that
+        was never acknowledged (for example because it crashed the worker process) is considered as failed.
+        Failed metrics are retried by later passes, after a delay that doubles with each failure.
+
+        The queue is updated by chunks of QUEUE_CHUNK_SIZE metrics on a single connection, which is closed
+        at the end of the run. If the worker process crashes, the whole chunk being processed is retried later.
+
+        The iteration stops when the host asks for cancellation, or once the deadline timestamp is reached.
+        """
+        now = time.time()
+        con = self.__queue_database()
+        with con:
+            # Metrics that were being processed when the previous run stopped
+            for probe, attempts in con.execute("SELECT probe, attempts FROM onoc_pred_queue WHERE worker_name=? AND status='running'", (self.data_name,)).fetchall():
+                logging.warning('[nanto:{0}] Processing of {1} was interrupted, it will be retried later'.format(self.data_name, probe))
+                self.__set_failed(con, probe, attempts, 'Interrupted', now)
+
+            pending = con.execute("SELECT COUNT(*) FROM onoc_pred_queue WHERE worker_name=? AND status='pending'", (self.data_name,)).fetchone()[0]
+            if pending > 0:
+                logging.info('[nanto:{0}] Resuming the previous pass ({1} metrics left)'.format(self.data_name, pending))
+            else:
+                metrics_mtimes = PredictionWorker.get_graphite_metrics_mtimes()
+                metrics = self.schedule_metrics(table, metrics_mtimes)
+                con.execute("DELETE FROM onoc_pred_queue WHERE worker_name=? AND status='done'", (self.data_name,))
+                # Forget the metrics that do not exist anymore, instead of retrying them forever
+                queued = [r[0] for r in con.execute('SELECT probe FROM onoc_pred_queue WHERE worker_name=?', (self.data_name,))]
+                con.executemany('DELETE FROM onoc_pred_queue WHERE worker_name=? AND probe=?',
+                                ((self.data_name, p) for p in queued if p not in metrics_mtimes))
+                con.executemany("INSERT OR IGNORE INTO onoc_pred_queue (worker_name, probe, position, status) VALUES (?, ?, ?, 'pending')",
+                                ((self.data_name, m, i) for i, m in enumerate(metrics)))
+                # Failed metrics take part in this pass only if their retry delay expired. The ones that
+                # were not scheduled (no new data since they failed) are retried at the end of the pass
+                con.executemany("UPDATE onoc_pred_queue SET position=?, status='pending' WHERE worker_name=? AND probe=? AND status='failed' AND next_try<=?",
+                                ((i, self.data_name, m, now) for i, m in enumerate(metrics)))
+                con.execute("UPDATE onoc_pred_queue SET position=?, status='pending' WHERE worker_name=? AND status='failed' AND next_try<=?",
+                            (len(metrics), self.data_name, now))
+            queue = [r[0] for r in con.execute("SELECT probe FROM onoc_pred_queue WHERE worker_name=? AND status='pending' ORDER BY position", (self.data_name,))]
+
+        chunk_end = 0
+        for i, probe in enumerate(queue):
+            stop = None
+            if self.should_cancel():
+                stop = 'Cancelling'
+            elif deadline is not None and time.time() > deadline:
+                stop = 'Run time exceeded, the next run will resume the pass'
+            if stop is not None:
+                logging.info('[nanto:{0}] {1}'.format(self.data_name, stop))
+                # The rest of the chunk was not processed: it stays in the pass
+                with con:
+                    con.executemany("UPDATE onoc_pred_queue SET status='pending', attempts=attempts-1 WHERE worker_name=? AND probe=? AND status='running'",
+                                    ((self.data_name, p) for p in queue[i:chunk_end]))
+                return
+            if i >= chunk_end:
+                chunk_end = i + QUEUE_CHUNK_SIZE
+                with con:
+                    self.__write_acks(con)
+                    con.executemany("UPDATE onoc_pred_queue SET status='running', attempts=attempts+1 WHERE worker_name=? AND probe=?",
+                                    ((self.data_name, p) for p in queue[i:chunk_end]))
+            yield probe
+
+    def queued_graphite_batches(self, table, from_hours, batch_size, deadline = None):
+        """
+        Groups the metrics yielded by queued_metrics(table, deadline) into batches of batch_size metrics,
+        and yields them as lists of (metric, (start, end, step, values)) tuples containing the last
+        from_hours hours of data of each metric (values may contain None values).
+        Metrics whose data could not be read are marked as failed and left out of the batches.
+        """
+        batch = []
+        for metric in self.queued_metrics(table, deadline):
+            try:
+                with self.stage('fetch'):
+                    batch.append((metric, PredictionWorker.get_graphite_data(metric, from_hours, False, True)))
+            except Exception as ex:
+                logging.warning('[nanto:{0}] Could not read the data of {1}: {2}'.format(self.data_name, metric, ex))
+                self.metric_failed(metric, str(ex))
+                continue
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def metric_done(self, probe):
+        """ Marks a metric yielded by queued_metrics as successfully processed """
+        self.count('processed')
+        self.__acks.append((probe, None, time.time()))
+
+    def metric_failed(self, probe, message):
+        """ Marks a metric yielded by queued_metrics as failed, so that it gets retried later """
+        self.count('failed')
+        self.__acks.append((probe, message, time.time()))
+
+    def __queue_database(self):
+        """ Returns the connection used by the work queue during the current run """
+        if self.__queue_con is None:
+            self.__queue_con = self.get_database()
+        return self.__queue_con
+
+    def __close_queue(self):
+        """ Writes the pending acknowledgments and closes the work queue connection, at the end of a run """
+        if self.__queue_con is None:
+            return
+        try:
+            with self.__queue_con as con:
+                self.__write_acks(con)
+        finally:
+            self.__queue_con.close()
+            self.__queue_con = None
+
+    def __write_acks(self, con):
+        """ Stores the acknowledgments received by metric_done and metric_failed """
+        acks = self.__acks
+        self.__acks = []
+        con.executemany("UPDATE onoc_pred_queue SET status='done', attempts=0, error_desc=NULL WHERE worker_name=? AND probe=?",
+                        ((self.data_name, probe) for probe, message, t in acks if message is None))
+        for probe, message, t in acks:
+            if message is not None:
+                row = con.execute('SELECT attempts FROM onoc_pred_queue WHERE worker_name=? AND probe=?', (self.data_name, probe)).fetchone()
+                self.__set_failed(con, probe, row[0] if row is not None else 1, message, t)
+
+    def __set_failed(self, con, probe, attempts, message, now):
+        delay = min(QUEUE_RETRY_DELAY * 2 ** max(attempts - 1, 0), QUEUE_MAX_RETRY_DELAY)
+        con.execute("UPDATE onoc_pred_queue SET status='failed', next_try=?, error_desc=? WHERE worker_name=? AND probe=?",
+                    (now + delay, message, self.data_name, probe))
+
     # GRAPHITE TOOLS for use by child classes
     @staticmethod
     def get_graphite_metrics():
@@ -305,13 +545,32 @@ class PredictionWorker(Process):
         return result
 
     @staticmethod
-    def __parseMetrics(query, store, results):
+    def get_graphite_metrics_mtimes():
+        """
+        Returns a dict associating the metrics available in Graphite to the last modification time of their
+        data file (or None if it is unknown)
+        """
+        result = {}
+        for m in PredictionWorker.__parseMetrics('*', storage.Store(), [], True):
+            # Depending on the Graphite version, the path of the file is stored on the node or on its reader
+            path = getattr(m, 'fs_path', None) or getattr(getattr(m, 'reader', None), 'fs_path', None)
+            mtime = None
+            if path is not None:
+                try:
+                    mtime = os.path.getmtime(path)
+                except OSError:
+                    pass
+            result[m.path] = mtime
+        return result
+
+    @staticmethod
+    def __parseMetrics(query, store, results, nodes = False):
         metrics= store.find(query)
         for m in metrics:
             if m.is_leaf:
-                results.append(m.path)
+                results.append(m if nodes else m.path)
             else:
-                PredictionWorker.__parseMetrics(m.path + '.*', store, results)
+                PredictionWorker.__parseMetrics(m.path + '.*', store, results, nodes)
         return results
 
     @staticmethod
@@ -394,7 +653,7 @@ class PredictionWorker(Process):
         in which servicename may be null to describe a host component.
         """
         result = []
-        hlist = get_all_hosts()
+        hlist = get_all_hosts('components')
         for hname in hlist:
             result.append((hname, None))
             for sname in hlist[hname]['services']:
@@ -436,6 +695,95 @@ class PredictionWorker(Process):
             start += step
 
 
+class ForecastBackend(object):
+    """ Abstract base class for the algorithms used to forecast the evolution of a time series """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def forecast(self, data, window, horizon):
+        """
+        Forecasts the next values of a time series made of hourly points.
+
+        data contains the history of the series, window the number of recent points the forecast
+        should be based on and horizon the number of points to forecast.
+        Returns a (mean, lower_80, lower_95, upper_80, upper_95) tuple of lists, containing the predicted
+        values and the bounds of their 80% and 95% confidence intervals, or None if the series could not be processed.
+        """
+        pass
+
+    def forecast_many(self, series, window, horizon):
+        """
+        Forecasts several time series at once. Returns a list containing the result of forecast() for each series.
+        Backends that have a per-call overhead should override this method.
+        """
+        return [self.forecast(data, window, horizon) for data in series]
+
+class RForecastBackend(ForecastBackend):
+    """ Forecasts time series with the timewindow.r script (STL decomposition and ETS, from the R forecast package) """
+
+    def forecast(self, data, window, horizon):
+        inputs = {'iData': PredictionValue('float', data),
+                  'iTwPoints': PredictionValue('int', window),
+                  'iOutputLength': PredictionValue('int', horizon)}
+
+        outputs = {'pred_mean': None, 'pred_lower': None, 'pred_upper': None}
+
+        if not PredictionWorker.run_r_script(PredictionWorker.generate_r_path('timewindow.r'), inputs, outputs):
+            return None
+        valcount = len(outputs['pred_mean'])
+        return (outputs['pred_mean'],
+                outputs['pred_lower'][:valcount],
+                outputs['pred_lower'][valcount:],
+                outputs['pred_upper'][:valcount],
+                outputs['pred_upper'][valcount:])
+
+    def forecast_many(self, series, window, horizon):
+        """
+        Forecasts all the series with a single execution of timewindow_batch.r.
+        If the script fails, the series are forecasted one by one with timewindow.r.
+        """
+        if len(series) == 0:
+            return []
+        data = []
+        for s in series:
+            data.extend(s)
+        inputs = {'iData': PredictionValue('float', data),
+                  'iLengths': PredictionValue('int', [len(s) for s in series]),
+                  'iTwPoints': PredictionValue('int', window),
+                  'iOutputLength': PredictionValue('int', horizon),
+                  'iCores': PredictionValue('int', R_BATCH_PROCESSES)}
+
+        outputs = {'pred_mean': None, 'pred_lower': None, 'pred_upper': None}
+
+        if not PredictionWorker.run_r_script(PredictionWorker.generate_r_path('timewindow_batch.r'), inputs, outputs):
+            logging.warning('[nanto] The batch forecast script failed, forecasting the {0} series one by one'.format(len(series)))
+            return [self.forecast(s, window, horizon) for s in series]
+        results = []
+        for i in xrange(len(series)):
+            mean = outputs['pred_mean'][i * horizon:(i + 1) * horizon]
+            lower = outputs['pred_lower'][i * 2 * horizon:(i + 1) * 2 * horizon]
+            upper = outputs['pred_upper'][i * 2 * horizon:(i + 1) * 2 * horizon]
+            prediction = (mean, lower[:horizon], lower[horizon:], upper[:horizon], upper[horizon:])
+            if any(None in values for values in prediction):
+                # The script could not process this series, or some of its bounds
+                results.append(None)
+            else:
+                results.append(prediction)
+        return results
+
+# Available forecast backends, as name => (module name, class name)
+FORECAST_BACKENDS = {
+    'R': ('prediction_worker', 'RForecastBackend'),
+    'numpy': ('numpy_forecast', 'NumpyForecastBackend'),
+}
+
+def create_forecast_backend(name):
+    """ Creates an instance of the forecast backend registered with the specified name in FORECAST_BACKENDS """
+    if name not in FORECAST_BACKENDS:
+        raise ValueError('Unknown forecast backend "{0}" (available backends are: {1})'.format(name, ', '.join(sorted(FORECAST_BACKENDS))))
+    modulename, typename = FORECAST_BACKENDS[name]
+    return getattr(importlib.import_module(modulename), typename)()
+
 class PredictionValue(object):
     """ A wrapper for values sent to R """
     def __init__(self, type, value):
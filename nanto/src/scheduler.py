@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# This file is part of Omega Noc
+# Copyright Omega Noc (C) 2014 Omega Cube and contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import fnmatch
+import logging
+
+class MetricScheduler(object):
+    """
+    Decides in which order a worker should process the Graphite metrics.
+
+    Metrics that did not receive any new data point since their last prediction are skipped.
+    The other ones are sorted by priority (see the priority_metrics configuration option),
+    then by the age of their last prediction, so that the most important and the most
+    outdated predictions are computed first even if a run cannot process every metric.
+    """
+    def __init__(self, priorities = None):
+        """
+        priorities is a list of metric name patterns (using shell-style wildcards), starting
+        with the most important ones. Metrics matching none of them come last.
+        """
+        self.priorities = list(priorities or [])
+
+    @staticmethod
+    def parse_priorities(value):
+        """ Parses the comma-separated list of patterns used in the configuration file """
+        if not value:
+            return []
+        return [p.strip() for p in value.split(',') if p.strip()]
+
+    def priority(self, metric):
+        """ Returns the priority rank of a metric (lower values are more important) """
+        for i, pattern in enumerate(self.priorities):
+            if fnmatch.fnmatchcase(metric, pattern):
+                return i
+        return len(self.priorities)
+
+    def schedule(self, metrics, last_updates):
+        """
+        Returns the list of the metrics that should be processed, in processing order.
+
+        metrics is a dict associating each metric name to the modification time of its data
+        (or None if it is unknown), and last_updates a dict associating metric names to
+        the time of their last prediction.
+        """
+        scheduled = []
+        skipped = 0
+        for metric, mtime in metrics.iteritems():
+            last_update = last_updates.get(metric)
+            if last_update is not None and mtime is not None and mtime <= last_update:
+                skipped += 1
+                continue
+            scheduled.append((self.priority(metric), last_update or 0, metric))
+        scheduled.sort()
+        logging.debug('[nanto] Scheduled {0} metrics, skipped {1} metrics without new data'.format(len(scheduled), skipped))
+        return [s[2] for s in scheduled]
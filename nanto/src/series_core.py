@@ -0,0 +1,197 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# This file is part of Omega Noc
+# Copyright Omega Noc (C) 2014 Omega Cube and contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Vectorized statistical tools shared by the Ecdf, Changepoint and MarkovStates workers.
+
+Most functions work on a whole batch of series at once, stored as a 2D array with one series per row
+(see to_matrix), so that the cost of the Python interpreter is paid once per batch instead of once per value.
+"""
+
+import numpy as np
+
+def to_matrix(series):
+    """
+    Stacks a list of series (lists of numbers that may contain None values) into a 2D float array.
+    Series are aligned on their last value; missing values are NaN.
+    """
+    length = max(len(s) for s in series) if series else 0
+    result = np.full((len(series), length), np.nan)
+    for i, s in enumerate(series):
+        if len(s) > 0:
+            result[i, length - len(s):] = np.array(s, dtype=float) # None becomes NaN
+    return result
+
+def fill_gaps(matrix):
+    """ Replaces NaN values by the previous valid value of the same row (leading NaN values are kept) """
+    valid = ~np.isnan(matrix)
+    index = np.where(valid, np.arange(matrix.shape[1]), 0)
+    np.maximum.accumulate(index, axis=1, out=index)
+    result = matrix[np.arange(matrix.shape[0])[:, None], index]
+    result[np.cumsum(valid, axis=1) == 0] = np.nan
+    return result
+
+# ECDF
+
+def ecdf_ranges(matrix, bins = 10):
+    """
+    Computes the empirical distribution of the values of each row, using a histogram of bins intervals
+    spanning from min(0, lowest value) to the highest value.
+
+    Returns an (upper_bounds, probabilities, lower_95, upper_95, counts) tuple, where upper_bounds and probabilities
+    have one row per series and one column per interval, lower_95 and upper_95 contain the bounds of the central
+    95% of the values of each series, and counts the amount of values of each series (0 if it has no values at all,
+    in which case the other results of the series are meaningless).
+    """
+    rows = matrix.shape[0]
+    valid = ~np.isnan(matrix)
+    counts = valid.sum(axis=1)
+    low = np.minimum(np.where(valid, matrix, np.inf).min(axis=1), 0)
+    high = np.where(valid, matrix, -np.inf).max(axis=1)
+    low[counts == 0] = 0
+    high[counts == 0] = 0
+    width = high - low
+    width[width <= 0] = 1
+
+    positions = np.where(valid, (np.where(valid, matrix, 0) - low[:, None]) / width[:, None] * bins, 0)
+    positions = np.clip(positions.astype(int), 0, bins - 1)
+    flat = (np.arange(rows)[:, None] * bins + positions)[valid]
+    histogram = np.bincount(flat, minlength=rows * bins).reshape(rows, bins)
+    probabilities = histogram / np.maximum(counts, 1)[:, None].astype(float)
+    upper_bounds = low[:, None] + width[:, None] * np.arange(1, bins + 1) / float(bins)
+
+    # Percentiles, computed on sorted rows (NaN values are sorted last)
+    ordered = np.sort(matrix, axis=1)
+    last = np.maximum(counts - 1, 0)
+    lower_95 = ordered[np.arange(rows), np.round(last * 0.025).astype(int)]
+    upper_95 = ordered[np.arange(rows), np.round(last * 0.975).astype(int)]
+    return upper_bounds, probabilities, lower_95, upper_95, counts
+
+# CHANGEPOINTS
+
+def changepoints(values, penalty = None, min_size = 5, max_changepoints = 10):
+    """
+    Detects the changes of mean of a series with binary segmentation, using a normal likelihood cost.
+
+    The noise level is estimated from the differences between consecutive values, and a split is kept
+    when it improves the cost by more than penalty (3 * log(n) by default, close to the MBIC penalty
+    used by the R changepoint package).
+    Returns the sorted indexes of the first value of each new segment.
+    """
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if n < 2 * min_size:
+        return []
+    # Robust estimate of the standard deviation of the noise
+    sigma = np.median(np.abs(np.diff(values) - np.median(np.diff(values)))) * 1.4826 / np.sqrt(2)
+    if sigma <= 0:
+        sigma = np.std(values)
+        if sigma <= 0:
+            return [] # Constant series
+    if penalty is None:
+        penalty = 3 * np.log(n)
+
+    sums = np.concatenate(([0.0], np.cumsum(values / sigma)))
+    result = []
+    segments = [(0, n)]
+    while segments and len(result) < max_changepoints:
+        best = None
+        for a, b in segments:
+            if b - a < 2 * min_size:
+                continue
+            split = np.arange(a + min_size, b - min_size + 1)
+            left = sums[split] - sums[a]
+            right = sums[b] - sums[split]
+            total = sums[b] - sums[a]
+            gain = left ** 2 / (split - a) + right ** 2 / (b - split) - total ** 2 / (b - a)
+            i = np.argmax(gain)
+            if best is None or gain[i] > best[0]:
+                best = (gain[i], a, b, split[i])
+        if best is None or best[0] <= penalty:
+            break
+        gain, a, b, k = best
+        segments.remove((a, b))
+        segments.extend([(a, k), (k, b)])
+        result.append(int(k))
+    return sorted(result)
+
+# MARKOV CHAINS
+
+def states_to_los(times, states, start, end, step):
+    """
+    Converts a list of state changes into a list of states (LOS), sampled every step seconds
+    from start to end. Each sample takes the state of the last change that happened before it,
+    or 0 if there was none.
+    """
+    grid = start + np.arange(int((end - start) // step) + 1) * step
+    index = np.searchsorted(np.asarray(times, dtype=float), grid, side='right') - 1
+    states = np.asarray(states, dtype=int)
+    if len(states) == 0:
+        return np.zeros(len(grid), dtype=int)
+    return np.where(index >= 0, states[np.maximum(index, 0)], 0)
+
+def transition_matrices(los, states_count):
+    """
+    Estimates the transition matrix of a Markov chain for each row of los (a 2D array of states sampled at a
+    regular interval). Returns an array of shape (rows, states_count, states_count).
+    States that were never left are considered as absorbing.
+    """
+    rows = los.shape[0]
+    flat = (np.arange(rows)[:, None] * states_count * states_count + los[:, :-1] * states_count + los[:, 1:]).ravel()
+    counts = np.bincount(flat, minlength=rows * states_count * states_count).reshape(rows, states_count, states_count).astype(float)
+    totals = counts.sum(axis=2)
+    counts[totals == 0] = np.eye(states_count)[np.nonzero(totals == 0)[1]]
+    return counts / counts.sum(axis=2)[:, :, None]
+
+def mean_first_passage(transitions, target):
+    """
+    Computes, for each transition matrix, the expected number of steps needed to reach the target state
+    from each state. Returns an array of shape (rows, states_count); values are NaN when the target
+    cannot be reached.
+    """
+    rows, states_count = transitions.shape[:2]
+    others = [s for s in xrange(states_count) if s != target]
+    q = transitions[:, others][:, :, others]
+    a = np.eye(len(others)) - q
+    result = np.full((rows, states_count), np.nan)
+    result[:, target] = 0
+    solvable = np.abs(np.linalg.det(a)) > 1e-12
+    if solvable.any():
+        times = np.linalg.solve(a[solvable], np.ones((solvable.sum(), len(others), 1)))[:, :, 0]
+        times[times < 0] = np.nan
+        result[np.ix_(solvable, others)] = times
+
+    # Some states cannot reach the target: solve the system for the other ones only
+    for row in np.nonzero(~solvable)[0]:
+        reaching = set([target])
+        changed = True
+        while changed:
+            changed = False
+            for s in others:
+                if s not in reaching and transitions[row, s, list(reaching)].sum() > 0:
+                    reaching.add(s)
+                    changed = True
+        states = [s for s in others if s in reaching]
+        if not states:
+            continue
+        a = np.eye(len(states)) - transitions[row][states][:, states]
+        if abs(np.linalg.det(a)) > 1e-12:
+            result[row, states] = np.linalg.solve(a, np.ones(len(states)))
+    return result
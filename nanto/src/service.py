@@ -20,9 +20,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import ConfigParser
+import errno
+import fcntl
 import logging
 import multiprocessing
+import os
 import os.path
+import re
+import select
 import signal
 import sys
 import threading
@@ -33,12 +38,17 @@ import importlib
 from daemon import DaemonContext
 from lockfile.pidlockfile import PIDLockFile
 
+from scheduler import MetricScheduler
+
 
 conf_file_path = '/etc/nanto.cfg'
 log_file_path = '/var/log/nanto.log'
 lock_file_path = '/var/run/nanto.pid'
 current_app = None # Will contain the currently running app instance
 current_context = None
+
+# Maximum time the main loop sleeps without checking the workers, in seconds
+MAX_SLEEP_TIME = 3600
     
 class Nanto(object):
     """ 
@@ -60,6 +70,15 @@ class Nanto(object):
         # Folder in which we'll store all the data
         self.storage = modconf.get('database_file', '/var/log/shinken/nanto.db')
         logging.debug('storage is {0}'.format(self.storage))
+        # Metrics that should be processed first by the workers
+        self.priority_metrics = MetricScheduler.parse_priorities(modconf.get('priority_metrics', ''))
+        logging.debug('priority_metrics is {0}'.format(self.priority_metrics))
+        # Algorithm used by the forecasting workers
+        self.forecast_backend = modconf.get('forecast_backend', 'R')
+        logging.debug('forecast_backend is {0}'.format(self.forecast_backend))
+        # Carbon daemon that receives the statistics of the workers
+        self.carbon_server = modconf.get('carbon_server', None)
+        logging.debug('carbon_server is {0}'.format(self.carbon_server))
 
         # Parse the workers list
         self.workers = modconf.get('workers', '')
@@ -67,6 +86,7 @@ class Nanto(object):
         logging.debug('workers is {0}'.format(self.workers))
         
         self.worker_containers = []
+        self.__wakeup_pipe = None
 
     def main(self):
         logging.info('Starting nanto')
@@ -74,25 +94,56 @@ class Nanto(object):
         
         logging.debug('[nanto] Starting with {0} workers registered. The time is {1}'.format(len(self.worker_containers), time.time()))
 
+        # The main loop sleeps until the next planned run, or until a worker process exits.
+        # Exits are notified by SIGCHLD, that writes into a pipe to wake up the select() call
+        self.__wakeup_pipe = os.pipe()
+        for fd in self.__wakeup_pipe:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: self.__wakeup())
+
         self.run = True
 
         while self.run:
-            # Breathe
-            time.sleep(10)
             # Check workers
             for wc in self.worker_containers:
                 wc.check()
 
+            next_run_times = [wc.next_run_time for wc in self.worker_containers if not wc.is_running]
+            if next_run_times:
+                timeout = min(max(min(next_run_times) - time.time(), 0), MAX_SLEEP_TIME)
+            else:
+                timeout = MAX_SLEEP_TIME
+            try:
+                select.select([self.__wakeup_pipe[0]], [], [], timeout)
+            except select.error as ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
+            self.__drain_wakeup_pipe()
+
         logging.debug('[nanto] Stopped')
 
+    def __wakeup(self):
+        """ Wakes the main loop up. Called from signal handlers. """
+        try:
+            os.write(self.__wakeup_pipe[1], '\0')
+        except OSError:
+            pass # The pipe is full, the main loop will wake up anyway
+
+    def __drain_wakeup_pipe(self):
+        try:
+            while os.read(self.__wakeup_pipe[0], 4096):
+                pass
+        except OSError:
+            pass # Nothing left to read
+
     def __register_default_prediction_systems(self):
         """ 
         Create instances of the statistical modules that will run at regular intervals,
         and fill the worker_containers field with them.
         """
         for w in self.workers:
-            # Try loading that worker
-            modulename = w.lower() + '_worker'
+            # Try loading that worker (for example MarkovStates is implemented in markov_states_worker)
+            modulename = re.sub('(?<!^)([A-Z])', r'_\1', w).lower() + '_worker'
             try:
                 mod = importlib.import_module(modulename)
             except Exception as err:
@@ -113,6 +164,8 @@ class Nanto(object):
     def stop(self):
         logging.info('Stopping Nanto')
         self.run = False
+        if self.__wakeup_pipe is not None:
+            self.__wakeup()
         # Cancel all currently running workers
         for w in self.worker_containers:
             if w.is_running:
@@ -140,7 +193,8 @@ class PredictionWorkerContainer(object):
 
 
         self.worker_instance = self.worker_class()
-        self.worker_instance.initialize(previous_worker, self.container.storage)
+        self.worker_instance.initialize(previous_worker, self.container.storage, self.container.priority_metrics,
+                                        self.container.forecast_backend, self.container.carbon_server)
 
         if previous_worker is not None and previous_worker.run_exception is not None:
             # Previous run ended up on an error.
@@ -168,7 +222,7 @@ class PredictionWorkerContainer(object):
                 logging.info('[nanto] Worker {0} done after running for {2} seconds. Next run planned at {1}'.format(self.worker_class.__name__, self.next_run_time, time.time() - self.start_time))
             return
 
-        if self.next_run_time < time.time():
+        if self.next_run_time <= time.time():
             # Run the worker now !
             logging.info('[nanto] Starting worker {0}'.format(self.worker_class.__name__))
             # A few notes on the execution model :
@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+# This file is part of Omega Noc
+# Copyright Omega Noc (C) 2014 Omega Cube and contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import socket
+import time
+from contextlib import contextmanager
+
+# Statistics older than that are removed from the database, in seconds
+STATS_RETENTION = 30 * 86400
+
+class WorkerStats(object):
+    """
+    Collects statistics about a run of a worker: the time spent in each stage of the computations,
+    and counters (processed, failed or skipped metrics...)
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.timers = {} # stage name => [total time, calls count]
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """ Measures the time spent in the with block, and adds it to the specified stage """
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            timer = self.timers.setdefault(name, [0.0, 0])
+            timer[0] += time.time() - t0
+            timer[1] += 1
+
+    def count(self, name, value = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def stop(self):
+        self.end_time = time.time()
+
+    def values(self):
+        """ Returns all the statistics as a dict associating dotted names to numbers """
+        result = {'duration': (self.end_time or time.time()) - self.start_time}
+        for name, (total, calls) in self.timers.iteritems():
+            result['stage.{0}.time'.format(name)] = total
+            result['stage.{0}.calls'.format(name)] = calls
+        for name, value in self.counters.iteritems():
+            result['count.{0}'.format(name)] = value
+        forecasted = self.counters.get('forecasted', 0)
+        if forecasted > 0:
+            result['forecast_error_rate'] = float(self.counters.get('forecast_errors', 0)) / forecasted
+        return result
+
+    def save(self, con, worker_name):
+        """ Stores the statistics in the onoc_pred_stats table, and removes the outdated ones """
+        con.execute('CREATE TABLE IF NOT EXISTS onoc_pred_stats (\
+                        worker_name VARCHAR(255) NOT NULL,\
+                        run_time INT NOT NULL,\
+                        name VARCHAR(255) NOT NULL,\
+                        value REAL,\
+                        PRIMARY KEY (worker_name, run_time, name))')
+        con.executemany('INSERT OR REPLACE INTO onoc_pred_stats (worker_name, run_time, name, value) VALUES (?, ?, ?, ?)',
+                        ((worker_name, int(self.start_time), name, value) for name, value in self.values().iteritems()))
+        con.execute('DELETE FROM onoc_pred_stats WHERE run_time < ?', (time.time() - STATS_RETENTION,))
+
+    def send(self, server, prefix):
+        """
+        Sends the statistics to carbon using the plaintext protocol.
+        server is a "host:port" string (the port defaults to 2003), and prefix is prepended to the metric names.
+        """
+        host, sep, port = server.partition(':')
+        timestamp = int(self.end_time or time.time())
+        lines = ''.join('{0}.{1} {2} {3}\n'.format(prefix, name, value, timestamp) for name, value in sorted(self.values().iteritems()))
+        try:
+            sock = socket.create_connection((host, int(port or 2003)), timeout=10)
+            try:
+                sock.sendall(lines)
+            finally:
+                sock.close()
+        except (socket.error, ValueError) as ex:
+            logging.warning('[nanto] Could not send the statistics to carbon ({0}): {1}'.format(server, ex))
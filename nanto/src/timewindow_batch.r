@@ -0,0 +1,85 @@
+# This file is part of Omega Noc
+# Copyright Omega Noc (C) 2014 Omega Cube and contributors
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Batch version of timewindow.r: forecasts several time series in a single call
+
+##########################################################################################
+#                                     Inputs                                             #
+##########################################################################################
+# iData - The past points of all the series, one series after the other                  #
+# iLengths - The amount of points of each series in iData                                #
+# iTwPoints - Amount of points to take up in the time window                             #
+# iOutputLength - The amount of data points to be forecasted                             #
+# iCores - The amount of processes used to compute the forecasts                         #
+##########################################################################################
+
+##########################################################################################
+#                                     Outputs                                            #
+##########################################################################################
+# pred_mean - iOutputLength predicted values per series                                  #
+# pred_lower, pred_upper - 2 * iOutputLength values per series: the bounds of the 80%    #
+#                          confidence interval, then the bounds of the 95% one           #
+# The values of the series that could not be forecasted are NA                           #
+##########################################################################################
+
+# Settings (see timewindow.r)
+checkIn = 6
+TSfrequency = 24
+epsilon = 1e-5
+confInterval = c(80, 95)
+
+library("forecast")
+library("parallel")
+
+forecastSeries <- function(iSeries) {
+    fullData = ts(iSeries, freq=TSfrequency)
+    twData = ts(fullData[(length(fullData) - iTwPoints + 1):length(fullData)], freq=TSfrequency)
+    twDataLength = length(twData)
+
+    # Interpolate missing values and anomalies among the last points
+    fullDataMean = mean(fullData)
+    fullDataSd = sd(fullData)
+    for (i in (twDataLength - checkIn + 1) : twDataLength){
+        if (is.na(twData[i])){
+            twData = na.interp(twData)
+        }
+        d = dnorm(twData[i], mean=fullDataMean, sd=fullDataSd)
+        if (d < epsilon){
+            twData[i] = NA
+            twData = na.interp(twData)
+        }
+    }
+
+    prediction = stlf(twData, h = iOutputLength, level = confInterval)
+    c(as.numeric(prediction$mean), as.numeric(prediction$lower), as.numeric(prediction$upper))
+}
+
+safeForecastSeries <- function(iSeries) {
+    tryCatch(forecastSeries(iSeries), error = function(e) rep(NA_real_, 5 * iOutputLength))
+}
+
+series = split(iData, rep(seq_along(iLengths), iLengths))
+if (iCores > 1 && .Platform$OS.type == "unix") {
+    results = mclapply(series, safeForecastSeries, mc.cores = iCores)
+} else {
+    results = lapply(series, safeForecastSeries)
+}
+
+# One column per series
+results = matrix(unlist(results), nrow = 5 * iOutputLength)
+pred_mean = as.numeric(results[1:iOutputLength, ])
+pred_lower = as.numeric(results[(iOutputLength + 1):(3 * iOutputLength), ])
+pred_upper = as.numeric(results[(3 * iOutputLength + 1):(5 * iOutputLength), ])
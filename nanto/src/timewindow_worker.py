@@ -24,7 +24,7 @@ import os
 import time
 import traceback
 
-from prediction_worker import PredictionWorker, PredictionValue
+from prediction_worker import PredictionWorker
 from on_reader.livestatus import livestatus
 
 
@@ -34,41 +34,113 @@ class TimewindowWorker(PredictionWorker):
     """
     def __init__(self):
         # The worker runs every 2 hours
-        super(TimewindowWorker, self).__init__(7200, 'timewindow', 2)
+        super(TimewindowWorker, self).__init__(7200, 'timewindow', 3)
         self.history_points_count = 30*24 # 1 month
         self.predicted_points = 6
+        self.checkinterval = 3600 # For now we'll only consider one value/hour
+        self.batch_size = 50 # Amount of components sent at once to the forecast backend
 
     def internal_run(self):
-        components = PredictionWorker.get_graphite_metrics()
-        logging.debug('[nanto:timewindow] About to run timewindow prediction on {0} components'.format(len(components)))
         logging.debug('[nanto:timewindow] On process {0}'.format(os.getpid()))
         t0 = time.time()
-        for c in components:
-            if self.should_cancel():
-                logging.info('[nanto:timewindow] Cancelling')
-                return
-            success = False
-            checkinterval = 3600 # For now we'll only consider one value/hour
-            now = time.time()
+        # Components that are not processed within the compute interval are left to the next run
+        count = 0
+        batch = []
+        for c in self.queued_metrics('timewindow', t0 + self.compute_interval):
+            count += 1
             try:
-                success = self.__go(c, checkinterval)
+                data = self.__load(c)
             except Exception, ex:
-                logging.warning('[nanto:timewindow]  An exception occured while computing the timewindow predictions for component {0}: {1}'.format(c, ex.message))
-                logging.debug('[nanto:timewindow]  Exception details: ' + traceback.format_exc())
-            if not success:
-                # There is no available data at all... Set the prediction value to NULL
-                with self.get_database() as con:
-                    con.execute('INSERT OR REPLACE INTO timewindow (probe, update_time, start_time, step, mean, lower_80, lower_95, upper_80, upper_95) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                                (c, time.time(), None, None, None, None, None, None, None))
+                self.__failed(c, ex)
+                continue
+            if data is None:
+                self.metric_done(c)
+                continue
+            batch.append((c, data))
+            if len(batch) >= self.batch_size:
+                self.__forecast(batch)
+                batch = []
+        if batch:
+            self.__forecast(batch)
         t1 = time.time()
         ttl = t1 - t0
-        logging.debug('[nanto:timewindow] Entire timewindow ({0} entries) in {1}s ({2}s / entry)'.format(len(components), ttl, ttl / len(components)))
-        
-    def __go(self, target, checkinterval):
-        now = time.time()
-        (start, end, step, values) = PredictionWorker.get_graphite_data(target, checkinterval * self.history_points_count / 3600, False, True)
+        logging.debug('[nanto:timewindow] Entire timewindow ({0} entries) in {1}s ({2}s / entry)'.format(count, ttl, ttl / max(count, 1)))
+
+    def __failed(self, target, ex):
+        logging.warning('[nanto:timewindow]  An exception occured while computing the timewindow predictions for component {0}: {1}'.format(target, ex.message))
+        logging.debug('[nanto:timewindow]  Exception details: ' + traceback.format_exc())
+        self.metric_failed(target, str(ex))
+        # Set the prediction value to NULL
+        with self.get_database() as con:
+            con.execute('INSERT OR REPLACE INTO timewindow (probe, update_time, start_time, step, mean, lower_80, lower_95, upper_80, upper_95) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (target, time.time(), None, None, None, None, None, None, None))
+
+    def __load(self, target):
+        """
+        Reads the history of a component from Graphite, and returns it as an (end, values) tuple where values
+        contains one value per checkinterval. Returns None if there is not enough data to make a prediction.
+        """
+        with self.stage('fetch'):
+            (end, step, values) = self.fetch(target)
+        with self.stage('resample'):
+            normalized_values = self.resample(values, step)
+
+        logging.debug('[nanto:timewindow] Found {0} data points for node {1}'.format(len(normalized_values), target))
+        # Check that we actually have enough data
+        if len(normalized_values) < 300:
+            logging.info('[nanto:timewindow]  Skipped time series on {0}: not enough data ({1} points)'.format(target, len(normalized_values)))
+            self.save_error(target, "There is not enough data to have make accurate predictions")
+            self.count('no_data')
+            return None
+        return (end, normalized_values)
+
+    def __forecast(self, batch):
+        """ Computes and stores the predictions of a list of (component, (end, values)) tuples """
+        self.count('forecasted', len(batch))
+        try:
+            with self.stage('forecast'):
+                predictions = self.forecast([data[1] for c, data in batch])
+        except Exception, ex:
+            # Only the batch call failed: forecast the components one by one before marking any of them as failed
+            logging.warning('[nanto:timewindow] Could not forecast a batch of {0} components ({1}), forecasting them one by one'.format(len(batch), ex))
+            self.count('batch_errors')
+            batch, predictions = self.__forecast_each(batch)
+        self.count('forecast_errors', sum(1 for p in predictions if p is None))
+
+        with self.stage('write'):
+            with self.get_database() as con:
+                self.store(con, batch, predictions)
+        for c, data in batch:
+            self.metric_done(c)
+
+    def __forecast_each(self, batch):
+        """
+        Forecasts a list of (component, (end, values)) tuples one at a time. The components whose forecast raises
+        an exception are marked as failed; returns the list of the other ones along with their predictions.
+        """
+        succeeded = []
+        predictions = []
+        for c, data in batch:
+            try:
+                with self.stage('forecast'):
+                    prediction = self.forecast_one(data[1])
+            except Exception, ex:
+                self.count('forecast_errors')
+                self.__failed(c, ex)
+                continue
+            succeeded.append((c, data))
+            predictions.append(prediction)
+        return succeeded, predictions
 
-        # Change the time series granularity so that we have the one required by the R script
+    # The steps of the timewindow computations
+
+    def fetch(self, target):
+        """ Reads the history of a component from Graphite, and returns it as an (end, step, values) tuple """
+        (start, end, step, values) = PredictionWorker.get_graphite_data(target, self.checkinterval * self.history_points_count / 3600, False, True)
+        return (end, step, values)
+
+    def resample(self, values, step):
+        """ Changes the time series granularity so that we have the one required by the forecast backend (one value per checkinterval) """
         normalized_values = []
         dstpos = 0
         lastval = 0
@@ -76,46 +148,37 @@ class TimewindowWorker(PredictionWorker):
             if values[srcpos] is not None:
                 lastval = values[srcpos]
 
-            while (srcpos * step) >= (dstpos * checkinterval):
+            while (srcpos * step) >= (dstpos * self.checkinterval):
                 normalized_values.append(lastval)
                 dstpos += 1
+        return normalized_values
 
-        logging.debug('[nanto:timewindow] Found {0} data points for node {1}'.format(len(normalized_values), target))
-        # Check that we actually have enough data
-        if len(normalized_values) < 300:
-            logging.info('[nanto:timewindow]  Skipped time series on {0}: not enough data ({1} points)'.format(target, len(normalized_values)))
-            save_error(target, "There is not enough data to have make accurate predictions")
-            return False
-
-        # Send the values to R
-        inputs = {'iData': PredictionValue('float', normalized_values),
-                    'iTwPoints': PredictionValue('int', 300),
-                    'iOutputLength': PredictionValue('int', 6)}
+    def forecast(self, series):
+        """ Computes the predictions of a list of resampled series (see ForecastBackend.forecast_many) """
+        return self.get_forecast_backend().forecast_many(series, 300, self.predicted_points)
 
-        outputs = {'pred_mean': None, 'pred_lower': None, 'pred_upper': None}
+    def forecast_one(self, values):
+        """ Computes the predictions of a single resampled series (see ForecastBackend.forecast) """
+        return self.get_forecast_backend().forecast(values, 300, self.predicted_points)
 
-        if self.run_r_script(PredictionWorker.generate_r_path('timewindow.r'), inputs, outputs):
-            valcount = len(outputs['pred_mean'])
-            mean = ';'.join([str(i) for i in outputs['pred_mean']])
-            lower_80 = ';'.join([str(i) for i in outputs['pred_lower'][:valcount]])
-            lower_95 = ';'.join([str(i) for i in outputs['pred_lower'][valcount:]])
-            upper_80 = ';'.join([str(i) for i in outputs['pred_upper'][:valcount]])
-            upper_95 = ';'.join([str(i) for i in outputs['pred_upper'][valcount:]])
-
-            with self.get_database() as con:
-                con.execute('INSERT OR REPLACE INTO timewindow (probe, update_time, error_desc, start_time, step, mean, lower_80, lower_95, upper_80, upper_95) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                            (target, time.time(), None, end + checkinterval, checkinterval, mean, lower_80, lower_95, upper_80, upper_95))
-
-            return True
-        else:
-            save_error(target, "This node could not be processed");
-            return False
+    def store(self, con, batch, predictions):
+        """ Saves the predictions computed for a list of (component, (end, values)) tuples """
+        for (target, (end, values)), prediction in zip(batch, predictions):
+            # Missing values (NA values returned by R) cannot be packed
+            if prediction is None or any(v is None for series in prediction for v in series):
+                self.save_error(target, "This node could not be processed", con)
+                continue
+            mean, lower_80, lower_95, upper_80, upper_95 = [self.pack_values(v) for v in prediction]
+            con.execute('INSERT OR REPLACE INTO timewindow (probe, update_time, error_desc, start_time, step, mean, lower_80, lower_95, upper_80, upper_95) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (target, time.time(), None, end + self.checkinterval, self.checkinterval, mean, lower_80, lower_95, upper_80, upper_95))
         
-    def save_error(target, message):
+    def save_error(self, target, message, con = None):
         """ Saves an error to the database, and clear and existing results """
-        with self.get_database() as con:
-            con.execute('INSERT OR REPLACE INTO timewindow (probe, update_time, error_desc, start_time, step, mean, lower_80, lower_95, upper_80, upper_95) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                        (target, time.time(), message, None, None, None, None, None, None, None))
+        if con is None:
+            with self.get_database() as con:
+                return self.save_error(target, message, con)
+        con.execute('INSERT OR REPLACE INTO timewindow (probe, update_time, error_desc, start_time, step, mean, lower_80, lower_95, upper_80, upper_95) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (target, time.time(), message, None, None, None, None, None, None, None))
         
     def updatedb(self, currentversion, connection):
         if currentversion < 1:
@@ -134,3 +197,13 @@ class TimewindowWorker(PredictionWorker):
             # Add the error_desc column, containing a user-friendly error message 
             # if for any reason we could not produce results
             connection.execute('ALTER TABLE timewindow ADD error_desc TEXT')
+        if currentversion < 3:
+            # The predicted values are stored as packed float64 blobs instead of ';'-joined strings
+            # (SQLite does not enforce column types, so the table structure stays the same)
+            logging.debug('[nanto:timewindow] Converting timewindow values to blobs')
+            columns = ('mean', 'lower_80', 'lower_95', 'upper_80', 'upper_95')
+            rows = connection.execute('SELECT probe, ' + ', '.join(columns) + ' FROM timewindow WHERE mean IS NOT NULL').fetchall()
+            for row in rows:
+                values = [self.pack_values([float(i) for i in v.split(';')]) for v in row[1:]]
+                connection.execute('UPDATE timewindow SET ' + ', '.join(c + '=?' for c in columns) + ' WHERE probe=?',
+                                   values + [row[0]])
@@ -7,6 +7,7 @@
 
 """This module tests the features available to all prediction systems"""
 
+import math
 import os
 import sys
 import unittest
@@ -87,5 +88,30 @@ class TestBaseWorker(unittest.TestCase):
         PredictionWorker.run_r_script(os.path.join(path, 'double.r'), { 'input': PredictionValue('float', 7) }, output)
         self.assertListEqual([14], output['output'])
 
+    def test_r_timewindow_batch(self):
+        try:
+            importr('forecast')
+        except Exception:
+            self.skipTest('The R forecast package is not installed')
+        # Two weeks of a daily seasonal series, and a series too short to be forecasted
+        seasonal = [10 + 5 * math.sin(2 * math.pi * i / 24) for i in xrange(24 * 14)]
+        short = [1.0, 2.0, 3.0]
+        inputs = {'iData': PredictionValue('float', seasonal + short),
+                  'iLengths': PredictionValue('int', [len(seasonal), len(short)]),
+                  'iTwPoints': PredictionValue('int', 300),
+                  'iOutputLength': PredictionValue('int', 6),
+                  'iCores': PredictionValue('int', 1)}
+        outputs = {'pred_mean': None, 'pred_lower': None, 'pred_upper': None}
+        self.assertTrue(PredictionWorker.run_r_script(PredictionWorker.generate_r_path('timewindow_batch.r'), inputs, outputs))
+
+        self.assertEqual(12, len(outputs['pred_mean']))
+        self.assertEqual(24, len(outputs['pred_lower']))
+        self.assertEqual(24, len(outputs['pred_upper']))
+        for i in xrange(6):
+            self.assertAlmostEqual(10 + 5 * math.sin(2 * math.pi * (24 * 14 + i) / 24), outputs['pred_mean'][i], delta=0.5)
+            self.assertLessEqual(outputs['pred_lower'][i], outputs['pred_mean'][i])
+            self.assertGreaterEqual(outputs['pred_upper'][i], outputs['pred_mean'][i])
+        self.assertListEqual([None] * 6, list(outputs['pred_mean'][6:]))
+
 if __name__ == '__main__':
     unittest.main()
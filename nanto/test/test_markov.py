@@ -33,3 +33,12 @@ class TestMarkov(unittest.TestCase):
 
         self.assertListEqual(los, [0, 2, 1, 1, 1, 1, 1, 1, 1, 0, 0])
 
+
+    def test_generate_los_end(self):
+        events = [{'time': 10, 'state': 2}]
+
+        los = MarkovStatesWorker._MarkovStatesWorker__create_los_from_events(events, 0, 60, 601)
+        other = MarkovStatesWorker._MarkovStatesWorker__create_los_from_events([], 0, 60, 601)
+
+        self.assertListEqual(los, [0] + [2] * 10)
+        self.assertEqual(len(los), len(other))
@@ -25,6 +25,9 @@ class FakeModule(object):
         self.error_interval = 600
         self.storage = '/tmp/predict/'
         self.debug_worker = None
+        self.priority_metrics = []
+        self.forecast_backend = 'R'
+        self.carbon_server = None
 
 class TestModule(unittest.TestCase):
     """Unit testing the module features"""
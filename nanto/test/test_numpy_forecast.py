@@ -0,0 +1,65 @@
+import math
+import unittest
+
+from module.numpy_forecast import NumpyForecastBackend
+
+class TestNumpyForecast(unittest.TestCase):
+    """Unit testing the NumPy forecast backend"""
+
+    def seasonal_series(self, start, count):
+        """ Daily seasonality (24 points per day) over an upward trend """
+        return [50 + 0.05 * i + 10 * math.sin(2 * math.pi * i / 24) for i in xrange(start, start + count)]
+
+    def test_forecast_shape(self):
+        subject = NumpyForecastBackend()
+        result = subject.forecast(self.seasonal_series(0, 24 * 14), 300, 24)
+
+        self.assertEqual(5, len(result))
+        mean, lower_80, lower_95, upper_80, upper_95 = result
+        for values in result:
+            self.assertEqual(24, len(values))
+        for i in xrange(24):
+            self.assertLessEqual(lower_95[i], lower_80[i])
+            self.assertLessEqual(lower_80[i], mean[i])
+            self.assertLessEqual(mean[i], upper_80[i])
+            self.assertLessEqual(upper_80[i], upper_95[i])
+
+    def test_forecast_seasonal_trend(self):
+        subject = NumpyForecastBackend()
+        mean = subject.forecast(self.seasonal_series(0, 24 * 14), 300, 24)[0]
+
+        for value, expected in zip(mean, self.seasonal_series(24 * 14, 24)):
+            self.assertAlmostEqual(expected, value, delta=1)
+
+    def test_forecast_anomaly(self):
+        subject = NumpyForecastBackend()
+        data = self.seasonal_series(0, 24 * 14)
+        data[-1] = 10000 # Abnormal last value
+        mean = subject.forecast(data, 300, 24)[0]
+
+        for value, expected in zip(mean, self.seasonal_series(24 * 14, 24)):
+            self.assertAlmostEqual(expected, value, delta=2)
+
+    def test_forecast_missing_values(self):
+        subject = NumpyForecastBackend()
+        data = self.seasonal_series(0, 24 * 14)
+        data[100:110] = [None] * 10
+        data[-2] = None
+        result = subject.forecast(data, 300, 24)
+
+        self.assertIsNotNone(result)
+        for values in result:
+            self.assertFalse(any(math.isnan(v) for v in values))
+
+    def test_forecast_too_short(self):
+        subject = NumpyForecastBackend()
+
+        self.assertIsNone(subject.forecast([1.0] * 30, 300, 24))
+
+    def test_forecast_no_values(self):
+        subject = NumpyForecastBackend()
+
+        self.assertIsNone(subject.forecast([None] * 400, 300, 24))
+
+if __name__ == '__main__':
+    unittest.main()
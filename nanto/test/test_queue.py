@@ -0,0 +1,150 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from module import prediction_worker
+from module.prediction_worker import PredictionWorker
+
+class QueueWorker(PredictionWorker):
+    """ Worker that processes the queued metrics without computing anything """
+    def __init__(self):
+        super(QueueWorker, self).__init__(3600, 'queue_test', 1)
+        self.failing = set()
+        self.deadline = None
+        self.on_metric = None
+        self.processed = []
+
+    def internal_run(self):
+        self.processed = []
+        for metric in self.queued_metrics('queue_test', self.deadline):
+            self.processed.append(metric)
+            if metric in self.failing:
+                self.metric_failed(metric, 'Failure')
+            else:
+                self.metric_done(metric)
+            if self.on_metric is not None:
+                self.on_metric(metric)
+
+    def updatedb(self, currentversion, connection):
+        connection.execute('CREATE TABLE queue_test (probe VARCHAR(512) NOT NULL PRIMARY KEY, update_time INT NOT NULL)')
+
+class TestQueue(unittest.TestCase):
+    """Unit testing the work queue of the workers"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'nanto.db')
+        self.now = 1000.0
+        self.metrics = {}
+        self.old_time = time.time
+        self.old_mtimes = PredictionWorker.get_graphite_metrics_mtimes
+        time.time = lambda: self.now
+        PredictionWorker.get_graphite_metrics_mtimes = staticmethod(lambda: dict(self.metrics))
+
+    def tearDown(self):
+        time.time = self.old_time
+        PredictionWorker.get_graphite_metrics_mtimes = self.old_mtimes
+        shutil.rmtree(self.directory)
+
+    def create_worker(self, metrics):
+        self.metrics = dict((m, 1) for m in metrics)
+        worker = QueueWorker()
+        worker.initialize(None, self.database)
+        return worker
+
+    def queue(self, probe = None):
+        """ Returns the (status, attempts, next_try) of a queued metric, or the number of queued metrics by status """
+        con = sqlite3.connect(self.database)
+        try:
+            if probe is not None:
+                return con.execute("SELECT status, attempts, next_try FROM onoc_pred_queue WHERE worker_name='queue_test' AND probe=?", (probe,)).fetchone()
+            return dict(con.execute("SELECT status, COUNT(*) FROM onoc_pred_queue WHERE worker_name='queue_test' GROUP BY status").fetchall())
+        finally:
+            con.close()
+
+    def test_pass(self):
+        worker = self.create_worker(['c', 'a', 'b'])
+        worker.run()
+
+        self.assertListEqual(['a', 'b', 'c'], worker.processed)
+        self.assertDictEqual({'done': 3}, self.queue())
+
+    def test_retry_backoff(self):
+        worker = self.create_worker(['a', 'b', 'c'])
+        worker.failing.add('b')
+        worker.run()
+
+        self.assertEqual(('failed', 1, 1600), self.queue('b'))
+
+        # The metric is not retried before its retry delay expires
+        self.now = 1500
+        worker.run()
+        self.assertListEqual(['a', 'c'], worker.processed)
+
+        # The delay doubles after each failure, up to one day
+        for attempts in xrange(2, 12):
+            self.now = self.queue('b')[2]
+            worker.run()
+            self.assertIn('b', worker.processed)
+            self.assertEqual(('failed', attempts, self.now + min(600 * 2 ** (attempts - 1), 86400)), self.queue('b'))
+
+        # A success resets the attempts count
+        worker.failing.clear()
+        self.now = self.queue('b')[2]
+        worker.run()
+        self.assertEqual(('done', 0), self.queue('b')[:2])
+
+    def test_vanished_metrics(self):
+        worker = self.create_worker(['a', 'b', 'c'])
+        worker.failing.add('b')
+        worker.run()
+        self.assertEqual('failed', self.queue('b')[0])
+
+        del self.metrics['b']
+        worker.run()
+
+        self.assertListEqual(['a', 'c'], worker.processed)
+        self.assertIsNone(self.queue('b'))
+
+    def test_chunks(self):
+        chunk = prediction_worker.QUEUE_CHUNK_SIZE
+        metrics = ['m{0:03d}'.format(i) for i in xrange(2 * chunk + 5)]
+        worker = self.create_worker(metrics)
+        states = {}
+        worker.on_metric = lambda m: states.setdefault(len(worker.processed), self.queue())
+        worker.run()
+
+        # Metrics are marked as running one chunk at a time, along with the results of the previous chunk
+        self.assertDictEqual({'running': chunk, 'pending': chunk + 5}, states[1])
+        self.assertDictEqual({'running': chunk, 'pending': chunk + 5}, states[chunk])
+        self.assertDictEqual({'done': chunk, 'running': chunk, 'pending': 5}, states[chunk + 1])
+        self.assertDictEqual({'done': 2 * chunk, 'running': 5}, states[2 * chunk + 5])
+        self.assertDictEqual({'done': 2 * chunk + 5}, self.queue())
+
+    def test_deadline(self):
+        metrics = ['m{0:02d}'.format(i) for i in xrange(30)]
+        worker = self.create_worker(metrics)
+        worker.deadline = 2000
+
+        def on_metric(metric):
+            if len(worker.processed) == 5:
+                self.now = 3000
+        worker.on_metric = on_metric
+        worker.run()
+
+        self.assertListEqual(metrics[:5], worker.processed)
+        self.assertDictEqual({'done': 5, 'pending': 25}, self.queue())
+        self.assertEqual(('pending', 0, 0), self.queue(metrics[5]))
+
+        # The next run resumes the pass
+        worker.on_metric = None
+        worker.deadline = None
+        worker.run()
+        self.assertListEqual(metrics[5:], worker.processed)
+        self.assertDictEqual({'done': 30}, self.queue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+from module.scheduler import MetricScheduler
+
+class TestScheduler(unittest.TestCase):
+    """Unit testing the metrics scheduling"""
+
+    def test_skip_unchanged(self):
+        subject = MetricScheduler()
+        metrics = {'a.cpu': 100, 'b.cpu': 300, 'c.cpu': None, 'd.cpu': 50}
+        last_updates = {'a.cpu': 200, 'b.cpu': 200, 'c.cpu': 200}
+
+        self.assertListEqual(['d.cpu', 'b.cpu', 'c.cpu'], subject.schedule(metrics, last_updates))
+
+    def test_staleness_order(self):
+        subject = MetricScheduler()
+        metrics = {'a.cpu': 1000, 'b.cpu': 1000, 'c.cpu': 1000}
+        last_updates = {'a.cpu': 300, 'b.cpu': 100}
+
+        self.assertListEqual(['c.cpu', 'b.cpu', 'a.cpu'], subject.schedule(metrics, last_updates))
+
+    def test_priorities(self):
+        subject = MetricScheduler(MetricScheduler.parse_priorities('web*.cpu, *.load'))
+        metrics = {'a.cpu': 1000, 'web1.cpu': 1000, 'a.load': 1000, 'web2.cpu': 1000}
+        last_updates = {'web1.cpu': 200, 'web2.cpu': 100, 'a.cpu': 50}
+
+        self.assertListEqual(['web2.cpu', 'web1.cpu', 'a.load', 'a.cpu'], subject.schedule(metrics, last_updates))
+
+if __name__ == '__main__':
+    unittest.main()
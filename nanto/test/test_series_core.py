@@ -0,0 +1,102 @@
+import unittest
+
+import numpy as np
+
+from module.series_core import to_matrix, fill_gaps, ecdf_ranges, changepoints, states_to_los, transition_matrices, mean_first_passage
+
+class TestSeriesCore(unittest.TestCase):
+    """Unit testing the statistical tools shared by the workers"""
+
+    def test_to_matrix(self):
+        matrix = to_matrix([[1, 2, 3], [None, 5], []])
+
+        self.assertEqual((3, 3), matrix.shape)
+        self.assertListEqual([1, 2, 3], matrix[0].tolist())
+        self.assertTrue(np.isnan(matrix[1, 0]) and np.isnan(matrix[1, 1]))
+        self.assertEqual(5, matrix[1, 2])
+        self.assertTrue(np.isnan(matrix[2]).all())
+
+    def test_fill_gaps(self):
+        matrix = fill_gaps(np.array([[np.nan, 1, np.nan, 3, np.nan]]))
+
+        self.assertTrue(np.isnan(matrix[0, 0]))
+        self.assertListEqual([1, 1, 3, 3], matrix[0, 1:].tolist())
+
+    def test_ecdf_ranges(self):
+        matrix = to_matrix([range(1, 11), [None] * 10, [None] * 9 + [5]])
+        upper_bounds, probabilities, lower_95, upper_95, counts = ecdf_ranges(matrix, 10)
+
+        self.assertListEqual([10, 0, 1], counts.tolist())
+        # The intervals span from 0 to the highest value
+        self.assertListEqual(range(1, 11), upper_bounds[0].tolist())
+        self.assertAlmostEqual(1, probabilities[0].sum())
+        self.assertEqual(1, lower_95[0])
+        self.assertEqual(10, upper_95[0])
+
+    def test_ecdf_ranges_no_values(self):
+        upper_bounds, probabilities, lower_95, upper_95, counts = ecdf_ranges(to_matrix([[None] * 10]), 10)
+
+        self.assertEqual(0, counts[0])
+        self.assertListEqual([0] * 10, probabilities[0].tolist())
+        self.assertFalse(np.isnan(upper_bounds).any())
+
+    def test_ecdf_ranges_single_value(self):
+        upper_bounds, probabilities, lower_95, upper_95, counts = ecdf_ranges(to_matrix([[None] * 9 + [5]]), 10)
+
+        self.assertEqual(1, counts[0])
+        self.assertEqual(5, upper_bounds[0, -1])
+        self.assertListEqual([0] * 9 + [1], probabilities[0].tolist())
+        self.assertEqual(5, lower_95[0])
+        self.assertEqual(5, upper_95[0])
+
+    def test_changepoints_step(self):
+        noise = np.random.RandomState(0).normal(0, 1, 300)
+        values = np.concatenate(([0] * 100, [10] * 120, [4] * 80)) + noise
+        points = changepoints(values)
+
+        self.assertEqual(2, len(points))
+        self.assertAlmostEqual(100, points[0], delta=2)
+        self.assertAlmostEqual(220, points[1], delta=2)
+
+    def test_changepoints_none(self):
+        self.assertListEqual([], changepoints([3] * 100))
+        self.assertListEqual([], changepoints(np.random.RandomState(0).normal(0, 1, 300)))
+        self.assertListEqual([], changepoints([1, 10]))
+
+    def test_states_to_los(self):
+        los = states_to_los([10, 70, 500], [2, 1, 0], 0, 601, 60)
+
+        self.assertListEqual([0, 2, 1, 1, 1, 1, 1, 1, 1, 0, 0], los.tolist())
+        self.assertListEqual([0] * 11, states_to_los([], [], 0, 601, 60).tolist())
+
+    def test_transition_matrices(self):
+        transitions = transition_matrices(np.array([[0, 0, 1, 1, 0]]), 3)
+
+        self.assertEqual((1, 3, 3), transitions.shape)
+        self.assertListEqual([0.5, 0.5, 0], transitions[0, 0].tolist())
+        self.assertListEqual([0.5, 0.5, 0], transitions[0, 1].tolist())
+        # States that were never left are absorbing
+        self.assertListEqual([0, 0, 1], transitions[0, 2].tolist())
+
+    def test_mean_first_passage(self):
+        transitions = np.array([[[0.5, 0.5], [0, 1]]])
+
+        self.assertListEqual([2, 0], mean_first_passage(transitions, 1)[0].tolist())
+
+    def test_mean_first_passage_unreachable(self):
+        # The error state (3) is never reached
+        times = mean_first_passage(transition_matrices(np.zeros((1, 10), dtype=int), 4), 3)
+
+        self.assertTrue(np.isnan(times[0, :3]).all())
+        self.assertEqual(0, times[0, 3])
+
+    def test_mean_first_passage_absorbing(self):
+        # OK (0) is absorbing, WARNING (1) always leads to CRITICAL (2), which always leads to the error state (3)
+        transitions = np.array([[[1, 0, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1], [0, 0, 0, 1]]], dtype=float)
+        times = mean_first_passage(transitions, 3)
+
+        self.assertTrue(np.isnan(times[0, 0]))
+        self.assertListEqual([2, 1, 0], times[0, 1:].tolist())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import socket
+import sqlite3
+import time
+import unittest
+
+from module.stats import WorkerStats, STATS_RETENTION
+
+class TestStats(unittest.TestCase):
+    """Unit testing the statistics of the worker runs"""
+
+    def setUp(self):
+        self.now = 100000.0
+        self.old_time = time.time
+        time.time = lambda: self.now
+
+    def tearDown(self):
+        time.time = self.old_time
+
+    def record(self):
+        """ Returns the statistics of a fake run lasting 10 seconds """
+        stats = WorkerStats()
+        with stats.stage('fetch'):
+            self.now += 2
+        with stats.stage('fetch'):
+            self.now += 1
+        with stats.stage('forecast'):
+            self.now += 4
+        stats.count('forecasted', 4)
+        stats.count('forecast_errors')
+        stats.count('processed', 3)
+        self.now += 3
+        stats.stop()
+        return stats
+
+    def test_values(self):
+        values = self.record().values()
+
+        self.assertDictEqual({'duration': 10,
+                              'stage.fetch.time': 3,
+                              'stage.fetch.calls': 2,
+                              'stage.forecast.time': 4,
+                              'stage.forecast.calls': 1,
+                              'count.forecasted': 4,
+                              'count.forecast_errors': 1,
+                              'count.processed': 3,
+                              'forecast_error_rate': 0.25}, values)
+
+    def test_save(self):
+        con = sqlite3.connect(':memory:')
+        stats = self.record()
+        stats.save(con, 'test')
+        # An outdated run is removed when the next run is saved
+        con.execute("INSERT INTO onoc_pred_stats (worker_name, run_time, name, value) VALUES ('test', ?, 'duration', 1)", (self.now - STATS_RETENTION - 1,))
+        con.execute("INSERT INTO onoc_pred_stats (worker_name, run_time, name, value) VALUES ('test', ?, 'duration', 2)", (self.now - STATS_RETENTION + 100,))
+        stats.save(con, 'test')
+
+        rows = con.execute('SELECT run_time, name, value FROM onoc_pred_stats WHERE worker_name=? ORDER BY run_time, name', ('test',)).fetchall()
+        self.assertListEqual([(self.now - STATS_RETENTION + 100, 'duration', 2)], rows[:1])
+        self.assertSetEqual(set([100000]), set(r[0] for r in rows[1:]))
+        self.assertDictEqual(stats.values(), dict((r[1], r[2]) for r in rows[1:]))
+
+    def test_send(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            stats = self.record()
+            stats.send('127.0.0.1:{0}'.format(server.getsockname()[1]), 'nanto.test')
+
+            client, address = server.accept()
+            data = ''
+            while True:
+                chunk = client.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            client.close()
+        finally:
+            server.close()
+
+        lines = data.splitlines()
+        self.assertEqual(9, len(lines))
+        self.assertListEqual(sorted(lines), lines)
+        self.assertIn('nanto.test.duration 10.0 100010', lines)
+        self.assertIn('nanto.test.stage.fetch.calls 2 100010', lines)
+        self.assertIn('nanto.test.count.processed 3 100010', lines)
+        self.assertIn('nanto.test.forecast_error_rate 0.25 100010', lines)
+
+    def test_send_unreachable(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        server.close()
+        # Errors are logged, not raised
+        self.record().send('127.0.0.1:{0}'.format(port), 'nanto.test')
+        self.record().send('127.0.0.1:port', 'nanto.test')
+
+if __name__ == '__main__':
+    unittest.main()